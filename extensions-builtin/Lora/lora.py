@@ -1,9 +1,11 @@
 import os
 import re
+import time
 import torch
+from collections import OrderedDict
 from typing import Union
 
-from modules import shared, devices, sd_models, errors, scripts, sd_hijack, hashes
+from modules import shared, devices, sd_models, sd_models_cache, errors, scripts, sd_hijack, hashes, model_library
 
 metadata_tags_order = {"ss_sd_model_name": 1, "ss_resolution": 2, "ss_clip_skip": 3, "ss_num_train_images": 10, "ss_tag_frequency": 20}
 
@@ -80,7 +82,7 @@ class LoraOnDisk:
 
         if self.is_safetensors:
             try:
-                self.metadata = sd_models.read_metadata_from_safetensors(filename)
+                self.metadata = model_library.library.file_data(filename, "safetensors_metadata", sd_models.read_metadata_from_safetensors)
             except Exception as e:
                 errors.display(e, f"reading lora {filename}")
 
@@ -111,7 +113,7 @@ class LoraOnDisk:
 
     def read_hash(self):
         if not self.hash:
-            self.set_hash(hashes.sha256(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors) or '')
+            self.set_hash(hashes.sha256_in_background(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors, callback=self.set_hash) or '')
 
     def get_alias(self):
         if shared.opts.lora_preferred_name == "Filename" or self.alias.lower() in forbidden_lora_aliases:
@@ -127,19 +129,182 @@ class LoraModule:
         self.multiplier = 1.0
         self.modules = {}
         self.mtime = None
+        self.nbytes = 0
 
         self.mentioned_name = None
         """the text that was used to add lora to prompt - can be either name or an alias"""
 
 
 class LoraUpDownModule:
-    def __init__(self):
-        self.up = None
-        self.down = None
+    """
+    Up and down weights of a single Lora layer, as tensors. The weights are read from the Lora's state dict when they
+    are first used, so for memory-mapped safetensors files loading a Lora only reads the file's header.
+    """
+
+    def __init__(self, state_dict=None):
+        self.state_dict = state_dict
+        self.up_key = None
+        self.down_key = None
         self.alpha = None
 
+        self._up = None
+        self._down = None
+
+    @property
+    def up(self):
+        if self._up is None and self.up_key is not None:
+            self._up = self.state_dict[self.up_key]
+
+        return self._up
+
+    @up.setter
+    def up(self, value):
+        self._up = value
+
+    @property
+    def down(self):
+        if self._down is None and self.down_key is not None:
+            self._down = self.state_dict[self.down_key]
+
+        return self._down
+
+    @down.setter
+    def down(self, value):
+        self._down = value
+
+
+class LoraCache:
+    """
+    LRU cache of loaded Loras that are kept between generations, limited by the total size of their files. Loras used
+    by the current generation are never removed.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.layer_names = None
+        """names of layers of the model that Loras in cache were loaded for"""
+
+    def max_size(self):
+        return shared.opts.lora_cache_size * 1024 * 1024
+
+    def get(self, name):
+        lora = self.entries.get(name)
+        if lora is not None:
+            self.entries.move_to_end(name)
+
+        return lora
+
+    def put(self, name, lora):
+        self.entries[name] = lora
+        self.entries.move_to_end(name)
+
+    def evict(self, keep=()):
+        keep_ids = {id(x) for x in keep}
+        size = sum(x.nbytes for x in self.entries.values())
+
+        for name, lora in list(self.entries.items()):
+            if size <= self.max_size():
+                break
+
+            if id(lora) in keep_ids:
+                continue
+
+            del self.entries[name]
+            size -= lora.nbytes
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "size": sum(x.nbytes for x in self.entries.values()),
+            "max_size": self.max_size(),
+        }
+
+
+class LoraDeltaCache:
+    """
+    LRU cache of weight changes calculated from Lora layers, limited by the total size of cached tensors.
+
+    Changes are stored without the Lora's multiplier applied, so they can be reused when the multiplier in prompt
+    changes, and are kept on the device and in the dtype of the layer they are for.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def max_size(self):
+        return shared.opts.lora_delta_cache_size * 1024 * 1024
+
+    def get(self, key, calculate):
+        """returns the cached change for key, or the result of calculate(), which is cached if it fits"""
+
+        updown = self.entries.get(key)
+        if updown is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return updown
+
+        self.misses += 1
+        updown = calculate()
+
+        size = updown.nbytes
+        if size > self.max_size():
+            return updown
+
+        self.entries[key] = updown
+        self.sizes[key] = size
+        self.size += size
+
+        while self.size > self.max_size():
+            old_key, _ = self.entries.popitem(last=False)
+            self.size -= self.sizes.pop(old_key)
+
+        return updown
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size(),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class LoraMergeStats:
+    """time spent applying Loras to model weights since the set of Loras was last selected - normally, during one request"""
+
+    def __init__(self):
+        self.layers = 0
+        self.seconds = 0.0
+        self.backups_size = 0
+
+    def reset(self):
+        self.layers = 0
+        self.seconds = 0.0
+
+    def stats(self):
+        return {
+            "layers_merged": self.layers,
+            "merge_seconds": self.seconds,
+            "backups_size": self.backups_size,
+        }
+
 
 def assign_lora_names_to_compvis_modules(sd_model):
+    delta_cache.clear()
+
     lora_layer_mapping = {}
 
     for name, module in shared.sd_model.cond_stage_model.wrapped.named_modules():
@@ -154,12 +319,22 @@ def assign_lora_names_to_compvis_modules(sd_model):
 
     sd_model.lora_layer_mapping = lora_layer_mapping
 
+    # which keys of a Lora are used depends on layers of the model, so Loras loaded for a different architecture are dropped
+    layer_names = set(lora_layer_mapping)
+    if lora_cache.layer_names != layer_names:
+        lora_cache.clear()
+        lora_cache.layer_names = layer_names
+
 
 def load_lora(name, lora_on_disk):
     lora = LoraModule(name, lora_on_disk)
     lora.mtime = os.path.getmtime(lora_on_disk.filename)
+    lora.nbytes = os.path.getsize(lora_on_disk.filename)
 
-    sd = sd_models.read_state_dict(lora_on_disk.filename)
+    if lora_on_disk.is_safetensors:
+        sd = sd_models_cache.MappedStateDict(lora_on_disk.filename)
+    else:
+        sd = sd_models.read_state_dict(lora_on_disk.filename, map_location=devices.cpu)
 
     # this should not be needed but is here as an emergency fix for an unknown error people are experiencing in 1.2.0
     if not hasattr(shared.sd_model, 'lora_layer_mapping'):
@@ -168,7 +343,7 @@ def load_lora(name, lora_on_disk):
     keys_failed_to_match = {}
     is_sd2 = 'model_transformer_resblocks' in shared.sd_model.lora_layer_mapping
 
-    for key_diffusers, weight in sd.items():
+    for key_diffusers in sd.keys():
         key_diffusers_without_lora_parts, lora_key = key_diffusers.split(".", 1)
         key = convert_diffusers_name_to_compvis(key_diffusers_without_lora_parts, is_sd2)
 
@@ -185,37 +360,27 @@ def load_lora(name, lora_on_disk):
 
         lora_module = lora.modules.get(key, None)
         if lora_module is None:
-            lora_module = LoraUpDownModule()
+            lora_module = LoraUpDownModule(sd)
             lora.modules[key] = lora_module
 
         if lora_key == "alpha":
-            lora_module.alpha = weight.item()
+            lora_module.alpha = sd[key_diffusers].item()
             continue
 
-        if type(sd_module) == torch.nn.Linear:
-            module = torch.nn.Linear(weight.shape[1], weight.shape[0], bias=False)
-        elif type(sd_module) == torch.nn.modules.linear.NonDynamicallyQuantizableLinear:
-            module = torch.nn.Linear(weight.shape[1], weight.shape[0], bias=False)
-        elif type(sd_module) == torch.nn.MultiheadAttention:
-            module = torch.nn.Linear(weight.shape[1], weight.shape[0], bias=False)
-        elif type(sd_module) == torch.nn.Conv2d and weight.shape[2:] == (1, 1):
-            module = torch.nn.Conv2d(weight.shape[1], weight.shape[0], (1, 1), bias=False)
-        elif type(sd_module) == torch.nn.Conv2d and weight.shape[2:] == (3, 3):
-            module = torch.nn.Conv2d(weight.shape[1], weight.shape[0], (3, 3), bias=False)
+        shape = sd.shape(key_diffusers) if isinstance(sd, sd_models_cache.MappedStateDict) else tuple(sd[key_diffusers].shape)
+
+        if type(sd_module) in (torch.nn.Linear, torch.nn.modules.linear.NonDynamicallyQuantizableLinear, torch.nn.MultiheadAttention) and len(shape) == 2:
+            pass
+        elif type(sd_module) == torch.nn.Conv2d and shape[2:] in ((1, 1), (3, 3)):
+            pass
         else:
             print(f'Lora layer {key_diffusers} matched a layer with unsupported type: {type(sd_module).__name__}')
             continue
-            raise AssertionError(f"Lora layer {key_diffusers} matched a layer with unsupported type: {type(sd_module).__name__}")
-
-        with torch.no_grad():
-            module.weight.copy_(weight)
-
-        module.to(device=devices.cpu, dtype=devices.dtype)
 
         if lora_key == "lora_up.weight":
-            lora_module.up = module
+            lora_module.up_key = key_diffusers
         elif lora_key == "lora_down.weight":
-            lora_module.down = module
+            lora_module.down_key = key_diffusers
         else:
             raise AssertionError(f"Bad Lora layer name: {key_diffusers} - must end in lora_up.weight, lora_down.weight or alpha")
 
@@ -226,12 +391,6 @@ def load_lora(name, lora_on_disk):
 
 
 def load_loras(names, multipliers=None):
-    already_loaded = {}
-
-    for lora in loaded_loras:
-        if lora.name in names:
-            already_loaded[lora.name] = lora
-
     loaded_loras.clear()
 
     loras_on_disk = [available_lora_aliases.get(name, None) for name in names]
@@ -242,19 +401,23 @@ def load_loras(names, multipliers=None):
 
     failed_to_load_loras = []
 
+    merge_stats.reset()
+
     for i, name in enumerate(names):
-        lora = already_loaded.get(name, None)
+        lora = lora_cache.get(name)
 
         lora_on_disk = loras_on_disk[i]
 
         if lora_on_disk is not None:
-            if lora is None or os.path.getmtime(lora_on_disk.filename) > lora.mtime:
+            if lora is None or lora.lora_on_disk.filename != lora_on_disk.filename or os.path.getmtime(lora_on_disk.filename) > lora.mtime:
                 try:
                     lora = load_lora(name, lora_on_disk)
                 except Exception as e:
                     errors.display(e, f"loading Lora {lora_on_disk.filename}")
                     continue
 
+                lora_cache.put(name, lora)
+
             lora.mentioned_name = name
 
             lora_on_disk.read_hash()
@@ -267,14 +430,18 @@ def load_loras(names, multipliers=None):
         lora.multiplier = multipliers[i] if multipliers else 1.0
         loaded_loras.append(lora)
 
+    lora_cache.evict(keep=loaded_loras)
+
     if failed_to_load_loras:
         sd_hijack.model_hijack.comments.append("Failed to find Loras: " + ", ".join(failed_to_load_loras))
 
 
-def lora_calc_updown(lora, module, target):
+def lora_calc_updown_unscaled(module, target):
+    """calculates the change to target's weight made by Lora layer module, without the Lora's multiplier"""
+
     with torch.no_grad():
-        up = module.up.weight.to(target.device, dtype=target.dtype)
-        down = module.down.weight.to(target.device, dtype=target.dtype)
+        up = module.up.to(target.device, dtype=target.dtype)
+        down = module.down.to(target.device, dtype=target.dtype)
 
         if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
             updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
@@ -283,11 +450,52 @@ def lora_calc_updown(lora, module, target):
         else:
             updown = up @ down
 
-        updown = updown * lora.multiplier * (module.alpha / module.up.weight.shape[1] if module.alpha else 1.0)
+        if module.alpha:
+            updown *= module.alpha / module.up.shape[1]
 
         return updown
 
 
+def lora_calc_updown(lora, module, target):
+    return lora_calc_updown_unscaled(module, target) * lora.multiplier
+
+
+def lora_cached_updown(lora, layer_name, target, calculate):
+    """returns the change to target's weight made by lora's layer_name layer, without multiplier, using delta_cache"""
+
+    key = (lora.name, lora.mtime, layer_name, target.device, target.dtype)
+
+    return delta_cache.get(key, calculate)
+
+
+def lora_accumulate(fused, updown, multiplier):
+    """adds updown * multiplier to fused, which is a tensor owned by the caller or None"""
+
+    if fused is None:
+        return updown * multiplier
+
+    return fused.add_(updown, alpha=multiplier)
+
+
+def lora_backup_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.MultiheadAttention]):
+    """
+    Keeps a copy of layer's original weights in CPU RAM, if it doesn't have one yet. This is only done for layers
+    that Loras actually change, once per layer, and the copy keeps the dtype of the weights.
+    """
+
+    if getattr(self, "lora_weights_backup", None) is not None:
+        return
+
+    if isinstance(self, torch.nn.MultiheadAttention):
+        weights_backup = (self.in_proj_weight.to(devices.cpu, copy=True), self.out_proj.weight.to(devices.cpu, copy=True))
+        merge_stats.backups_size += sum(x.nbytes for x in weights_backup)
+    else:
+        weights_backup = self.weight.to(devices.cpu, copy=True)
+        merge_stats.backups_size += weights_backup.nbytes
+
+    self.lora_weights_backup = weights_backup
+
+
 def lora_restore_weights_from_backup(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.MultiheadAttention]):
     weights_backup = getattr(self, "lora_weights_backup", None)
 
@@ -315,45 +523,65 @@ def lora_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.Mu
     current_names = getattr(self, "lora_current_names", ())
     wanted_names = tuple((x.name, x.multiplier) for x in loaded_loras)
 
-    weights_backup = getattr(self, "lora_weights_backup", None)
-    if weights_backup is None:
-        if isinstance(self, torch.nn.MultiheadAttention):
-            weights_backup = (self.in_proj_weight.to(devices.cpu, copy=True), self.out_proj.weight.to(devices.cpu, copy=True))
-        else:
-            weights_backup = self.weight.to(devices.cpu, copy=True)
+    if current_names == wanted_names:
+        return
 
-        self.lora_weights_backup = weights_backup
+    t0 = time.perf_counter()
 
-    if current_names != wanted_names:
-        lora_restore_weights_from_backup(self)
+    # changes from all Loras are summed first, so that weights are only updated once however many Loras there are
+    fused = None
+    fused_in_proj = None
+    fused_out_proj = None
 
-        for lora in loaded_loras:
-            module = lora.modules.get(lora_layer_name, None)
-            if module is not None and hasattr(self, 'weight'):
-                self.weight += lora_calc_updown(lora, module, self.weight)
-                continue
+    for lora in loaded_loras:
+        module = lora.modules.get(lora_layer_name, None)
+        if module is not None and hasattr(self, 'weight'):
+            updown = lora_cached_updown(lora, lora_layer_name, self.weight, lambda module=module: lora_calc_updown_unscaled(module, self.weight))
+            fused = lora_accumulate(fused, updown, lora.multiplier)
+            continue
 
-            module_q = lora.modules.get(lora_layer_name + "_q_proj", None)
-            module_k = lora.modules.get(lora_layer_name + "_k_proj", None)
-            module_v = lora.modules.get(lora_layer_name + "_v_proj", None)
-            module_out = lora.modules.get(lora_layer_name + "_out_proj", None)
+        module_q = lora.modules.get(lora_layer_name + "_q_proj", None)
+        module_k = lora.modules.get(lora_layer_name + "_k_proj", None)
+        module_v = lora.modules.get(lora_layer_name + "_v_proj", None)
+        module_out = lora.modules.get(lora_layer_name + "_out_proj", None)
 
-            if isinstance(self, torch.nn.MultiheadAttention) and module_q and module_k and module_v and module_out:
-                updown_q = lora_calc_updown(lora, module_q, self.in_proj_weight)
-                updown_k = lora_calc_updown(lora, module_k, self.in_proj_weight)
-                updown_v = lora_calc_updown(lora, module_v, self.in_proj_weight)
-                updown_qkv = torch.vstack([updown_q, updown_k, updown_v])
+        if isinstance(self, torch.nn.MultiheadAttention) and module_q and module_k and module_v and module_out:
+            def calc_qkv(module_q=module_q, module_k=module_k, module_v=module_v):
+                updown_q = lora_calc_updown_unscaled(module_q, self.in_proj_weight)
+                updown_k = lora_calc_updown_unscaled(module_k, self.in_proj_weight)
+                updown_v = lora_calc_updown_unscaled(module_v, self.in_proj_weight)
+                return torch.vstack([updown_q, updown_k, updown_v])
 
-                self.in_proj_weight += updown_qkv
-                self.out_proj.weight += lora_calc_updown(lora, module_out, self.out_proj.weight)
-                continue
+            updown_qkv = lora_cached_updown(lora, lora_layer_name + "_qkv", self.in_proj_weight, calc_qkv)
+            updown_out = lora_cached_updown(lora, lora_layer_name + "_out_proj", self.out_proj.weight, lambda module_out=module_out: lora_calc_updown_unscaled(module_out, self.out_proj.weight))
 
-            if module is None:
-                continue
+            fused_in_proj = lora_accumulate(fused_in_proj, updown_qkv, lora.multiplier)
+            fused_out_proj = lora_accumulate(fused_out_proj, updown_out, lora.multiplier)
+            continue
 
-            print(f'failed to calculate lora weights for layer {lora_layer_name}')
+        if module is None:
+            continue
+
+        print(f'failed to calculate lora weights for layer {lora_layer_name}')
+
+    changed = fused is not None or fused_in_proj is not None
+    if changed:
+        lora_backup_weights(self)
+
+    lora_restore_weights_from_backup(self)
+
+    if fused is not None:
+        self.weight += fused
+
+    if fused_in_proj is not None:
+        self.in_proj_weight += fused_in_proj
+        self.out_proj.weight += fused_out_proj
 
-        self.lora_current_names = wanted_names
+    self.lora_current_names = wanted_names
+
+    if changed:
+        merge_stats.layers += 1
+    merge_stats.seconds += time.perf_counter() - t0
 
 
 def lora_forward(module, input, original_forward):
@@ -378,15 +606,27 @@ def lora_forward(module, input, original_forward):
         if module is None:
             continue
 
-        module.up.to(device=devices.device)
-        module.down.to(device=devices.device)
+        # converted for this call only: the Lora may stay in lora_cache after it's unloaded, and should stay in RAM there
+        up = module.up.to(device=devices.device, dtype=input.dtype)
+        down = module.down.to(device=devices.device, dtype=input.dtype)
+
+        if down.ndim == 4:
+            lora_res = torch.nn.functional.conv2d(torch.nn.functional.conv2d(input, down), up)
+        else:
+            lora_res = torch.nn.functional.linear(torch.nn.functional.linear(input, down), up)
 
-        res = res + module.up(module.down(input)) * lora.multiplier * (module.alpha / module.up.weight.shape[1] if module.alpha else 1.0)
+        res = res + lora_res * lora.multiplier * (module.alpha / up.shape[1] if module.alpha else 1.0)
 
     return res
 
 
 def lora_reset_cached_weight(self: Union[torch.nn.Conv2d, torch.nn.Linear]):
+    weights_backup = getattr(self, "lora_weights_backup", None)
+    if isinstance(weights_backup, tuple):
+        merge_stats.backups_size -= sum(x.nbytes for x in weights_backup)
+    elif weights_backup is not None:
+        merge_stats.backups_size -= weights_backup.nbytes
+
     self.lora_current_names = ()
     self.lora_weights_backup = None
 
@@ -442,7 +682,7 @@ def list_available_loras():
 
     os.makedirs(shared.cmd_opts.lora_dir, exist_ok=True)
 
-    candidates = list(shared.walk_files(shared.cmd_opts.lora_dir, allowed_extensions=[".pt", ".ckpt", ".safetensors"]))
+    candidates = model_library.library.walk_files(shared.cmd_opts.lora_dir, allowed_extensions=[".pt", ".ckpt", ".safetensors"])
     for filename in sorted(candidates, key=str.lower):
         if os.path.isdir(filename):
             continue
@@ -462,6 +702,8 @@ def list_available_loras():
         available_lora_aliases[name] = entry
         available_lora_aliases[entry.alias] = entry
 
+    model_library.library.save()
+
 
 re_lora_name = re.compile(r"(.*)\s*\([0-9a-fA-F]+\)")
 
@@ -502,5 +744,8 @@ available_lora_aliases = {}
 available_lora_hash_lookup = {}
 forbidden_lora_aliases = {}
 loaded_loras = []
+lora_cache = LoraCache()
+delta_cache = LoraDeltaCache()
+merge_stats = LoraMergeStats()
 
 list_available_loras()
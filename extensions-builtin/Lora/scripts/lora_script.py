@@ -58,6 +58,8 @@ shared.options_templates.update(shared.options_section(('extra_networks', "Extra
     "sd_lora": shared.OptionInfo("None", "Add Lora to prompt", gr.Dropdown, lambda: {"choices": ["None", *lora.available_loras]}, refresh=lora.list_available_loras),
     "lora_preferred_name": shared.OptionInfo("Alias from file", "When adding to prompt, refer to Lora by", gr.Radio, {"choices": ["Alias from file", "Filename"]}),
     "lora_add_hashes_to_infotext": shared.OptionInfo(True, "Add Lora hashes to infotext"),
+    "lora_cache_size": shared.OptionInfo(1024, "Memory for keeping Loras loaded between generations, in MB", gr.Number, {"precision": 0}).info("counted by file size; safetensors Loras are memory-mapped and only read when their layers are used"),
+    "lora_delta_cache_size": shared.OptionInfo(256, "Memory for caching calculated Lora weight changes, in MB", gr.Number, {"precision": 0}).info("0 = disable; changes are kept in VRAM and make switching between sets of Loras faster"),
 }))
 
 
@@ -84,6 +86,14 @@ def api_loras(_: gr.Blocks, app: FastAPI):
     async def refresh_loras():
         return lora.list_available_loras()
 
+    @app.get("/sdapi/v1/lora-stats")
+    async def get_lora_stats():
+        return {
+            "merge": lora.merge_stats.stats(),
+            "delta_cache": lora.delta_cache.stats(),
+            "lora_cache": lora.lora_cache.stats(),
+        }
+
 
 script_callbacks.on_app_started(api_loras)
 
@@ -1,20 +1,26 @@
 import base64
 import io
+import json
+import queue
+import threading
 import time
+import uuid
 import datetime
 import uvicorn
 import gradio as gr
-from threading import Lock
+from contextlib import contextmanager
 from io import BytesIO
 from fastapi import APIRouter, Depends, FastAPI, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from secrets import compare_digest
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
 
 import modules.shared as shared
-from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors
+from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, job_scheduler, batch_coalescer, task_results, progress, cond_cache, init_latent_cache
 from modules.api import models
 from modules.shared import opts
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
@@ -22,7 +28,7 @@ from modules.textual_inversion.textual_inversion import create_embedding, train_
 from modules.textual_inversion.preprocess import preprocess
 from modules.hypernetworks.hypernetwork import create_hypernetwork, train_hypernetwork
 from PIL import PngImagePlugin,Image
-from modules.sd_models import checkpoints_list, unload_model_weights, reload_model_weights
+from modules.sd_models import checkpoint_infos, unload_model_weights, reload_model_weights
 from modules.sd_vae import vae_dict
 from modules.sd_models_config import find_checkpoint_config_near_filename
 from modules.realesrgan_model import get_realesrgan_models
@@ -62,6 +68,12 @@ def setUpscalers(req: dict):
 
 
 def decode_base64_to_image(encoding):
+    if isinstance(encoding, (bytes, bytearray)):  # from a multipart upload
+        try:
+            return Image.open(BytesIO(encoding))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail="Invalid image") from e
+
     if encoding.startswith("data:image/"):
         encoding = encoding.split(";")[1].split(",")[1]
     try:
@@ -71,34 +83,70 @@ def decode_base64_to_image(encoding):
         raise HTTPException(status_code=500, detail="Invalid encoded image") from e
 
 
-def encode_pil_to_base64(image):
-    with io.BytesIO() as output_bytes:
-
-        if opts.samples_format.lower() == 'png':
-            use_metadata = False
-            metadata = PngImagePlugin.PngInfo()
-            for key, value in image.info.items():
-                if isinstance(key, str) and isinstance(value, str):
-                    metadata.add_text(key, value)
-                    use_metadata = True
-            image.save(output_bytes, format="PNG", pnginfo=(metadata if use_metadata else None), quality=opts.jpeg_quality)
-
-        elif opts.samples_format.lower() in ("jpg", "jpeg", "webp"):
-            parameters = image.info.get('parameters', None)
-            exif_bytes = piexif.dump({
-                "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters or "", encoding="unicode") }
-            })
-            if opts.samples_format.lower() in ("jpg", "jpeg"):
-                image.save(output_bytes, format="JPEG", exif = exif_bytes, quality=opts.jpeg_quality)
-            else:
-                image.save(output_bytes, format="WEBP", exif = exif_bytes, quality=opts.jpeg_quality)
+image_media_types = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+def validate_image_format(image_format):
+    """returns image_format (opts.samples_format by default) in lower case and its media type; raises HTTP 422 if it's not supported"""
+
+    image_format = (image_format or opts.samples_format).lower()
+    media_type = image_media_types.get(image_format)
+    if media_type is None:
+        raise HTTPException(status_code=422, detail=f"Invalid image format: {image_format}")
+
+    return image_format, media_type
+
+
+def encode_pil_to_bytes(image, image_format=None, quality=None, compress_level=None):
+    """
+    Encodes image in image_format (opts.samples_format by default) and returns the encoded bytes; BytesIO hands over
+    its buffer to getvalue() without copying it as long as nothing else references the buffer.
+    """
+
+    image_format = (image_format or opts.samples_format).lower()
+    quality = quality if quality is not None else opts.jpeg_quality
+    output_bytes = io.BytesIO()
+
+    if image_format == 'png':
+        use_metadata = False
+        metadata = PngImagePlugin.PngInfo()
+        for key, value in image.info.items():
+            if isinstance(key, str) and isinstance(value, str):
+                metadata.add_text(key, value)
+                use_metadata = True
+        image.save(output_bytes, format="PNG", pnginfo=(metadata if use_metadata else None), compress_level=compress_level if compress_level is not None else 6)
 
+    elif image_format in ("jpg", "jpeg", "webp"):
+        parameters = image.info.get('parameters', None)
+        exif_bytes = piexif.dump({
+            "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters or "", encoding="unicode") }
+        })
+        if image_format in ("jpg", "jpeg"):
+            image.save(output_bytes, format="JPEG", exif = exif_bytes, quality=quality)
         else:
-            raise HTTPException(status_code=500, detail="Invalid image format")
+            image.save(output_bytes, format="WEBP", exif = exif_bytes, quality=quality)
+
+    else:
+        raise HTTPException(status_code=500, detail="Invalid image format")
+
+    return output_bytes.getvalue()
+
+
+def encode_pil_to_base64(image, image_format=None, quality=None, compress_level=None):
+    return base64.b64encode(encode_pil_to_bytes(image, image_format, quality, compress_level))
+
 
-        bytes_data = output_bytes.getvalue()
+def multipart_part(boundary, content_type, data):
+    """chunks of one part of a multipart response; data is sent as is, without being copied into a bigger buffer"""
 
-    return base64.b64encode(bytes_data)
+    head = f"--{boundary}\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\n\r\n"
+
+    return [head.encode("utf8"), data, b"\r\n"]
 
 
 def api_middleware(app: FastAPI):
@@ -164,7 +212,7 @@ def api_middleware(app: FastAPI):
 
 
 class Api:
-    def __init__(self, app: FastAPI, queue_lock: Lock):
+    def __init__(self, app: FastAPI, queue_lock: job_scheduler.JobScheduler):
         if shared.cmd_opts.api_auth:
             self.credentials = {}
             for auth in shared.cmd_opts.api_auth.split(","):
@@ -174,13 +222,23 @@ class Api:
         self.router = APIRouter()
         self.app = app
         self.queue_lock = queue_lock
+        self.submitted_tasks = set()
+        self.submitted_tasks_lock = threading.Lock()
         api_middleware(self.app)
         self.add_api_route("/sdapi/v1/txt2img", self.text2imgapi, methods=["POST"], response_model=models.TextToImageResponse)
         self.add_api_route("/sdapi/v1/img2img", self.img2imgapi, methods=["POST"], response_model=models.ImageToImageResponse)
+        self.add_api_route("/sdapi/v1/txt2img/multipart", self.text2imgapi_multipart, methods=["POST"])
+        self.add_api_route("/sdapi/v1/img2img/multipart", self.img2imgapi_multipart, methods=["POST"])
+        self.add_api_route("/sdapi/v1/txt2img/submit", self.text2imgapi_submit, methods=["POST"], response_model=models.TaskSubmitResponse)
+        self.add_api_route("/sdapi/v1/img2img/submit", self.img2imgapi_submit, methods=["POST"], response_model=models.TaskSubmitResponse)
+        self.add_api_route("/sdapi/v1/task-result", self.get_task_result, methods=["GET"], response_model=models.TaskResultResponse)
         self.add_api_route("/sdapi/v1/extra-single-image", self.extras_single_image_api, methods=["POST"], response_model=models.ExtrasSingleImageResponse)
         self.add_api_route("/sdapi/v1/extra-batch-images", self.extras_batch_images_api, methods=["POST"], response_model=models.ExtrasBatchImagesResponse)
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
         self.add_api_route("/sdapi/v1/progress", self.progressapi, methods=["GET"], response_model=models.ProgressResponse)
+        self.add_api_route("/sdapi/v1/progress/stream", progress.progress_stream, methods=["GET"])
+        self.add_api_route("/sdapi/v1/queue", self.get_queue, methods=["GET"], response_model=models.QueueStatusResponse)
+        self.add_api_route("/sdapi/v1/queue/cancel", self.cancel_queued, methods=["POST"])
         self.add_api_route("/sdapi/v1/interrogate", self.interrogateapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/interrupt", self.interruptapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/skip", self.skip, methods=["POST"])
@@ -224,6 +282,20 @@ class Api:
 
         raise HTTPException(status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"})
 
+    @contextmanager
+    def queued_job(self, id_task=None, client_id=None, priority=0):
+        try:
+            job = self.queue_lock.enter(id_task, client=client_id or "api", priority=priority)
+        except job_scheduler.QueueFullError as e:
+            raise HTTPException(status_code=429, detail=str(e)) from e
+        except job_scheduler.JobCancelledError as e:
+            raise HTTPException(status_code=409, detail=str(e)) from e
+
+        try:
+            yield job
+        finally:
+            self.queue_lock.leave(job)
+
     def get_selectable_script(self, script_name, script_runner):
         if script_name is None or script_name == "":
             return None, None
@@ -297,6 +369,17 @@ class Api:
         return script_args
 
     def text2imgapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+        response, _ = self.run_text2img(txt2imgreq)
+        return response
+
+    def run_text2img(self, txt2imgreq, image_ready=None):
+        """
+        runs a txt2img request and returns the response along with Processed for it; image_ready, if given, is called
+        with each generated image as soon as it's finished
+        """
+
+        validate_image_format(txt2imgreq.image_format)
+
         script_runner = scripts.scripts_txt2img
         if not script_runner.scripts:
             script_runner.initialize_scripts(False)
@@ -322,27 +405,69 @@ class Api:
 
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
+        id_task = args.pop('id_task', None)
+        client_id = args.pop('client_id', None)
+        priority = args.pop('priority', 0)
+        encode_args = (args.pop('image_format', None), args.pop('image_quality', None), args.pop('png_compress_level', None))
 
-        with self.queue_lock:
+        if selectable_scripts is None and not txt2imgreq.alwayson_scripts and opts.api_batch_coalescing_max_size > 0 and image_ready is None:
             p = StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)
             p.scripts = script_runner
             p.outpath_grids = opts.outdir_txt2img_grids
             p.outpath_samples = opts.outdir_txt2img_samples
+            p.script_args = tuple(script_args)
 
-            shared.state.begin()
-            if selectable_scripts is not None:
-                p.script_args = script_args
-                processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
-            else:
-                p.script_args = tuple(script_args) # Need to pass args as tuple here
-                processed = process_images(p)
-            shared.state.end()
+            def run(batch_p):
+                shared.state.begin()
+                try:
+                    return process_images(batch_p)
+                finally:
+                    shared.state.end()
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
+            try:
+                processed = batch_coalescer.coalescer.process(p, self.queue_lock, id_task, client_id or "api", priority, run)
+            except job_scheduler.QueueFullError as e:
+                raise HTTPException(status_code=429, detail=str(e)) from e
+            except job_scheduler.JobCancelledError as e:
+                raise HTTPException(status_code=409, detail=str(e)) from e
+        else:
+            with self.queued_job(id_task, client_id, priority):
+                p = StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)
+                p.scripts = script_runner
+                p.outpath_grids = opts.outdir_txt2img_grids
+                p.outpath_samples = opts.outdir_txt2img_samples
+                p.image_ready_callback = image_ready
+
+                shared.state.begin()
+                if selectable_scripts is not None:
+                    p.script_args = script_args
+                    processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
+                else:
+                    p.script_args = tuple(script_args) # Need to pass args as tuple here
+                    processed = process_images(p)
+                shared.state.end()
+
+        b64images = [encode_pil_to_base64(image, *encode_args) for image in processed.images] if send_images else []
+
+        response = models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
 
-        return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
+        if id_task is not None:
+            task_results.store.put(id_task, "finished", result=jsonable_encoder(response))
+
+        return response, processed
 
     def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
+        response, _ = self.run_img2img(img2imgreq)
+        return response
+
+    def run_img2img(self, img2imgreq, image_ready=None):
+        """
+        runs an img2img request and returns the response along with Processed for it; image_ready, if given, is called
+        with each generated image as soon as it's finished
+        """
+
+        validate_image_format(img2imgreq.image_format)
+
         init_images = img2imgreq.init_images
         if init_images is None:
             raise HTTPException(status_code=404, detail="Init image not found")
@@ -378,13 +503,18 @@ class Api:
 
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
+        id_task = args.pop('id_task', None)
+        client_id = args.pop('client_id', None)
+        priority = args.pop('priority', 0)
+        encode_args = (args.pop('image_format', None), args.pop('image_quality', None), args.pop('png_compress_level', None))
 
-        with self.queue_lock:
+        with self.queued_job(id_task, client_id, priority):
             p = StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)
             p.init_images = [decode_base64_to_image(x) for x in init_images]
             p.scripts = script_runner
             p.outpath_grids = opts.outdir_img2img_grids
             p.outpath_samples = opts.outdir_img2img_samples
+            p.image_ready_callback = image_ready
 
             shared.state.begin()
             if selectable_scripts is not None:
@@ -395,20 +525,172 @@ class Api:
                 processed = process_images(p)
             shared.state.end()
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
+        b64images = [encode_pil_to_base64(image, *encode_args) for image in processed.images] if send_images else []
 
         if not img2imgreq.include_init_images:
             img2imgreq.init_images = None
             img2imgreq.mask = None
 
-        return models.ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
+        response = models.ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
+
+        if id_task is not None:
+            task_results.store.put(id_task, "finished", result=jsonable_encoder(response))
+
+        return response, processed
+
+    def multipart_api(self, req, run, stream):
+        """
+        Runs run(req, image_ready) and returns a multipart/mixed response with generated images as binary parts, encoded
+        as requested by req, followed by an application/json part with the rest of the usual response.
+
+        Without stream, the response is sent when the job is done, with the same images as the JSON endpoint returns,
+        and errors are reported with an HTTP status as usual. With stream, each image is sent as soon as it's finished
+        and the grid is not included; scripts can't be used then, because the images a script generates on the way
+        are not its results.
+        """
+
+        image_format, media_type = validate_image_format(req.image_format)
+        if stream and req.script_name:
+            raise HTTPException(status_code=422, detail="Scripts can't be used with a streamed response")
+
+        encode_args = (image_format, req.image_quality, req.png_compress_level)
+        req.send_images = False
+        boundary = uuid.uuid4().hex
+
+        def image_part(image):
+            return multipart_part(boundary, media_type, encode_pil_to_bytes(image, *encode_args))
+
+        def json_part(data):
+            return multipart_part(boundary, "application/json", json.dumps(jsonable_encoder(data)).encode("utf8"))
+
+        closing = f"--{boundary}--\r\n".encode("utf8")
+        response_media_type = f"multipart/mixed; boundary={boundary}"
+
+        if not stream:
+            response, processed = run(req)
+
+            parts = [chunk for image in processed.images for chunk in image_part(image)] + json_part(response) + [closing]
+            return StreamingResponse(iter(parts), media_type=response_media_type)
+
+        items = queue.Queue()
+
+        def task():
+            try:
+                response, _ = run(req, items.put)
+                items.put(json_part(response))
+            except HTTPException as e:
+                items.put(json_part({"error": str(e.detail)}))
+            except Exception as e:
+                errors.report("Error running streamed API request", exc_info=True)
+                items.put(json_part({"error": str(e)}))
+            finally:
+                items.put(None)
+
+        threading.Thread(target=task, name="api multipart stream", daemon=True).start()
+
+        def generate():
+            while True:
+                item = items.get()
+                if item is None:
+                    break
+
+                # images are encoded here rather than in the callback so that generation doesn't wait for encoding
+                yield from image_part(item) if isinstance(item, Image.Image) else item
+
+            yield closing
+
+        return StreamingResponse(generate(), media_type=response_media_type)
+
+    def text2imgapi_multipart(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI, stream: bool = False):
+        return self.multipart_api(txt2imgreq, self.run_text2img, stream)
+
+    async def img2imgapi_multipart(self, request: Request, stream: bool = False):
+        """
+        Accepts either the usual JSON body, or multipart/form-data with the JSON request in the "request" field and
+        init images and mask as binary files in "init_images" and "mask" fields.
+        """
+
+        try:
+            if request.headers.get("content-type", "").startswith("multipart/form-data"):
+                form = await request.form()
+                img2imgreq = models.StableDiffusionImg2ImgProcessingAPI(**json.loads(form.get("request") or "{}"))
+
+                init_images = [await file.read() for file in form.getlist("init_images") if not isinstance(file, str)]
+                if init_images:
+                    img2imgreq.init_images = init_images
+                    img2imgreq.include_init_images = False  # uploaded files are not sent back as base64
+
+                mask = form.get("mask")
+                if mask is not None and not isinstance(mask, str):
+                    img2imgreq.mask = await mask.read()
+            else:
+                img2imgreq = models.StableDiffusionImg2ImgProcessingAPI(**(await request.json()))
+        except (ValidationError, json.JSONDecodeError) as e:
+            raise HTTPException(status_code=422, detail=str(e)) from e
+
+        return await run_in_threadpool(self.multipart_api, img2imgreq, self.run_img2img, stream)
+
+    def submit_task(self, req, run):
+        """starts run(req) in a background thread and returns the task id right away; the result goes to the task result store"""
+
+        if not task_results.store.enabled():
+            raise HTTPException(status_code=400, detail="Task results are not being kept; enable them in settings to submit tasks")
+
+        validate_image_format(req.image_format)
+
+        id_task = req.id_task or f"task({uuid.uuid4().hex})"
+        req.id_task = id_task
+
+        with self.submitted_tasks_lock:
+            if id_task in self.submitted_tasks:
+                raise HTTPException(status_code=409, detail=f"Task {id_task} is already submitted")
+
+            self.submitted_tasks.add(id_task)
+
+        def task():
+            try:
+                run(req)
+            except HTTPException as e:
+                task_results.store.put(id_task, "failed", error=str(e.detail))
+            except Exception as e:
+                errors.report(f"Error running task {id_task}", exc_info=True)
+                task_results.store.put(id_task, "failed", error=str(e))
+            finally:
+                with self.submitted_tasks_lock:
+                    self.submitted_tasks.discard(id_task)
+
+        threading.Thread(target=task, name=f"api task {id_task}", daemon=True).start()
+
+        return models.TaskSubmitResponse(id_task=id_task)
+
+    def text2imgapi_submit(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+        return self.submit_task(txt2imgreq, self.text2imgapi)
+
+    def img2imgapi_submit(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
+        return self.submit_task(img2imgreq, self.img2imgapi)
+
+    def get_task_result(self, id_task: str):
+        entry = task_results.store.get(id_task)
+        if entry is not None:
+            return entry
+
+        if self.queue_lock.is_running(id_task):
+            return models.TaskResultResponse(id_task=id_task, status="running")
+
+        with self.submitted_tasks_lock:
+            submitted = id_task in self.submitted_tasks
+
+        if submitted or self.queue_lock.is_queued(id_task):
+            return models.TaskResultResponse(id_task=id_task, status="queued")
+
+        raise HTTPException(status_code=404, detail=f"No result for task {id_task}")
 
     def extras_single_image_api(self, req: models.ExtrasSingleImageRequest):
         reqDict = setUpscalers(req)
 
         reqDict['image'] = decode_base64_to_image(reqDict['image'])
 
-        with self.queue_lock:
+        with self.queued_job():
             result = postprocessing.run_extras(extras_mode=0, image_folder="", input_dir="", output_dir="", save_output=False, **reqDict)
 
         return models.ExtrasSingleImageResponse(image=encode_pil_to_base64(result[0][0]), html_info=result[1])
@@ -419,7 +701,7 @@ class Api:
         image_list = reqDict.pop('imageList', [])
         image_folder = [decode_base64_to_image(x.data) for x in image_list]
 
-        with self.queue_lock:
+        with self.queued_job():
             result = postprocessing.run_extras(extras_mode=1, image_folder=image_folder, image="", input_dir="", output_dir="", save_output=False, **reqDict)
 
         return models.ExtrasBatchImagesResponse(images=list(map(encode_pil_to_base64, result[0])), html_info=result[1])
@@ -468,6 +750,15 @@ class Api:
 
         return models.ProgressResponse(progress=progress, eta_relative=eta_relative, state=shared.state.dict(), current_image=current_image, textinfo=shared.state.textinfo)
 
+    def get_queue(self):
+        return {**self.queue_lock.dict(), "image_save_backlog": images.save_queue.backlog()}
+
+    def cancel_queued(self, req: models.QueueCancelRequest):
+        if not self.queue_lock.cancel(req.id_task):
+            raise HTTPException(status_code=404, detail=f"Task {req.id_task} is not waiting in queue")
+
+        return {}
+
     def interrogateapi(self, interrogatereq: models.InterrogateRequest):
         image_b64 = interrogatereq.image
         if image_b64 is None:
@@ -477,7 +768,7 @@ class Api:
         img = img.convert('RGB')
 
         # Override object param
-        with self.queue_lock:
+        with self.queued_job():
             if interrogatereq.model == "clip":
                 processed = shared.interrogator.interrogate(img)
             elif interrogatereq.model == "deepdanbooru":
@@ -550,7 +841,7 @@ class Api:
         ]
 
     def get_sd_models(self):
-        return [{"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x)} for x in checkpoints_list.values()]
+        return [{"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x)} for x in checkpoint_infos()]
 
     def get_sd_vaes(self):
         return [{"model_name": x, "filename": vae_dict[x]} for x in vae_dict.keys()]
@@ -593,7 +884,7 @@ class Api:
         }
 
     def refresh_checkpoints(self):
-        with self.queue_lock:
+        with self.queued_job():
             shared.refresh_checkpoints()
 
     def create_embedding(self, args: dict):
@@ -711,7 +1002,7 @@ class Api:
                 cuda = {'error': 'unavailable'}
         except Exception as err:
             cuda = {'error': f'{err}'}
-        return models.MemoryResponse(ram=ram, cuda=cuda)
+        return models.MemoryResponse(ram=ram, cuda=cuda, cond_cache=cond_cache.cache.stats(), init_latent_cache=init_latent_cache.cache.stats())
 
     def launch(self, server_name, port):
         self.app.include_router(self.router)
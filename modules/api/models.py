@@ -107,6 +107,12 @@ StableDiffusionTxt2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "send_images", "type": bool, "default": True},
         {"key": "save_images", "type": bool, "default": False},
         {"key": "alwayson_scripts", "type": dict, "default": {}},
+        {"key": "id_task", "type": str, "default": None},
+        {"key": "client_id", "type": str, "default": None},
+        {"key": "priority", "type": int, "default": 0},
+        {"key": "image_format", "type": str, "default": None},
+        {"key": "image_quality", "type": int, "default": None},
+        {"key": "png_compress_level", "type": int, "default": None},
     ]
 ).generate_model()
 
@@ -124,6 +130,12 @@ StableDiffusionImg2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "send_images", "type": bool, "default": True},
         {"key": "save_images", "type": bool, "default": False},
         {"key": "alwayson_scripts", "type": dict, "default": {}},
+        {"key": "id_task", "type": str, "default": None},
+        {"key": "client_id", "type": str, "default": None},
+        {"key": "priority", "type": int, "default": 0},
+        {"key": "image_format", "type": str, "default": None},
+        {"key": "image_quality", "type": int, "default": None},
+        {"key": "png_compress_level", "type": int, "default": None},
     ]
 ).generate_model()
 
@@ -293,6 +305,8 @@ class EmbeddingsResponse(BaseModel):
 class MemoryResponse(BaseModel):
     ram: dict = Field(title="RAM", description="System memory stats")
     cuda: dict = Field(title="CUDA", description="nVidia CUDA memory stats")
+    cond_cache: dict = Field(default=None, title="Conditioning cache", description="Size and hit/miss stats of the encoded prompt cache")
+    init_latent_cache: dict = Field(default=None, title="Init latent cache", description="Size and hit/miss stats of the VAE-encoded init image cache")
 
 
 class ScriptsList(BaseModel):
@@ -314,3 +328,38 @@ class ScriptInfo(BaseModel):
     is_alwayson: bool = Field(default=None, title="IsAlwayson", description="Flag specifying whether this script is an alwayson script")
     is_img2img: bool = Field(default=None, title="IsImg2img", description="Flag specifying whether this script is an img2img script")
     args: List[ScriptArg] = Field(title="Arguments", description="List of script's arguments")
+
+
+class QueueJobItem(BaseModel):
+    id_task: str = Field(title="Task ID")
+    client: str = Field(title="Client", description="Client the job was submitted by; jobs of different clients take turns")
+    priority: int = Field(title="Priority", description="Jobs with higher priority run first")
+    state: str = Field(title="State", description="One of: queued, running, finished, cancelled")
+    time_queued: float = Field(title="Time queued")
+    time_started: Optional[float] = Field(title="Time started")
+    time_finished: Optional[float] = Field(title="Time finished")
+
+class QueueStatusResponse(BaseModel):
+    queue_size: int = Field(title="Queue size", description="Number of jobs waiting in queue")
+    running: Optional[QueueJobItem] = Field(title="Running job")
+    queued: List[QueueJobItem] = Field(title="Queued jobs", description="Jobs waiting in queue, in the order they will run")
+    clients: Dict[str, int] = Field(title="Clients", description="Number of queued jobs for each client")
+    average_duration: Optional[float] = Field(title="Average duration", description="Average duration of recent jobs in seconds")
+    eta_empty: Optional[float] = Field(title="ETA until empty", description="Estimated number of seconds until all queued jobs are done")
+    total_finished: int = Field(title="Finished jobs")
+    total_cancelled: int = Field(title="Cancelled jobs")
+    total_rejected: int = Field(title="Rejected jobs", description="Jobs not admitted into queue because of queue size limits")
+    image_save_backlog: int = Field(default=0, title="Image save backlog", description="Number of generated images waiting to be saved in background")
+
+class QueueCancelRequest(BaseModel):
+    id_task: str = Field(title="Task ID", description="id of the queued task to cancel")
+
+class TaskSubmitResponse(BaseModel):
+    id_task: str = Field(title="Task ID", description="Use with /sdapi/v1/task-result to get the result when the task is done")
+
+class TaskResultResponse(BaseModel):
+    id_task: str = Field(title="Task ID")
+    status: str = Field(title="Status", description="One of: queued, running, finished, failed")
+    time_finished: Optional[float] = Field(default=None, title="Time finished")
+    result: Optional[dict] = Field(default=None, title="Result", description="Response of the generation request, same as would be returned by a blocking call")
+    error: Optional[str] = Field(default=None, title="Error", description="Reason the task failed")
@@ -0,0 +1,264 @@
+import copy
+import inspect
+import json
+import threading
+
+from modules import shared, processing, extra_networks, job_scheduler
+from modules.processing import StableDiffusionProcessingTxt2Img
+
+# attributes of StableDiffusionProcessingTxt2Img that can differ between jobs merged into one batch
+per_sample_fields = {"prompt", "negative_prompt", "seed", "subseed", "batch_size", "hr_prompt", "hr_negative_prompt"}
+
+
+def init_parameter_names(cls):
+    names = set()
+    for class_ in inspect.getmro(cls):
+        if class_ is not object:
+            names.update(inspect.signature(class_.__init__).parameters)
+
+    return names - {"self", "kwargs", "sd_model", "sampler_index"}
+
+
+def compatibility_key(p: StableDiffusionProcessingTxt2Img, client=None, priority=0):
+    """
+    Returns a key that is equal for two txt2img jobs if they can be generated as one batch, or None if the job
+    can't be merged with anything. Only jobs from the same client with the same priority are merged, so that merging
+    doesn't let a job skip ahead of the order the job scheduler would run it in.
+    """
+
+    if p.n_iter != 1 or not p.do_not_save_grid or type(p.prompt) == list or type(p.negative_prompt) == list or type(p.seed) == list or type(p.subseed) == list:
+        return None
+
+    fields = {k: getattr(p, k, None) for k in init_parameter_names(type(p)) - per_sample_fields - {"script_args"}}
+
+    prompts = [p.prompt, p.hr_prompt or p.prompt]
+    networks = []
+    for prompt in prompts:
+        _, extra_network_data = extra_networks.parse_prompt(shared.prompt_styles.apply_styles_to_prompt(prompt, p.styles))
+        networks.append(sorted((name, [params.items for params in params_list]) for name, params_list in extra_network_data.items()))
+
+    try:
+        return json.dumps([fields, networks, id(p.scripts), p.script_args, client, priority], sort_keys=True, default=str)
+    except TypeError:
+        return None
+
+
+class BatchGroup:
+    def __init__(self, key, leader):
+        self.key = key
+        self.leader = leader
+        self.jobs = []
+        self.attached = []
+        self.batch_size = 0
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+    def add(self, p, job=None):
+        """adds job p to the group; job is the scheduler's job for p, for all jobs except the leader"""
+
+        self.jobs.append(p)
+        self.batch_size += p.batch_size
+
+        if job is not None:
+            self.attached.append((p, job))
+
+    def retain(self, started):
+        """removes attached jobs that are not in started (because they were cancelled) from the group"""
+
+        for p, job in self.attached:
+            if job not in started:
+                self.jobs.remove(p)
+                self.batch_size -= p.batch_size
+
+        self.attached = [(p, job) for p, job in self.attached if job in started]
+
+    def create_batch_processing(self):
+        """creates a single processing object that generates images for all jobs in the group"""
+
+        first = self.jobs[0]
+
+        p = copy.copy(first)
+        p.extra_generation_params = dict(first.extra_generation_params)
+        p.override_settings = dict(first.override_settings)
+        p.prompt = []
+        p.negative_prompt = []
+        p.hr_prompt = []
+        p.hr_negative_prompt = []
+        p.seed = []
+        p.subseed = []
+        p.batch_size = self.batch_size
+
+        for job in self.jobs:
+            seed = int(processing.get_fixed_seed(job.seed))
+            subseed = int(processing.get_fixed_seed(job.subseed))
+
+            p.prompt += [job.prompt] * job.batch_size
+            p.negative_prompt += [job.negative_prompt] * job.batch_size
+            p.hr_prompt += [job.hr_prompt or job.prompt] * job.batch_size
+            p.hr_negative_prompt += [job.hr_negative_prompt or job.negative_prompt] * job.batch_size
+            p.seed += [seed + (x if job.subseed_strength == 0 else 0) for x in range(job.batch_size)]
+            p.subseed += [subseed + x for x in range(job.batch_size)]
+
+        return p
+
+    def job_generation_params(self, job, batch_p):
+        """extra_generation_params of batch_p as they would be if job was generated on its own"""
+
+        params = dict(batch_p.extra_generation_params)
+        params.pop("Hires prompt", None)
+        params.pop("Hires negative prompt", None)
+
+        if job.enable_hr:
+            if (job.hr_prompt or job.prompt) != job.prompt:
+                params["Hires prompt"] = job.hr_prompt
+
+            if (job.hr_negative_prompt or job.negative_prompt) != job.negative_prompt:
+                params["Hires negative prompt"] = job.hr_negative_prompt
+
+        return params
+
+    def split_results(self, processed, batch_p):
+        """
+        splits Processed for batch_p, created by create_batch_processing, into one for every job; infotexts are made
+        again for each job, so that they only describe that job's own images and prompts
+        """
+
+        if len(processed.images) != self.batch_size:
+            raise RuntimeError(f"batched generation returned {len(processed.images)} images for {self.batch_size} requested")
+
+        results = []
+        start = 0
+        for job in self.jobs:
+            end = start + job.batch_size
+
+            res = copy.copy(processed)
+            res.images = processed.images[start:end]
+            res.all_prompts = processed.all_prompts[start:end]
+            res.all_negative_prompts = processed.all_negative_prompts[start:end]
+            res.all_seeds = processed.all_seeds[start:end]
+            res.all_subseeds = processed.all_subseeds[start:end]
+            res.extra_generation_params = self.job_generation_params(job, batch_p)
+
+            job_p = copy.copy(batch_p)
+            job_p.batch_size = job.batch_size
+            job_p.prompt = job.prompt
+            job_p.negative_prompt = job.negative_prompt
+            job_p.all_prompts = res.all_prompts
+            job_p.all_negative_prompts = res.all_negative_prompts
+            job_p.extra_generation_params = res.extra_generation_params
+
+            res.infotexts = [processing.create_infotext(job_p, res.all_prompts, res.all_seeds, res.all_subseeds, position_in_batch=i) for i in range(job.batch_size)]
+            res.prompt = res.all_prompts[0]
+            res.negative_prompt = res.all_negative_prompts[0]
+            res.seed = res.all_seeds[0]
+            res.subseed = res.all_subseeds[0]
+            res.info = res.infotexts[0]
+            res.batch_size = job.batch_size
+            res.index_of_first_image = 0
+
+            results.append(res)
+            start = end
+
+        return results
+
+    def result(self, p):
+        self.done.wait()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.results[self.jobs.index(p)]
+
+
+class BatchCoalescer:
+    """
+    Merges compatible txt2img jobs into a single batch.
+
+    The first job with a given set of generation parameters becomes the leader of a group and waits in queue; jobs
+    with the same parameters that arrive while it waits join the group instead of queueing themselves. When the
+    leader's turn comes, the whole group is generated as one batch and the results are split back between jobs.
+
+    Jobs that join a group are attached to the leader's job in the job scheduler: they are reported as queued and can
+    be cancelled until the leader's turn comes, and are then running and finished together with it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open_groups = {}
+
+    def max_batch_size(self):
+        return shared.opts.api_batch_coalescing_max_size
+
+    def join(self, p, scheduler, id_task, client, priority):
+        """
+        returns the group that will generate the job and the scheduler's job attached to the group's leader; the
+        job is None if the caller leads the group and is responsible for running it
+        """
+
+        key = compatibility_key(p, client, priority)
+
+        with self.lock:
+            group = self.open_groups.get(key) if key is not None else None
+            if group is not None and group.batch_size + p.batch_size <= self.max_batch_size():
+                job = scheduler.attach(id_task, client=client, priority=priority, leader=group.leader)
+                group.add(p, job)
+                return group, job
+
+            group = BatchGroup(key, id_task)
+            group.add(p)
+            if key is not None:
+                self.open_groups[key] = group
+
+            return group, None
+
+    def close(self, group):
+        with self.lock:
+            if self.open_groups.get(group.key) is group:
+                del self.open_groups[group.key]
+
+    def process(self, p, scheduler, id_task, client, priority, run):
+        """
+        Generates images for txt2img job p, possibly together with other jobs.
+
+        The job is queued in scheduler with given id_task, client and priority; run is a function that takes a
+        processing object and returns Processed for it. Raises job_scheduler.QueueFullError and
+        job_scheduler.JobCancelledError like the scheduler does.
+        """
+
+        group, job = self.join(p, scheduler, id_task, client, priority)
+        if job is not None:
+            job.turn.wait()
+
+            if job.state == "cancelled":
+                raise job_scheduler.JobCancelledError(f"Task {job.id_task} was cancelled while waiting in queue")
+
+            if job.state == "detached":
+                # the leader never got to run the group, so this job has to get its own turn
+                return self.process(p, scheduler, id_task, client, priority, run)
+
+            return group.result(p)
+
+        try:
+            with scheduler.job(id_task, client=client, priority=priority):
+                self.close(group)
+                group.retain(scheduler.start_attached([job for _, job in group.attached]))
+
+                if len(group.jobs) == 1:
+                    group.results = [run(p)]
+                else:
+                    print(f"Generating {len(group.jobs)} txt2img requests as a single batch of {group.batch_size} images")
+                    batch_p = group.create_batch_processing()
+                    group.results = group.split_results(run(batch_p), batch_p)
+        except Exception as e:
+            group.error = e
+            raise
+        finally:
+            self.close(group)
+            scheduler.detach([job for _, job in group.attached])
+            group.done.set()
+
+        return group.result(p)
+
+
+coalescer = BatchCoalescer()
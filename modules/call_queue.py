@@ -1,10 +1,10 @@
 import html
-import threading
 import time
 
-from modules import shared, progress, errors
+from modules import shared, progress, errors, job_scheduler
 
-queue_lock = threading.Lock()
+# kept under its old name: extensions use it as a lock
+queue_lock = job_scheduler.scheduler
 
 
 def wrap_queued_call(func):
@@ -23,19 +23,14 @@ def wrap_gradio_gpu_call(func, extra_outputs=None):
         # if the first argument is a string that says "task(...)", it is treated as a job id
         if args and type(args[0]) == str and args[0].startswith("task(") and args[0].endswith(")"):
             id_task = args[0]
-            progress.add_task_to_queue(id_task)
         else:
             id_task = None
 
-        with queue_lock:
+        with queue_lock.job(id_task, client="ui"):
             shared.state.begin()
-            progress.start_task(id_task)
 
-            try:
-                res = func(*args, **kwargs)
-                progress.record_results(id_task, res)
-            finally:
-                progress.finish_task(id_task)
+            res = func(*args, **kwargs)
+            progress.record_results(id_task, res)
 
             shared.state.end()
 
@@ -0,0 +1,95 @@
+import collections
+import threading
+
+from modules import shared, extra_networks
+
+
+class ConditioningCache:
+    """
+    Process-wide LRU cache of text encoder outputs, limited by the total size of cached tensors.
+
+    An entry holds conds for all texts of a single prompt's schedule, because the text encoder pads texts encoded
+    together to the same length. Entries are keyed by those texts and by everything else that affects the result:
+    the model and its checkpoint, CLIP skip, emphasis settings and the extra networks last activated. The cache is
+    cleared when a new model is created or textual inversion embeddings are reloaded.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def max_size(self):
+        return shared.opts.cond_cache_size * 1024 * 1024
+
+    def context_key(self, model):
+        checkpoint_info = getattr(model, "sd_checkpoint_info", None)
+
+        return (
+            id(model),
+            getattr(checkpoint_info, "filename", None),
+            shared.opts.CLIP_stop_at_last_layers,
+            shared.opts.enable_emphasis,
+            shared.opts.use_old_emphasis_implementation,
+            shared.opts.comma_padding_backtrack,
+            extra_networks.active_networks_key,
+        )
+
+    def get_learned_conditioning(self, model, texts):
+        """returns model.get_learned_conditioning(texts), using the cache if possible"""
+
+        if self.max_size() <= 0:
+            return model.get_learned_conditioning(texts)
+
+        key = (self.context_key(model), tuple(texts))
+
+        with self.lock:
+            conds = self.entries.get(key)
+            if conds is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return conds
+
+            self.misses += 1
+
+        conds = model.get_learned_conditioning(texts)
+        self.put(key, conds)
+
+        return conds
+
+    def put(self, key, conds):
+        size = conds.nbytes
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            self.entries[key] = conds
+            self.sizes[key] = size
+            self.size += size
+
+            while self.entries and self.size > self.max_size():
+                old_key, _ = self.entries.popitem(last=False)
+                self.size -= self.sizes.pop(old_key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size(),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+cache = ConditioningCache()
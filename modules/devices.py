@@ -93,21 +93,31 @@ def cond_cast_float(input):
     return input.float() if unet_needs_upcast else input
 
 
-def randn(seed, shape):
+def randn_device():
+    """device that seeded noise is generated on before it's moved to device"""
+
     from modules.shared import opts
 
-    torch.manual_seed(seed)
     if opts.randn_source == "CPU" or device.type == 'mps':
-        return torch.randn(shape, device=cpu).to(device)
-    return torch.randn(shape, device=device)
+        return cpu
+    return device
 
 
-def randn_without_seed(shape):
-    from modules.shared import opts
+def default_generator(dev):
+    """global torch RNG used by torch.randn for tensors on dev"""
 
-    if opts.randn_source == "CPU" or device.type == 'mps':
-        return torch.randn(shape, device=cpu).to(device)
-    return torch.randn(shape, device=device)
+    if dev.type == 'cuda':
+        return torch.cuda.default_generators[dev.index if dev.index is not None else torch.cuda.current_device()]
+    return torch.default_generator
+
+
+def randn(seed, shape):
+    torch.manual_seed(seed)
+    return torch.randn(shape, device=randn_device()).to(device)
+
+
+def randn_without_seed(shape):
+    return torch.randn(shape, device=randn_device()).to(device)
 
 
 def autocast(disable=False):
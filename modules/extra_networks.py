@@ -5,6 +5,9 @@ from modules import errors
 
 extra_network_registry = {}
 
+# identifies extra networks and their arguments from the last call to activate(); see network_data_key()
+active_networks_key = ()
+
 
 def initialize():
     extra_network_registry.clear()
@@ -78,10 +81,19 @@ class ExtraNetwork:
         raise NotImplementedError
 
 
+def network_data_key(extra_network_data):
+    """returns a hashable value that is equal for equal extra_network_data"""
+
+    return tuple(sorted((name, tuple(tuple(params.items) for params in params_list)) for name, params_list in extra_network_data.items()))
+
+
 def activate(p, extra_network_data):
     """call activate for extra networks in extra_network_data in specified order, then call
     activate for all remaining registered networks with an empty argument list"""
 
+    global active_networks_key
+    active_networks_key = network_data_key(extra_network_data)
+
     for extra_network_name, extra_network_args in extra_network_data.items():
         extra_network = extra_network_registry.get(extra_network_name, None)
         if extra_network is None:
@@ -120,17 +120,16 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
     if not primary_model_name:
         return fail("Failed: Merging requires a primary model.")
 
-    primary_model_info = sd_models.checkpoints_list[primary_model_name]
-
     if theta_func2 and not secondary_model_name:
         return fail("Failed: Merging requires a secondary model.")
 
-    secondary_model_info = sd_models.checkpoints_list[secondary_model_name] if theta_func2 else None
-
     if theta_func1 and not tertiary_model_name:
         return fail(f"Failed: Interpolation method ({interp_method}) requires a tertiary model.")
 
-    tertiary_model_info = sd_models.checkpoints_list[tertiary_model_name] if theta_func1 else None
+    with sd_models.checkpoints_lock:
+        primary_model_info = sd_models.checkpoints_list[primary_model_name]
+        secondary_model_info = sd_models.checkpoints_list[secondary_model_name] if theta_func2 else None
+        tertiary_model_info = sd_models.checkpoints_list[tertiary_model_name] if theta_func1 else None
 
     result_is_inpainting_model = False
     result_is_instruct_pix2pix_model = False
@@ -291,7 +290,7 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         torch.save(theta_0, output_modelname)
 
     sd_models.list_models()
-    created_model = next((ckpt for ckpt in sd_models.checkpoints_list.values() if ckpt.name == filename), None)
+    created_model = next((ckpt for ckpt in sd_models.checkpoint_infos() if ckpt.name == filename), None)
     if created_model:
         created_model.calculate_shorthash()
 
@@ -1,58 +1,115 @@
 import hashlib
 import json
 import os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import filelock
 
-from modules import shared
+from modules import shared, errors
 from modules.paths import data_path
 
 
 cache_filename = os.path.join(data_path, "cache.json")
+cache_log_filename = os.path.join(data_path, "cache.log")
 cache_data = None
+cache_lock = threading.RLock()
+
+hash_block_size = 16 * 1024 * 1024
 
 
 def dump_cache():
-    with filelock.FileLock(f"{cache_filename}.lock"):
+    with cache_lock, filelock.FileLock(f"{cache_filename}.lock"):
+        load_cache_log()  # entries added by other processes since the cache was loaded
+
         with open(cache_filename, "w", encoding="utf8") as file:
             json.dump(cache_data, file, indent=4)
 
+        if os.path.exists(cache_log_filename):
+            os.remove(cache_log_filename)
+
+
+def load_cache_log():
+    """applies entries from the append-only log to cache_data"""
+
+    if not os.path.isfile(cache_log_filename):
+        return
+
+    with open(cache_log_filename, "r", encoding="utf8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash while writing
+
+            cache_data.setdefault(entry["subsection"], {})[entry["key"]] = entry["value"]
+
 
 def cache(subsection):
     global cache_data
 
-    if cache_data is None:
-        with filelock.FileLock(f"{cache_filename}.lock"):
-            if not os.path.isfile(cache_filename):
-                cache_data = {}
-            else:
-                with open(cache_filename, "r", encoding="utf8") as file:
-                    cache_data = json.load(file)
+    with cache_lock:
+        if cache_data is None:
+            with filelock.FileLock(f"{cache_filename}.lock"):
+                if not os.path.isfile(cache_filename):
+                    cache_data = {}
+                else:
+                    with open(cache_filename, "r", encoding="utf8") as file:
+                        cache_data = json.load(file)
+
+            if os.path.isfile(cache_log_filename):
+                dump_cache()
 
-    s = cache_data.get(subsection, {})
-    cache_data[subsection] = s
+        s = cache_data.get(subsection, {})
+        cache_data[subsection] = s
 
     return s
 
 
+def cache_set(subsection, key, value):
+    """
+    Stores a single cache entry. Instead of rewriting the whole cache.json, the entry is appended to a log next to it;
+    the log is merged into cache.json next time the cache is loaded or dumped.
+    """
+
+    entries = cache(subsection)
+
+    with cache_lock, filelock.FileLock(f"{cache_filename}.lock"):
+        entries[key] = value
+
+        with open(cache_log_filename, "a", encoding="utf8") as file:
+            file.write(json.dumps({"subsection": subsection, "key": key, "value": value}) + "\n")
+
+
+def hash_file(file, hash_object):
+    buffer = bytearray(hash_block_size)
+    view = memoryview(buffer)
+
+    while True:
+        n = file.readinto(buffer)
+        if not n:
+            break
+
+        hash_object.update(view[:n])
+
+
 def calculate_sha256(filename):
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
 
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+    with open(filename, "rb", buffering=0) as f:
+        hash_file(f, hash_sha256)
 
     return hash_sha256.hexdigest()
 
 
 def sha256_from_cache(filename, title, use_addnet_hash=False):
     hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
-    ondisk_mtime = os.path.getmtime(filename)
 
     if title not in hashes:
         return None
 
+    ondisk_mtime = os.path.getmtime(filename)
+
     cached_sha256 = hashes[title].get("sha256", None)
     cached_mtime = hashes[title].get("mtime", 0)
 
@@ -62,8 +119,107 @@ def sha256_from_cache(filename, title, use_addnet_hash=False):
     return cached_sha256
 
 
+def calculate_and_store_sha256(filename, title, use_addnet_hash=False, background=False):
+    if not background:
+        print(f"Calculating sha256 for {filename}: ", end='')
+
+    if use_addnet_hash:
+        with open(filename, "rb", buffering=0) as file:
+            sha256_value = addnet_hash_safetensors(file)
+    else:
+        sha256_value = calculate_sha256(filename)
+
+    if background:
+        print(f"Calculated sha256 for {filename}: {sha256_value}")
+    else:
+        print(f"{sha256_value}")
+
+    cache_set("hashes-addnet" if use_addnet_hash else "hashes", title, {
+        "mtime": os.path.getmtime(filename),
+        "sha256": sha256_value,
+    })
+
+    return sha256_value
+
+
+class HashingService:
+    """
+    Calculates hashes in background threads, so that callers that can do without a hash for a while don't have to
+    wait for it. Each file is only hashed once even if it's requested again while its hash is pending.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.jobs = {}
+
+    def submit(self, filename, title, use_addnet_hash=False):
+        """returns a future for the hash of the file, starting the calculation if it isn't already in progress"""
+
+        key = (title, use_addnet_hash)
+
+        with self.lock:
+            future = self.jobs.get(key)
+            if future is not None:
+                return future
+
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=max(1, int(shared.opts.hash_threads)), thread_name_prefix="hashing")
+
+            future = self.executor.submit(self.run, key, filename, title, use_addnet_hash)
+            self.jobs[key] = future
+
+        return future
+
+    def run(self, key, filename, title, use_addnet_hash):
+        try:
+            return calculate_and_store_sha256(filename, title, use_addnet_hash, background=True)
+        except Exception:
+            errors.report(f"Error calculating hash for {filename}", exc_info=True)
+            raise
+        finally:
+            with self.lock:
+                self.jobs.pop(key, None)
+
+    def pending_job(self, title, use_addnet_hash=False):
+        with self.lock:
+            return self.jobs.get((title, use_addnet_hash))
+
+    def pending(self):
+        """titles of files whose hashes are being calculated"""
+
+        with self.lock:
+            return [title for title, _ in self.jobs]
+
+
+hashing = HashingService()
+
+
 def sha256(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+    sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
+    if sha256_value is not None:
+        return sha256_value
+
+    if shared.cmd_opts.no_hashing:
+        return None
+
+    future = hashing.pending_job(title, use_addnet_hash)
+    if future is not None:
+        return future.result()
+
+    return calculate_and_store_sha256(filename, title, use_addnet_hash)
+
+
+def sha256_in_background(filename, title, use_addnet_hash=False, callback=None):
+    """
+    Returns the hash of the file if it's known. Otherwise returns None and starts calculating the hash in a
+    background thread; callback, if given, is called with the hash from that thread when it's ready.
+
+    Behaves like sha256() if background hashing is disabled in settings.
+    """
+
+    if not shared.opts.hash_in_background:
+        return sha256(filename, title, use_addnet_hash)
 
     sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
     if sha256_value is not None:
@@ -72,28 +228,21 @@ def sha256(filename, title, use_addnet_hash=False):
     if shared.cmd_opts.no_hashing:
         return None
 
-    print(f"Calculating sha256 for {filename}: ", end='')
-    if use_addnet_hash:
-        with open(filename, "rb") as file:
-            sha256_value = addnet_hash_safetensors(file)
-    else:
-        sha256_value = calculate_sha256(filename)
-    print(f"{sha256_value}")
+    future = hashing.submit(filename, title, use_addnet_hash)
 
-    hashes[title] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value,
-    }
+    if callback is not None:
+        def done(f):
+            if f.exception() is None:
+                callback(f.result())
 
-    dump_cache()
+        future.add_done_callback(done)
 
-    return sha256_value
+    return None
 
 
 def addnet_hash_safetensors(b):
     """kohya-ss hash for safetensors from https://github.com/kohya-ss/sd-scripts/blob/main/library/train_util.py"""
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
 
     b.seek(0)
     header = b.read(8)
@@ -101,8 +250,6 @@ def addnet_hash_safetensors(b):
 
     offset = n + 8
     b.seek(offset)
-    for chunk in iter(lambda: b.read(blksize), b""):
-        hash_sha256.update(chunk)
+    hash_file(b, hash_sha256)
 
     return hash_sha256.hexdigest()
-
@@ -1,3 +1,4 @@
+import copy
 import datetime
 
 import pytz
@@ -5,8 +6,11 @@ import io
 import math
 import os
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import re
+import threading
 
+import filelock
 import numpy as np
 import piexif
 import piexif.helper
@@ -261,13 +265,7 @@ def resize_image(resize_mode, im, width, height, upscaler_name=None):
         scale = max(w / im.width, h / im.height)
 
         if scale > 1.0:
-            upscalers = [x for x in shared.sd_upscalers if x.name == upscaler_name]
-            if len(upscalers) == 0:
-                upscaler = shared.sd_upscalers[0]
-                print(f"could not find upscaler named {upscaler_name or '<empty string>'}, using {upscaler.name} as a fallback")
-            else:
-                upscaler = upscalers[0]
-
+            upscaler = find_upscaler(upscaler_name)
             im = upscaler.scaler.upscale(im, scale, upscaler.data_path)
 
         if im.width != w or im.height != h:
@@ -312,6 +310,43 @@ def resize_image(resize_mode, im, width, height, upscaler_name=None):
     return res
 
 
+def find_upscaler(upscaler_name):
+    upscalers = [x for x in shared.sd_upscalers if x.name == upscaler_name]
+    if len(upscalers) == 0:
+        upscaler = shared.sd_upscalers[0]
+        print(f"could not find upscaler named {upscaler_name or '<empty string>'}, using {upscaler.name} as a fallback")
+    else:
+        upscaler = upscalers[0]
+
+    return upscaler
+
+
+def upscale_tensor(tensor, width, height, upscaler_name):
+    """
+    Same as resize_image(0, ...) with an upscaler, for a batch of RGB images in a (B, 3, H, W) tensor with values in
+    0..1 range; the result stays on the device. Returns None if the upscaler only works with PIL images, in which
+    case resize_image should be used instead.
+    """
+
+    from modules.upscaler import resize_tensor
+
+    if upscaler_name is None or upscaler_name == "None":
+        return None
+
+    scale = max(width / tensor.shape[3], height / tensor.shape[2])
+
+    if scale > 1.0:
+        upscaler = find_upscaler(upscaler_name)
+        tensor = upscaler.scaler.upscale_tensor(tensor, scale, upscaler.data_path)
+        if tensor is None:
+            return None
+
+    if tensor.shape[3] != width or tensor.shape[2] != height:
+        tensor = resize_tensor(tensor, width, height)
+
+    return tensor
+
+
 invalid_filename_chars = '<>:"/\\|?*\n'
 invalid_filename_prefix = ' '
 invalid_filename_postfix = ' .'
@@ -497,6 +532,60 @@ def get_next_sequence_number(path, basename):
     return result + 1
 
 
+def sequence_counter_filename(path, basename):
+    return os.path.join(path, f".sequence-{basename}" if basename else ".sequence")
+
+
+def read_sequence_counter(counter_filename):
+    try:
+        with open(counter_filename, "r", encoding="utf8") as file:
+            return int(file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def write_sequence_counter(counter_filename, value):
+    temp_filename = f"{counter_filename}.tmp"
+    with open(temp_filename, "w", encoding="utf8") as file:
+        file.write(str(value))
+
+    os.replace(temp_filename, counter_filename)
+
+
+def allocate_numbered_filename(path, basename, make_filename):
+    """
+    Returns a filename for the next number in sequence for images with given basename in the directory, using
+    make_filename(number) to make filenames.
+
+    The next number is kept in a counter file in the directory, protected by a file lock, so that processes sharing
+    the directory do not have to list it on every save and do not get same numbers. The directory is only
+    listed when the counter file is missing or unreadable, or when it turns out to be stale because the filename for
+    the number it gives is already taken.
+    """
+
+    counter_filename = sequence_counter_filename(path, basename)
+
+    with filelock.FileLock(f"{counter_filename}.lock"):
+        number = read_sequence_counter(counter_filename)
+        if number is None:
+            number = get_next_sequence_number(path, basename)
+
+        filename = make_filename(number)
+        if os.path.exists(filename) or filename in reserved_filenames:
+            number = max(number, get_next_sequence_number(path, basename))
+
+            for i in range(500):
+                filename = make_filename(number + i)
+                if not os.path.exists(filename) and filename not in reserved_filenames:
+                    break
+
+            number += i
+
+        write_sequence_counter(counter_filename, number + 1)
+
+    return filename
+
+
 def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_pnginfo=None):
     if extension is None:
         extension = os.path.splitext(filename)[1]
@@ -593,18 +682,26 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
         file_decoration = namegen.apply(file_decoration) + suffix
 
         if add_number:
-            basecount = get_next_sequence_number(path, basename)
-            fullfn = None
-            for i in range(500):
-                fn = f"{basecount + i:05}" if basename == '' else f"{basename}-{basecount + i:04}"
-                fullfn = os.path.join(path, f"{fn}{file_decoration}.{extension}")
-                if not os.path.exists(fullfn):
-                    break
+            def make_filename(number):
+                fn = f"{number:05}" if basename == '' else f"{basename}-{number:04}"
+                return os.path.join(path, f"{fn}{file_decoration}.{extension}")
+
+            with reserved_filenames_lock:
+                fullfn = allocate_numbered_filename(path, basename, make_filename)
+                reserved_filenames.add(fullfn)
         else:
             fullfn = os.path.join(path, f"{file_decoration}.{extension}")
     else:
         fullfn = os.path.join(path, f"{forced_filename}.{extension}")
 
+    try:
+        return save_image_to_filename(image, path, fullfn, info, pnginfo_section_name, p, existing_info)
+    finally:
+        with reserved_filenames_lock:
+            reserved_filenames.discard(fullfn)
+
+
+def save_image_to_filename(image, path, fullfn, info, pnginfo_section_name, p, existing_info):
     pnginfo = existing_info or {}
     if info is not None:
         pnginfo[pnginfo_section_name] = info
@@ -662,6 +759,78 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
     return fullfn, txt_fullfn
 
 
+class SaveQueue:
+    """
+    Saves images in background threads, so that generation does not wait for image encoding and disk writes.
+    Number of threads and the maximum number of images waiting to be saved are set in settings.
+    """
+
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.executor = None
+        self.threads = 0
+        self.futures = set()
+
+    def submit(self, func, *args, **kwargs):
+        threads = opts.save_images_threads
+        if threads <= 0:
+            self.wait()
+            func(*args, **kwargs)
+            return
+
+        limit = max(opts.save_images_queue_size, 1)
+
+        with self.changed:
+            while len(self.futures) >= limit or (self.futures and self.threads != threads):
+                self.changed.wait()
+
+            if self.executor is None or self.threads != threads:
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+
+                self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="image_save")
+                self.threads = threads
+
+            future = self.executor.submit(self.run, func, args, kwargs)
+            self.futures.add(future)
+
+        future.add_done_callback(self.done)
+
+    def run(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            errors.report("Error saving image", exc_info=True)
+
+    def done(self, future):
+        with self.changed:
+            self.futures.discard(future)
+            self.changed.notify_all()
+
+    def backlog(self):
+        """number of images waiting to be saved"""
+
+        return len(self.futures)
+
+    def wait(self):
+        """blocks until all submitted images are saved"""
+
+        with self.changed:
+            while self.futures:
+                self.changed.wait()
+
+
+save_queue = SaveQueue()
+reserved_filenames = set()
+reserved_filenames_lock = threading.Lock()
+
+
+def save_image_in_background(image, path, basename, *args, p=None, **kwargs):
+    """same as save_image, but returns immediately and saves the image in background; use save_queue.wait() to make sure it's saved"""
+
+    save_queue.submit(save_image, image, path, basename, *args, p=copy.copy(p) if p is not None else None, **kwargs)
+
+
 def read_info_from_image(image):
     items = image.info or {}
 
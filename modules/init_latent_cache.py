@@ -0,0 +1,105 @@
+import collections
+import hashlib
+import threading
+
+import torch
+
+from modules import shared, devices, sd_vae
+
+
+class InitLatentCache:
+    """
+    Process-wide LRU cache of VAE encoder outputs for img2img init images, limited by the total size of cached tensors.
+
+    Entries are keyed by a digest of the pixels that go into the encoder, after the init images have been resized,
+    cropped and filled under the mask, so the same picture edited with a different resize mode, size, mask or fill
+    mode gets its own entry; and by the identity of the VAE: the model, its checkpoint, the external VAE file loaded
+    into it and the VAE's dtype. The cache is cleared when a new model is created.
+
+    What is cached is the result of encode_first_stage, a distribution for the usual KL autoencoder, and the latent
+    is still sampled from it on every use, so repeated edits skip the encoder but are otherwise the same as before.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def max_size(self):
+        return shared.opts.init_latent_cache_size * 1024 * 1024
+
+    def context_key(self, model):
+        checkpoint_info = getattr(model, "sd_checkpoint_info", None)
+
+        return (
+            id(model),
+            getattr(checkpoint_info, "filename", None),
+            sd_vae.loaded_vae_file,
+            devices.dtype_vae,
+        )
+
+    def encode_first_stage(self, model, batch_images, image):
+        """
+        returns model.encode_first_stage(image), using the cache if possible; batch_images is the numpy array
+        image was made from
+        """
+
+        if self.max_size() <= 0:
+            return model.encode_first_stage(image)
+
+        digest = hashlib.sha256(batch_images.tobytes()).hexdigest()
+        key = (self.context_key(model), batch_images.shape, batch_images.dtype.str, digest)
+
+        with self.lock:
+            encoded = self.entries.get(key)
+            if encoded is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return encoded
+
+            self.misses += 1
+
+        encoded = model.encode_first_stage(image)
+        self.put(key, encoded)
+
+        return encoded
+
+    def put(self, key, encoded):
+        if isinstance(encoded, torch.Tensor):
+            size = encoded.nbytes
+        else:
+            size = sum(x.nbytes for x in vars(encoded).values() if isinstance(x, torch.Tensor))
+
+        with self.lock:
+            if key in self.entries or size > self.max_size():
+                return
+
+            self.entries[key] = encoded
+            self.sizes[key] = size
+            self.size += size
+
+            while self.entries and self.size > self.max_size():
+                old_key, _ = self.entries.popitem(last=False)
+                self.size -= self.sizes.pop(old_key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size(),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+cache = InitLatentCache()
@@ -0,0 +1,345 @@
+import collections
+import itertools
+import threading
+import time
+
+from modules import shared
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, id_task, client, priority, seq):
+        self.id_task = id_task
+        self.client = client
+        self.priority = priority
+        self.seq = seq
+        self.state = "queued"
+        self.time_queued = time.time()
+        self.time_started = None
+        self.time_finished = None
+        self.turn = threading.Event()
+        self.leader = None
+
+    def dict(self):
+        return {
+            "id_task": self.id_task,
+            "client": self.client,
+            "priority": self.priority,
+            "state": self.state,
+            "time_queued": self.time_queued,
+            "time_started": self.time_started,
+            "time_finished": self.time_finished,
+        }
+
+
+class JobScheduler:
+    """
+    Runs one job at a time, like the threading.Lock it replaces, but picks the next job to run by priority first,
+    then round-robin across clients, then by submission order. Queued jobs can be cancelled, and admission is
+    limited by the queue_max_size/queue_max_size_per_client options.
+
+    Can still be used as `with queue_lock:` or via acquire()/release(); those calls are queued as anonymous jobs.
+
+    Jobs that are generated as part of another job's batch don't get a turn of their own; they are registered with
+    attach() and reported as queued, then running and finished together with the job that runs them.
+    """
+
+    finished_limit = 16
+    durations_limit = 20
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = {}
+        self.current = None
+        self.attached = {}
+        self.finished = collections.OrderedDict()
+        self.durations = collections.deque(maxlen=self.durations_limit)
+        self.client_last_served = {}
+        self.counter = itertools.count()
+        self.served_counter = itertools.count()
+        self.total_rejected = 0
+        self.total_cancelled = 0
+        self.total_finished = 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def acquire(self, blocking=True, timeout=-1):
+        try:
+            self.enter(None, blocking=blocking, timeout=None if timeout < 0 else timeout)
+        except (TimeoutError, JobCancelledError):
+            return False
+
+        return True
+
+    def release(self):
+        with self.lock:
+            if self.current is None:
+                raise RuntimeError("release unlocked job scheduler")
+
+            self._finish_current()
+
+    def locked(self):
+        return self.current is not None
+
+    def job(self, id_task=None, client=None, priority=0):
+        """returns a context manager that waits for its turn in the queue on enter and lets the next job run on exit"""
+
+        return JobContext(self, id_task, client, priority)
+
+    def enter(self, id_task, client=None, priority=0, blocking=True, timeout=None):
+        with self.lock:
+            seq = next(self.counter)
+            job = Job(id_task or f"anonymous({seq})", client or "default", priority or 0, seq)
+
+            if self.current is None and not self.queued:
+                self._start(job)
+                return job
+
+            if not blocking:
+                raise TimeoutError()
+
+            self._admit(job)
+            self.queued[job.id_task] = job
+
+        if not job.turn.wait(timeout):
+            with self.lock:
+                if not job.turn.is_set():
+                    self.queued.pop(job.id_task, None)
+                    raise TimeoutError()
+
+        if job.state == "cancelled":
+            raise JobCancelledError(f"Task {job.id_task} was cancelled while waiting in queue")
+
+        return job
+
+    def leave(self, job):
+        with self.lock:
+            if self.current is job:
+                self._finish_current()
+
+    def attach(self, id_task, client=None, priority=0, leader=None):
+        """
+        registers a job that will run as part of the job with id leader instead of waiting for its own turn; the job
+        is reported as queued and can be cancelled until start_attached() is called for it
+        """
+
+        with self.lock:
+            seq = next(self.counter)
+            job = Job(id_task or f"anonymous({seq})", client or "default", priority or 0, seq)
+            job.leader = leader
+
+            self._admit(job)
+            self.attached[job.id_task] = job
+
+        return job
+
+    def start_attached(self, jobs):
+        """marks attached jobs as running; returns those of them that were not cancelled"""
+
+        with self.lock:
+            started = []
+            for job in jobs:
+                if job.state != "queued":
+                    continue
+
+                job.state = "running"
+                job.time_started = time.time()
+                job.turn.set()
+                started.append(job)
+
+        return started
+
+    def detach(self, jobs):
+        """
+        unregisters attached jobs: those that were running are recorded as finished, those still waiting are woken up
+        with state "detached" and have to queue on their own
+        """
+
+        with self.lock:
+            for job in jobs:
+                if self.attached.get(job.id_task) is not job:
+                    continue
+
+                del self.attached[job.id_task]
+
+                if job.state == "running":
+                    job.state = "finished"
+                    job.time_finished = time.time()
+                    self._remember_finished(job)
+                    self.total_finished += 1
+                else:
+                    job.state = "detached"
+
+                job.turn.set()
+
+    def cancel(self, id_task):
+        """removes a queued job; returns False if there is no such job waiting in queue"""
+
+        with self.lock:
+            job = self.queued.pop(id_task, None)
+            if job is None:
+                job = self.attached.get(id_task)
+                if job is None or job.state != "queued":
+                    return False
+
+                del self.attached[id_task]
+
+            job.state = "cancelled"
+            job.time_finished = time.time()
+            self._remember_finished(job)
+            self.total_cancelled += 1
+            job.turn.set()
+
+        return True
+
+    def is_running(self, id_task):
+        current = self.current
+        if current is not None and current.id_task == id_task:
+            return True
+
+        job = self.attached.get(id_task)
+        return job is not None and job.state == "running"
+
+    def is_queued(self, id_task):
+        if id_task in self.queued:
+            return True
+
+        job = self.attached.get(id_task)
+        return job is not None and job.state == "queued"
+
+    def is_finished(self, id_task):
+        return id_task in self.finished
+
+    def position(self, id_task):
+        """number of jobs that will run before the queued job with given id; None if it's not in queue"""
+
+        with self.lock:
+            job = self.attached.get(id_task)
+            if job is not None and job.state == "queued":
+                id_task = job.leader
+
+            if id_task not in self.queued:
+                return None
+
+            order = sorted(self.queued.values(), key=self._order_key)
+            return next(i for i, job in enumerate(order) if job.id_task == id_task)
+
+    def average_duration(self):
+        if not self.durations:
+            return None
+
+        return sum(self.durations) / len(self.durations)
+
+    def eta(self, id_task):
+        """estimated number of seconds until the queued job with given id starts running"""
+
+        position = self.position(id_task)
+        average = self.average_duration()
+        if position is None or average is None:
+            return None
+
+        current = self.current
+        remaining_current = max(average - (time.time() - current.time_started), 0) if current is not None else 0
+
+        return remaining_current + position * average
+
+    def dict(self):
+        with self.lock:
+            order = sorted(self.queued.values(), key=self._order_key)
+            current = self.current
+            attached = list(self.attached.values())
+
+            clients = collections.Counter(job.client for job in order + attached if job.state == "queued")
+
+        average = self.average_duration()
+
+        return {
+            "queue_size": len(order),
+            "running": current.dict() if current is not None else None,
+            "queued": [job.dict() for job in order],
+            "attached": [job.dict() for job in attached],
+            "clients": dict(clients),
+            "average_duration": average,
+            "eta_empty": average * (len(order) + (current is not None)) if average is not None else None,
+            "total_finished": self.total_finished,
+            "total_cancelled": self.total_cancelled,
+            "total_rejected": self.total_rejected,
+        }
+
+    def _admit(self, job):
+        max_size = shared.opts.queue_max_size
+        max_size_per_client = shared.opts.queue_max_size_per_client
+
+        if job.id_task in self.queued or job.id_task in self.attached or self.is_running(job.id_task):
+            self.total_rejected += 1
+            raise QueueFullError(f"Task {job.id_task} is already in queue")
+
+        waiting = list(self.queued.values()) + [x for x in self.attached.values() if x.state == "queued"]
+
+        if max_size > 0 and len(waiting) >= max_size:
+            self.total_rejected += 1
+            raise QueueFullError(f"Queue is full: {len(waiting)} jobs waiting")
+
+        if max_size_per_client > 0 and sum(1 for x in waiting if x.client == job.client) >= max_size_per_client:
+            self.total_rejected += 1
+            raise QueueFullError(f"Too many jobs in queue for client {job.client}")
+
+    def _order_key(self, job):
+        return -job.priority, self.client_last_served.get(job.client, -1), job.seq
+
+    def _start(self, job):
+        job.state = "running"
+        job.time_started = time.time()
+        self.current = job
+        self.client_last_served[job.client] = next(self.served_counter)
+        job.turn.set()
+
+    def _finish_current(self):
+        job = self.current
+        job.state = "finished"
+        job.time_finished = time.time()
+        self.durations.append(job.time_finished - job.time_started)
+        self._remember_finished(job)
+        self.total_finished += 1
+        self.current = None
+
+        if self.queued:
+            next_job = min(self.queued.values(), key=self._order_key)
+            del self.queued[next_job.id_task]
+            self._start(next_job)
+
+    def _remember_finished(self, job):
+        self.finished[job.id_task] = job
+        while len(self.finished) > self.finished_limit:
+            self.finished.popitem(last=False)
+
+
+class JobContext:
+    def __init__(self, scheduler, id_task, client, priority):
+        self.scheduler = scheduler
+        self.id_task = id_task
+        self.client = client
+        self.priority = priority
+        self.job = None
+
+    def __enter__(self):
+        self.job = self.scheduler.enter(self.id_task, client=self.client, priority=self.priority)
+        return self.job
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.scheduler.leave(self.job)
+
+
+scheduler = JobScheduler()
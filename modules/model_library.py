@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+
+from modules import shared, errors
+from modules.paths import data_path
+
+
+class ModelLibrary:
+    """
+    Persistent index of directories with models, shared by checkpoint, Lora and embedding lists.
+
+    For every directory it keeps the directory's mtime along with the names, mtimes and sizes of files in it, and a
+    directory whose mtime hasn't changed since the last scan is not listed again. Adding, removing or renaming a file
+    changes its directory's mtime, so rescanning an unchanged library costs one stat per directory instead of one per
+    file.
+
+    It also keeps data read from files, such as safetensors metadata, for as long as the file's own mtime and size stay
+    the same. Those are checked for every file, because overwriting a file in place doesn't change its directory's mtime.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.dirs = None
+        self.files = None
+        self.dirty = False
+
+    def enabled(self):
+        return shared.opts.model_library_index
+
+    def load(self):
+        if self.dirs is not None:
+            return
+
+        self.dirs = {}
+        self.files = {}
+
+        if not os.path.isfile(self.filename):
+            return
+
+        try:
+            with open(self.filename, "r", encoding="utf8") as file:
+                data = json.load(file)
+
+            self.dirs = data.get("dirs", {})
+            self.files = data.get("files", {})
+        except Exception as e:
+            errors.display(e, f"reading model library index {self.filename}")
+
+    def save(self):
+        with self.lock:
+            if not self.dirty or not self.enabled():
+                return
+
+            # data for files that are gone from their directory is not needed anymore
+            for filename in list(self.files):
+                entry = self.dirs.get(os.path.dirname(filename))
+                if entry is not None and os.path.basename(filename) not in entry["files"]:
+                    del self.files[filename]
+
+            tmp_filename = f"{self.filename}.tmp"
+
+            try:
+                with open(tmp_filename, "w", encoding="utf8") as file:
+                    json.dump({"dirs": self.dirs, "files": self.files}, file)
+
+                os.replace(tmp_filename, self.filename)
+                self.dirty = False
+            except OSError as e:
+                errors.display(e, f"saving model library index {self.filename}")
+
+    def list_dir(self, path):
+        """returns a dict of file name -> [mtime, size] and a list of subdirectory names for directory path"""
+
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return {}, []
+
+        entry = self.dirs.get(path)
+        if self.enabled() and entry is not None and entry["mtime"] == mtime:
+            return entry["files"], entry["dirs"]
+
+        files = {}
+        subdirs = []
+
+        with os.scandir(path) as it:
+            for direntry in it:
+                try:
+                    if direntry.is_dir():
+                        subdirs.append(direntry.name)
+                        continue
+
+                    stat = direntry.stat()
+                    files[direntry.name] = [stat.st_mtime, stat.st_size]
+                except OSError:
+                    files[direntry.name] = [0, 0]  # broken symlink; callers decide what to do with it
+
+        self.dirs[path] = {"mtime": mtime, "files": files, "dirs": subdirs}
+        self.dirty = True
+
+        return files, subdirs
+
+    def walk_files(self, path, allowed_extensions=None):
+        """same as shared.walk_files, but uses the index for directories that haven't changed"""
+
+        if not os.path.exists(path):
+            return []
+
+        if allowed_extensions is not None:
+            allowed_extensions = set(allowed_extensions)
+
+        res = []
+
+        with self.lock:
+            self.load()
+
+            pending = [path]
+            while pending:
+                root = pending.pop()
+
+                if not shared.opts.list_hidden_files and ("/." in root or "\\." in root):
+                    continue
+
+                files, subdirs = self.list_dir(root)
+
+                for filename in files:
+                    if allowed_extensions is not None:
+                        _, ext = os.path.splitext(filename)
+                        if ext not in allowed_extensions:
+                            continue
+
+                    res.append(os.path.join(root, filename))
+
+                pending += [os.path.join(root, x) for x in subdirs]
+
+            self.save()
+
+        return res
+
+    def stat(self, filename):
+        """returns [mtime, size] of the file, updating the index if its directory has been scanned"""
+
+        st = os.stat(filename)
+        stat = [st.st_mtime, st.st_size]
+
+        with self.lock:
+            self.load()
+
+            entry = self.dirs.get(os.path.dirname(filename))
+            name = os.path.basename(filename)
+            if entry is not None and name in entry["files"] and entry["files"][name] != stat:
+                entry["files"][name] = stat
+                self.dirty = True
+
+        return stat
+
+    def file_data(self, filename, kind, calculate):
+        """
+        Returns calculate(filename), remembered in the index under kind for as long as the file doesn't change.
+        The result must be serializable to JSON.
+        """
+
+        if not self.enabled():
+            return calculate(filename)
+
+        try:
+            stat = self.stat(filename)
+        except OSError:
+            return calculate(filename)
+
+        with self.lock:
+            record = self.files.get(filename)
+            if record is not None and record["stat"] == stat and kind in record["data"]:
+                return record["data"][kind]
+
+        value = calculate(filename)
+
+        with self.lock:
+            record = self.files.get(filename)
+            if record is None or record["stat"] != stat:
+                record = {"stat": stat, "data": {}}
+                self.files[filename] = record
+
+            record["data"][kind] = value
+            self.dirty = True
+
+        return value
+
+
+library = ModelLibrary(os.path.join(data_path, "model_library.json"))
@@ -3,7 +3,7 @@ import shutil
 import importlib
 from urllib.parse import urlparse
 
-from modules import shared
+from modules import shared, model_library
 from modules.upscaler import Upscaler, UpscalerLanczos, UpscalerNearest, UpscalerNone
 from modules.paths import script_path, models_path
 
@@ -35,7 +35,7 @@ def load_models(model_path: str, model_url: str = None, command_path: str = None
         places.append(model_path)
 
         for place in places:
-            for full_path in shared.walk_files(place, allowed_extensions=ext_filter):
+            for full_path in model_library.library.walk_files(place, allowed_extensions=ext_filter):
                 if os.path.islink(full_path) and not os.path.exists(full_path):
                     print(f"Skipping broken symlink: {full_path}")
                     continue
@@ -1,4 +1,9 @@
+import collections
+import hashlib
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
 
@@ -6,6 +11,77 @@ from modules import shared, images, devices, scripts, scripts_postprocessing, ui
 from modules.shared import opts
 
 
+class PostprocessingManifest:
+    """
+    Record of input files that a batch from directory has finished, kept as a JSON lines file in the output directory,
+    so that a batch started again with the same settings skips files that were already processed. A file is only
+    skipped if its mtime and size are the same as when it was processed.
+    """
+
+    def __init__(self, path, settings):
+        self.filename = os.path.join(path, "postprocessing-manifest.jsonl")
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.done = set()
+
+        if not os.path.isfile(self.filename):
+            return
+
+        with open(self.filename, "r", encoding="utf8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut short by an interrupted write
+
+                if entry.get("settings") == settings:
+                    self.done.add((entry["input"], entry["mtime"], entry["size"]))
+
+    @staticmethod
+    def key(filename):
+        stat = os.stat(filename)
+        return os.path.abspath(filename), stat.st_mtime, stat.st_size
+
+    def contains(self, filename):
+        try:
+            return self.key(filename) in self.done
+        except OSError:
+            return False
+
+    def add(self, filename):
+        input_filename, mtime, size = self.key(filename)
+
+        with self.lock:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+            with open(self.filename, "a", encoding="utf8") as file:
+                file.write(json.dumps({"input": input_filename, "mtime": mtime, "size": size, "settings": self.settings}) + "\n")
+
+
+def load_image(image, skip_errors):
+    """opens and decodes an image if needed; returns the image in RGB and its original info, or (None, None) for an unreadable file with skip_errors"""
+
+    try:
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+
+        existing_pnginfo = image.info or {}
+
+        return image.convert("RGB"), existing_pnginfo
+    except Exception:
+        if not skip_errors:
+            raise
+
+        return None, None
+
+
+def save_postprocessed_image(image, outpath, basename, infotext, existing_pnginfo, manifest, name):
+    images.save_image(image, path=outpath, basename=basename, seed=None, prompt=None, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=None)
+
+    if manifest is not None:
+        manifest.add(name)
+
+
 def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output: bool = True):
     devices.torch_gc()
 
@@ -22,7 +98,7 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
                 image = img
                 fn = ''
             else:
-                image = Image.open(os.path.abspath(img.name))
+                image = os.path.abspath(img.name)
                 fn = os.path.splitext(img.orig_name)[0]
             image_data.append(image)
             image_names.append(fn)
@@ -32,11 +108,7 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
 
         image_list = shared.listfiles(input_dir)
         for filename in image_list:
-            try:
-                image = Image.open(filename)
-            except Exception:
-                continue
-            image_data.append(image)
+            image_data.append(filename)
             image_names.append(filename)
     else:
         assert image, 'image not selected'
@@ -49,33 +121,74 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
     else:
         outpath = opts.outdir_samples or opts.outdir_extras_samples
 
+    manifest = None
+    if extras_mode == 2 and save_output and opts.postprocessing_resume_batch:
+        manifest = PostprocessingManifest(outpath, hashlib.sha256(repr(args).encode("utf8")).hexdigest()[0:16])
+
+        items = [(image, name) for image, name in zip(image_data, image_names) if not manifest.contains(name)]
+        if len(items) < len(image_data):
+            print(f"Skipping {len(image_data) - len(items)} images already processed with same settings, according to {manifest.filename}")
+    else:
+        items = list(zip(image_data, image_names))
+
     infotext = ''
 
-    for image, name in zip(image_data, image_names):
-        shared.state.textinfo = name
+    # images are decoded by a pool of threads ahead of the one being processed and saved by images.save_queue, so
+    # that the GPU doesn't wait for either
+    workers = max(int(opts.postprocessing_workers), 1)
+    max_queued = workers * 2
 
-        existing_pnginfo = image.info or {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="postprocessing-load") as load_pool:
+        pending_items = iter(items)
+        loading = collections.deque()
+
+        def queue_loads():
+            while len(loading) < max_queued:
+                item = next(pending_items, None)
+                if item is None:
+                    return
 
-        pp = scripts_postprocessing.PostprocessedImage(image.convert("RGB"))
+                image, name = item
+                loading.append((name, load_pool.submit(load_image, image, extras_mode == 2)))
 
-        scripts.scripts_postproc.run(pp, args)
+        queue_loads()
+
+        while loading:
+            name, future = loading.popleft()
+            queue_loads()
+
+            image, existing_pnginfo = future.result()
+            if image is None:
+                continue
+
+            if shared.state.interrupted:
+                break
+
+            shared.state.textinfo = name
+
+            pp = scripts_postprocessing.PostprocessedImage(image)
+
+            scripts.scripts_postproc.run(pp, args)
+
+            if opts.use_original_name_batch and name is not None:
+                basename = os.path.splitext(os.path.basename(name))[0]
+            else:
+                basename = ''
 
-        if opts.use_original_name_batch and name is not None:
-            basename = os.path.splitext(os.path.basename(name))[0]
-        else:
-            basename = ''
+            infotext = ", ".join([k if k == v else f'{k}: {generation_parameters_copypaste.quote(v)}' for k, v in pp.info.items() if v is not None])
 
-        infotext = ", ".join([k if k == v else f'{k}: {generation_parameters_copypaste.quote(v)}' for k, v in pp.info.items() if v is not None])
+            if opts.enable_pnginfo:
+                pp.image.info = existing_pnginfo
+                pp.image.info["postprocessing"] = infotext
 
-        if opts.enable_pnginfo:
-            pp.image.info = existing_pnginfo
-            pp.image.info["postprocessing"] = infotext
+            if save_output:
+                images.save_queue.submit(save_postprocessed_image, pp.image, outpath, basename, infotext, existing_pnginfo, manifest, name)
 
-        if save_output:
-            images.save_image(pp.image, path=outpath, basename=basename, seed=None, prompt=None, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=None)
+            if extras_mode != 2 or show_extras_results:
+                outputs.append(pp.image)
 
-        if extras_mode != 2 or show_extras_results:
-            outputs.append(pp.image)
+    if save_output:
+        images.save_queue.wait()
 
     devices.torch_gc()
 
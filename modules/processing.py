@@ -14,7 +14,7 @@ from skimage import exposure
 from typing import Any, Dict, List
 
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet
+from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, tiling, init_latent_cache
 from modules.sd_hijack import model_hijack
 from modules.shared import opts, cmd_opts, state
 import modules.shared as shared
@@ -184,6 +184,9 @@ class StableDiffusionProcessing:
         self.uc = None
         self.c = None
 
+        self.image_ready_callback = None
+        """if set, called with every generated image as soon as it is finished, before the rest of the job is done"""
+
     @property
     def sd_model(self):
         return shared.sd_model
@@ -458,66 +461,96 @@ def slerp(val, low, high):
 
 
 def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, seed_resize_from_h=0, seed_resize_from_w=0, p=None):
+    """
+    Returns a batch of noise, one sample of shape for each seed. Noise for the whole batch, along with variation
+    noise and sampler noises, is written into preallocated batch tensors by a private generator and moved to the
+    device at once. The numbers are the same as those devices.randn gives for each seed in turn, and the global
+    RNG is left in the same state, so seeds reproduce exactly as before.
+    """
+
     eta_noise_seed_delta = opts.eta_noise_seed_delta or 0
-    xs = []
+    shape = tuple(shape)
+    noise_shape = shape if seed_resize_from_h <= 0 or seed_resize_from_w <= 0 else (shape[0], seed_resize_from_h//8, seed_resize_from_w//8)
 
     # if we have multiple seeds, this means we are working with batch size>1; this then
     # enables the generation of additional tensors with noise that the sampler will use during its processing.
     # Using those pre-generated tensors instead of simple torch.randn allows a batch with seeds [100, 101] to
     # produce the same images as with two batches [100], [101].
     if p is not None and p.sampler is not None and (len(seeds) > 1 and opts.enable_batch_seeds or eta_noise_seed_delta > 0):
-        sampler_noises = [[] for _ in range(p.sampler.number_of_needed_noises(p))]
+        sampler_noise_count = p.sampler.number_of_needed_noises(p)
     else:
-        sampler_noises = None
-
+        sampler_noise_count = None
+
+    # randn results depend on device; gpu and cpu get different results for same seed;
+    # the way I see it, it's better to do this on CPU, so that everyone gets same result;
+    # but the original script had it like this, so I do not dare change it for now because
+    # it will break everyone's seeds.
+    rng_device = devices.randn_device()
+    generator = torch.Generator(rng_device)
+
+    count = len(seeds)
+    x = torch.empty((count, *shape), device=rng_device)
+    noise = x if noise_shape == shape else torch.empty((count, *noise_shape), device=rng_device)
+    subnoise = torch.empty((count, *noise_shape), device=rng_device) if subseeds is not None else None
+    sampler_noises = [torch.empty((count, *noise_shape), device=rng_device) for _ in range(sampler_noise_count)] if sampler_noise_count is not None else None
+
+    # tensor.normal_() is what torch.randn() fills a new tensor with
+    last_seed = None
     for i, seed in enumerate(seeds):
-        noise_shape = shape if seed_resize_from_h <= 0 or seed_resize_from_w <= 0 else (shape[0], seed_resize_from_h//8, seed_resize_from_w//8)
-
-        subnoise = None
-        if subseeds is not None:
+        if subnoise is not None:
             subseed = 0 if i >= len(subseeds) else subseeds[i]
 
-            subnoise = devices.randn(subseed, noise_shape)
+            generator.manual_seed(subseed)
+            subnoise[i].normal_(generator=generator)
 
-        # randn results depend on device; gpu and cpu get different results for same seed;
-        # the way I see it, it's better to do this on CPU, so that everyone gets same result;
-        # but the original script had it like this, so I do not dare change it for now because
-        # it will break everyone's seeds.
-        noise = devices.randn(seed, noise_shape)
+        last_seed = seed
+        generator.manual_seed(seed)
+        noise[i].normal_(generator=generator)
 
-        if subnoise is not None:
-            noise = slerp(subseed_strength, noise, subnoise)
-
-        if noise_shape != shape:
-            x = devices.randn(seed, shape)
-            dx = (shape[2] - noise_shape[2]) // 2
-            dy = (shape[1] - noise_shape[1]) // 2
-            w = noise_shape[2] if dx >= 0 else noise_shape[2] + 2 * dx
-            h = noise_shape[1] if dy >= 0 else noise_shape[1] + 2 * dy
-            tx = 0 if dx < 0 else dx
-            ty = 0 if dy < 0 else dy
-            dx = max(-dx, 0)
-            dy = max(-dy, 0)
-
-            x[:, ty:ty+h, tx:tx+w] = noise[:, dy:dy+h, dx:dx+w]
-            noise = x
+        if noise is not x:
+            generator.manual_seed(seed)
+            x[i].normal_(generator=generator)
 
         if sampler_noises is not None:
-            cnt = p.sampler.number_of_needed_noises(p)
-
             if eta_noise_seed_delta > 0:
-                torch.manual_seed(seed + eta_noise_seed_delta)
+                last_seed = seed + eta_noise_seed_delta
+                generator.manual_seed(last_seed)
+
+            for sampler_noise in sampler_noises:
+                sampler_noise[i].normal_(generator=generator)
+
+    # samplers that don't get pre-generated noise use the global RNG; leave it as if noise was made with it
+    if last_seed is not None:
+        torch.manual_seed(last_seed)
+        devices.default_generator(rng_device).set_state(generator.get_state())
+
+    x = x.to(devices.device)
+    noise = x if noise is x else noise.to(devices.device)
+
+    if subnoise is not None:
+        subnoise = subnoise.to(devices.device)
+
+        # slerp normalizes each sample on its own; applying it to the whole batch at once changes the order of
+        # floating point sums, so results would differ in the last bits
+        for i in range(count):
+            noise[i] = slerp(subseed_strength, noise[i], subnoise[i])
 
-            for j in range(cnt):
-                sampler_noises[j].append(devices.randn_without_seed(tuple(noise_shape)))
+    if noise is not x:
+        dx = (shape[2] - noise_shape[2]) // 2
+        dy = (shape[1] - noise_shape[1]) // 2
+        w = noise_shape[2] if dx >= 0 else noise_shape[2] + 2 * dx
+        h = noise_shape[1] if dy >= 0 else noise_shape[1] + 2 * dy
+        tx = 0 if dx < 0 else dx
+        ty = 0 if dy < 0 else dy
+        dx = max(-dx, 0)
+        dy = max(-dy, 0)
 
-        xs.append(noise)
+        x[:, :, ty:ty+h, tx:tx+w] = noise[:, :, dy:dy+h, dx:dx+w]
 
     if sampler_noises is not None:
-        p.sampler.sampler_noises = [torch.stack(n).to(shared.device) for n in sampler_noises]
+        p.sampler.sampler_noises = [n.to(shared.device) for n in sampler_noises]
 
-    x = torch.stack(xs).to(shared.device)
-    return x
+    return x.to(shared.device)
 
 
 def decode_first_stage(model, x):
@@ -527,6 +560,67 @@ def decode_first_stage(model, x):
     return x
 
 
+def decode_first_stage_tiled(model, x, tile_size=64, overlap=16):
+    """decodes latents in overlapping tiles of tile_size x tile_size to use less VRAM; tiles are blended where they overlap"""
+
+    height, width = x.shape[2], x.shape[3]
+    result = None
+    result_weights = None
+
+    for y in tiling.tile_starts(height, tile_size, overlap):
+        for x0 in tiling.tile_starts(width, tile_size, overlap):
+            decoded = decode_first_stage(model, x[:, :, y:y + tile_size, x0:x0 + tile_size])
+            scale = decoded.shape[2] // min(tile_size, height)
+
+            if result is None:
+                result = torch.zeros((x.shape[0], decoded.shape[1], height * scale, width * scale), device=decoded.device, dtype=torch.float32)
+                result_weights = torch.zeros((1, 1, height * scale, width * scale), device=decoded.device, dtype=torch.float32)
+
+            weights = tiling.tile_blend_weights(decoded.shape[2], decoded.shape[3], overlap * scale, decoded.device)
+            region = (slice(None), slice(None), slice(y * scale, y * scale + decoded.shape[2]), slice(x0 * scale, x0 * scale + decoded.shape[3]))
+            result[region] += decoded.float() * weights
+            result_weights[region] += weights
+
+    return (result / result_weights).to(decoded.dtype)
+
+
+def decode_first_stage_with_fallback(model, x):
+    """decodes latents; if VRAM runs out, retries with the batch split in halves, and with tiled decoding for single images"""
+
+    try:
+        return decode_first_stage(model, x)
+    except RuntimeError as e:  # torch.cuda.OutOfMemoryError is a subclass of RuntimeError
+        if "out of memory" not in str(e):
+            raise
+
+    devices.torch_gc()
+
+    if x.shape[0] > 1:
+        half = x.shape[0] // 2
+        return torch.cat([decode_first_stage_with_fallback(model, x[:half]), decode_first_stage_with_fallback(model, x[half:])])
+
+    print("Not enough VRAM to decode the image with VAE, falling back to tiled decoding")
+    return decode_first_stage_tiled(model, x)
+
+
+def decode_latent_batch(model, batch, check_for_nans=False):
+    """decodes a batch of latents with VAE, opts.vae_decode_batch_size images at a time (0 = all at once); results stay on the device"""
+
+    micro_batch_size = opts.vae_decode_batch_size or batch.shape[0]
+    samples = []
+
+    for i in range(0, batch.shape[0], micro_batch_size):
+        sample = decode_first_stage_with_fallback(model, batch[i:i + micro_batch_size].to(dtype=devices.dtype_vae))
+
+        if check_for_nans:
+            for x in sample:
+                devices.test_for_nans(x, "vae")
+
+        samples.append(sample)
+
+    return torch.cat(samples) if len(samples) > 1 else samples[0]
+
+
 def get_fixed_seed(seed):
     if seed is None or seed == '' or seed == -1:
         return int(random.randrange(4294967294))
@@ -620,6 +714,8 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
         res = process_images_inner(p)
 
     finally:
+        images.save_queue.wait()
+
         sd_models.apply_token_merging(p.sd_model, 0)
 
         # restore opts to original state
@@ -738,12 +834,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
                 samples_ddim = p.sample(conditioning=p.c, unconditional_conditioning=p.uc, seeds=p.seeds, subseeds=p.subseeds, subseed_strength=p.subseed_strength, prompts=p.prompts)
 
-            x_samples_ddim = [decode_first_stage(p.sd_model, samples_ddim[i:i+1].to(dtype=devices.dtype_vae))[0].cpu() for i in range(samples_ddim.size(0))]
-            for x in x_samples_ddim:
-                devices.test_for_nans(x, "vae")
-
-            x_samples_ddim = torch.stack(x_samples_ddim).float()
-            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+            x_samples_ddim = decode_latent_batch(p.sd_model, samples_ddim, check_for_nans=True).float()
+            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0).cpu()  # scripts expect images on CPU; one transfer for the whole batch
 
             del samples_ddim
 
@@ -755,15 +847,14 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             if p.scripts is not None:
                 p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
 
-            for i, x_sample in enumerate(x_samples_ddim):
-                p.batch_index = i
+            x_samples_uint8 = (255. * x_samples_ddim).to(torch.uint8).permute(0, 2, 3, 1).numpy()
 
-                x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
-                x_sample = x_sample.astype(np.uint8)
+            for i, x_sample in enumerate(x_samples_uint8):
+                p.batch_index = i
 
                 if p.restore_faces:
                     if opts.save and not p.do_not_save_samples and opts.save_images_before_face_restoration:
-                        images.save_image(Image.fromarray(x_sample), p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-face-restoration")
+                        images.save_image_in_background(Image.fromarray(x_sample), p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-face-restoration")
 
                     devices.torch_gc()
 
@@ -780,13 +871,13 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 if p.color_corrections is not None and i < len(p.color_corrections):
                     if opts.save and not p.do_not_save_samples and opts.save_images_before_color_correction:
                         image_without_cc = apply_overlay(image, p.paste_to, i, p.overlay_images)
-                        images.save_image(image_without_cc, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-color-correction")
+                        images.save_image_in_background(image_without_cc, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-color-correction")
                     image = apply_color_correction(p.color_corrections[i], image)
 
                 image = apply_overlay(image, p.paste_to, i, p.overlay_images)
 
                 if opts.samples_save and not p.do_not_save_samples:
-                    images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p)
+                    images.save_image_in_background(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p)
 
                 text = infotext(n, i)
                 infotexts.append(text)
@@ -794,15 +885,18 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     image.info["parameters"] = text
                 output_images.append(image)
 
+                if p.image_ready_callback is not None:
+                    p.image_ready_callback(image)
+
                 if hasattr(p, 'mask_for_overlay') and p.mask_for_overlay and any([opts.save_mask, opts.save_mask_composite, opts.return_mask, opts.return_mask_composite]):
                     image_mask = p.mask_for_overlay.convert('RGB')
                     image_mask_composite = Image.composite(image.convert('RGBA').convert('RGBa'), Image.new('RGBa', image.size), images.resize_image(2, p.mask_for_overlay, image.width, image.height).convert('L')).convert('RGBA')
 
                     if opts.save_mask:
-                        images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-mask")
+                        images.save_image_in_background(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-mask")
 
                     if opts.save_mask_composite:
-                        images.save_image(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-mask-composite")
+                        images.save_image_in_background(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-mask-composite")
 
                     if opts.return_mask:
                         output_images.append(image_mask)
@@ -810,7 +904,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     if opts.return_mask_composite:
                         output_images.append(image_mask_composite)
 
-            del x_samples_ddim
+            del x_samples_ddim, x_samples_uint8
 
             devices.torch_gc()
 
@@ -832,13 +926,16 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 index_of_first_image = 1
 
             if opts.grid_save:
-                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(), short_filename=not opts.grid_extended_filename, p=p, grid=True)
+                images.save_image_in_background(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(), short_filename=not opts.grid_extended_filename, p=p, grid=True)
 
     if not p.disable_extra_networks and p.extra_network_data:
         extra_networks.deactivate(p, p.extra_network_data)
 
     devices.torch_gc()
 
+    # images are saved in background while generation continues; make sure all of them are on disk before returning
+    images.save_queue.wait()
+
     res = Processed(
         p,
         images_list=output_images,
@@ -999,17 +1096,19 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
         target_width = self.hr_upscale_to_x
         target_height = self.hr_upscale_to_y
 
+        save_before_hires = opts.save and not self.do_not_save_samples and opts.save_images_before_highres_fix
+
         def save_intermediate(image, index):
             """saves image before applying hires fix, if enabled in options; takes as an argument either an image or batch with latent space images"""
 
-            if not opts.save or self.do_not_save_samples or not opts.save_images_before_highres_fix:
+            if not save_before_hires:
                 return
 
             if not isinstance(image, Image.Image):
                 image = sd_samplers.sample_to_image(image, index, approximation=0)
 
             info = create_infotext(self, self.all_prompts, self.all_seeds, self.all_subseeds, [], iteration=self.iteration, position_in_batch=index)
-            images.save_image(image, self.outpath_samples, "", seeds[index], prompts[index], opts.samples_format, info=info, suffix="-before-highres-fix")
+            images.save_image_in_background(image, self.outpath_samples, "", seeds[index], prompts[index], opts.samples_format, info=info, suffix="-before-highres-fix")
 
         if latent_scale_mode is not None:
             for i in range(samples.shape[0]):
@@ -1024,24 +1123,38 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
             else:
                 image_conditioning = self.txt2img_image_conditioning(samples)
         else:
-            decoded_samples = decode_first_stage(self.sd_model, samples)
+            decoded_samples = decode_latent_batch(self.sd_model, samples)
             lowres_samples = torch.clamp((decoded_samples + 1.0) / 2.0, min=0.0, max=1.0)
 
-            batch_images = []
-            for i, x_sample in enumerate(lowres_samples):
+            def lowres_image(x_sample):
                 x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
                 x_sample = x_sample.astype(np.uint8)
-                image = Image.fromarray(x_sample)
+                return Image.fromarray(x_sample)
+
+            # the whole batch is upscaled as a tensor on the device if the upscaler can do that; otherwise, one PIL image at a time
+            upscaled = images.upscale_tensor(lowres_samples, target_width, target_height, self.hr_upscaler) if opts.hires_fix_upscale_on_device else None
+
+            if upscaled is not None:
+                if save_before_hires:
+                    for i, x_sample in enumerate(lowres_samples):
+                        save_intermediate(lowres_image(x_sample), i)
+
+                decoded_samples = upscaled.to(shared.device, torch.float32)
+            else:
+                batch_images = []
+                for i, x_sample in enumerate(lowres_samples):
+                    image = lowres_image(x_sample)
+
+                    save_intermediate(image, i)
 
-                save_intermediate(image, i)
+                    image = images.resize_image(0, image, target_width, target_height, upscaler_name=self.hr_upscaler)
+                    image = np.array(image).astype(np.float32) / 255.0
+                    image = np.moveaxis(image, 2, 0)
+                    batch_images.append(image)
 
-                image = images.resize_image(0, image, target_width, target_height, upscaler_name=self.hr_upscaler)
-                image = np.array(image).astype(np.float32) / 255.0
-                image = np.moveaxis(image, 2, 0)
-                batch_images.append(image)
+                decoded_samples = torch.from_numpy(np.array(batch_images))
+                decoded_samples = decoded_samples.to(shared.device)
 
-            decoded_samples = torch.from_numpy(np.array(batch_images))
-            decoded_samples = decoded_samples.to(shared.device)
             decoded_samples = 2. * decoded_samples - 1.
 
             samples = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(decoded_samples))
@@ -1282,7 +1395,8 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
         image = 2. * image - 1.
         image = image.to(shared.device)
 
-        self.init_latent = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(image))
+        encoded = init_latent_cache.cache.encode_first_stage(self.sd_model, batch_images, image)
+        self.init_latent = self.sd_model.get_first_stage_encoding(encoded)
 
         if self.resize_mode == 3:
             self.init_latent = torch.nn.functional.interpolate(self.init_latent, size=(self.height // opt_f, self.width // opt_f), mode="bilinear")
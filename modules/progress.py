@@ -1,50 +1,33 @@
+import asyncio
 import base64
 import io
+import json
+import threading
 import time
 
 import gradio as gr
+from fastapi import Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
+from modules import errors
 from modules.shared import opts
+from modules.job_scheduler import scheduler
+from modules.task_results import store as task_result_store
 
 import modules.shared as shared
 
 
-current_task = None
-pending_tasks = {}
-finished_tasks = []
 recorded_results = []
 recorded_results_limit = 2
 
 
-def start_task(id_task):
-    global current_task
-
-    current_task = id_task
-    pending_tasks.pop(id_task, None)
-
-
-def finish_task(id_task):
-    global current_task
-
-    if current_task == id_task:
-        current_task = None
-
-    finished_tasks.append(id_task)
-    if len(finished_tasks) > 16:
-        finished_tasks.pop(0)
-
-
 def record_results(id_task, res):
     recorded_results.append((id_task, res))
     if len(recorded_results) > recorded_results_limit:
         recorded_results.pop(0)
 
 
-def add_task_to_queue(id_job):
-    pending_tasks[id_job] = time.time()
-
-
 class ProgressRequest(BaseModel):
     id_task: str = Field(default=None, title="Task ID", description="id of the task to get progress for")
     id_live_preview: int = Field(default=-1, title="Live preview image ID", description="id of last received last preview image")
@@ -59,19 +42,16 @@ class ProgressResponse(BaseModel):
     live_preview: str = Field(default=None, title="Live preview image", description="Current live preview; a data: uri")
     id_live_preview: int = Field(default=None, title="Live preview image ID", description="Send this together with next request to prevent receiving same image")
     textinfo: str = Field(default=None, title="Info text", description="Info text used by WebUI.")
+    queue_position: int = Field(default=None, title="Queue position", description="Number of jobs that will run before this one; only set while the task is in queue")
 
 
 def setup_progress_api(app):
+    app.add_api_route("/internal/progress/stream", progress_stream, methods=["GET"])
     return app.add_api_route("/internal/progress", progressapi, methods=["POST"], response_model=ProgressResponse)
 
 
-def progressapi(req: ProgressRequest):
-    active = req.id_task == current_task
-    queued = req.id_task in pending_tasks
-    completed = req.id_task in finished_tasks
-
-    if not active:
-        return ProgressResponse(active=active, queued=queued, completed=completed, id_live_preview=-1, textinfo="In queue..." if queued else "Waiting...")
+def current_progress():
+    """returns progress of the running job in range from 0 to 1 and estimated remaining time in seconds"""
 
     progress = 0
 
@@ -89,37 +69,206 @@ def progressapi(req: ProgressRequest):
     predicted_duration = elapsed_since_start / progress if progress > 0 else None
     eta = predicted_duration - elapsed_since_start if predicted_duration is not None else None
 
+    return progress, eta
+
+
+live_preview_cache = (None, None)
+
+
+def encode_live_preview():
+    """
+    Returns a data: uri with current live preview image, or None if there is no preview. The image is only encoded
+    once no matter how many clients ask for it.
+    """
+
+    global live_preview_cache
+
+    image = shared.state.current_image
+    if image is None:
+        return None
+
+    key = (shared.state.id_live_preview, id(image), opts.live_previews_image_format)
+    cached_key, cached_uri = live_preview_cache
+    if cached_key == key:
+        return cached_uri
+
+    buffered = io.BytesIO()
+
+    if opts.live_previews_image_format == "png":
+        # using optimize for large images takes an enormous amount of time
+        if max(*image.size) <= 256:
+            save_kwargs = {"optimize": True}
+        else:
+            save_kwargs = {"optimize": False, "compress_level": 1}
+
+    else:
+        save_kwargs = {}
+
+    image.save(buffered, format=opts.live_previews_image_format, **save_kwargs)
+    base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
+    live_preview = f"data:image/{opts.live_previews_image_format};base64,{base64_image}"
+
+    live_preview_cache = (key, live_preview)
+
+    return live_preview
+
+
+def progressapi(req: ProgressRequest):
+    active = scheduler.is_running(req.id_task)
+    queued = scheduler.is_queued(req.id_task)
+    completed = scheduler.is_finished(req.id_task) or task_result_store.contains(req.id_task)
+
+    if not active:
+        if queued:
+            position = scheduler.position(req.id_task)
+            textinfo = "In queue..." if position is None else f"In queue, position {position + 1}..."
+            return ProgressResponse(active=active, queued=queued, completed=completed, eta=scheduler.eta(req.id_task), queue_position=position, id_live_preview=-1, textinfo=textinfo)
+
+        return ProgressResponse(active=active, queued=queued, completed=completed, id_live_preview=-1, textinfo="Waiting...")
+
+    progress, eta = current_progress()
+
     id_live_preview = req.id_live_preview
     shared.state.set_current_image()
     if opts.live_previews_enable and shared.state.id_live_preview != req.id_live_preview:
-        image = shared.state.current_image
-        if image is not None:
-            buffered = io.BytesIO()
-
-            if opts.live_previews_image_format == "png":
-                # using optimize for large images takes an enormous amount of time
-                if max(*image.size) <= 256:
-                    save_kwargs = {"optimize": True}
-                else:
-                    save_kwargs = {"optimize": False, "compress_level": 1}
-
-            else:
-                save_kwargs = {}
-
-            image.save(buffered, format=opts.live_previews_image_format, **save_kwargs)
-            base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
-            live_preview = f"data:image/{opts.live_previews_image_format};base64,{base64_image}"
+        live_preview = encode_live_preview()
+        if live_preview is not None:
             id_live_preview = shared.state.id_live_preview
-        else:
-            live_preview = None
     else:
         live_preview = None
 
     return ProgressResponse(active=active, queued=queued, completed=completed, progress=progress, eta=eta, live_preview=live_preview, id_live_preview=id_live_preview, textinfo=shared.state.textinfo)
 
 
+class ProgressBroadcaster:
+    """
+    Pushes progress of the running job to all subscribed clients as server-sent events.
+
+    While there are subscribers, a single thread samples progress every live_preview_refresh_period milliseconds.
+    When anything has changed, it formats one event, with a new live preview encoded once if there is one, and puts
+    that same event into every subscriber's queue. A subscriber that doesn't keep up loses its oldest events.
+    """
+
+    queue_size = 8
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.thread = None
+        self.last_message = None
+
+    def subscribe(self, loop):
+        """must be called from the event loop passed as the argument"""
+
+        subscriber = (loop, asyncio.Queue(maxsize=self.queue_size))
+
+        with self.lock:
+            self.subscribers.add(subscriber)
+
+            if self.last_message is not None:
+                subscriber[1].put_nowait(self.last_message)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="progress broadcaster", daemon=True)
+                self.thread.start()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def snapshot(self, id_live_preview):
+        current = scheduler.current
+
+        event = {
+            "id_task": current.id_task if current is not None else None,
+            "queue_size": len(scheduler.queued),
+            "active": current is not None,
+            "progress": None,
+            "eta": None,
+            "textinfo": None,
+        }
+
+        if current is not None:
+            event["progress"], event["eta"] = current_progress()
+            event["textinfo"] = shared.state.textinfo
+
+            shared.state.set_current_image()
+            if opts.live_previews_enable and shared.state.id_live_preview != id_live_preview:
+                live_preview = encode_live_preview()
+                if live_preview is not None:
+                    event["id_live_preview"] = shared.state.id_live_preview
+                    event["live_preview"] = live_preview
+
+        return event
+
+    def run(self):
+        last_event = None
+        id_live_preview = -1
+
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    self.last_message = None
+                    return
+
+            try:
+                event = self.snapshot(id_live_preview)
+            except Exception:
+                errors.report("Error getting progress for broadcast", exc_info=True)
+                event = None
+
+            if event is not None:
+                id_live_preview = event.get("id_live_preview", id_live_preview)
+
+                # eta changes all the time, so it only counts as a change together with something else
+                comparable = {k: v for k, v in event.items() if k != "eta"}
+                if comparable != last_event:
+                    message = f"data: {json.dumps(event)}\n\n"
+
+                    with self.lock:
+                        self.last_message = message
+                        for loop, queue in self.subscribers:
+                            loop.call_soon_threadsafe(self.put, queue, message)
+
+                last_event = comparable
+
+            time.sleep(max(opts.live_preview_refresh_period, 100) / 1000)
+
+    @staticmethod
+    def put(queue, message):
+        if queue.full():
+            queue.get_nowait()
+
+        queue.put_nowait(message)
+
+
+broadcaster = ProgressBroadcaster()
+
+
+async def progress_stream(request: Request):
+    """server-sent events with progress of the running job; see ProgressBroadcaster"""
+
+    async def events():
+        subscriber = broadcaster.subscribe(asyncio.get_running_loop())
+        _, queue = subscriber
+
+        try:
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 def restore_progress(id_task):
-    while id_task == current_task or id_task in pending_tasks:
+    while scheduler.is_running(id_task) or scheduler.is_queued(id_task):
         time.sleep(0.1)
 
     res = next(iter([x[1] for x in recorded_results if id_task == x[0]]), None)
@@ -1,5 +1,5 @@
 import re
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from typing import List
 import lark
 
@@ -127,6 +127,8 @@ def get_learned_conditioning(model, prompts, steps):
         ]
     ]
     """
+    from modules import cond_cache
+
     res = []
 
     prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps)
@@ -140,7 +142,7 @@ def get_learned_conditioning(model, prompts, steps):
             continue
 
         texts = [x[1] for x in prompt_schedule]
-        conds = model.get_learned_conditioning(texts)
+        conds = cond_cache.cache.get_learned_conditioning(model, texts)
 
         cond_schedule = []
         for i, (end_at_step, _) in enumerate(prompt_schedule):
@@ -214,51 +216,119 @@ def get_multicond_learned_conditioning(model, prompts, steps) -> MulticondLearne
     return MulticondLearnedConditioning(shape=(len(prompts),), batch=res)
 
 
-def reconstruct_cond_batch(c: List[List[ScheduledPromptConditioning]], current_step):
-    param = c[0][0].cond
-    res = torch.zeros((len(c),) + param.shape, device=param.device, dtype=param.dtype)
-    for i, cond_schedule in enumerate(c):
-        target_index = 0
-        for current, entry in enumerate(cond_schedule):
-            if current_step <= entry.end_at_step:
-                target_index = current
-                break
-        res[i] = cond_schedule[target_index].cond
+class CompiledCondSchedule:
+    """
+    Conditioning schedules for a batch, prepared once so that getting conds for a sampling step is a single gather:
+    a table with the index of the cond each schedule uses at each step, and all distinct conds stacked into one tensor
+    for every token count a step needs. Like before compiling, conds at a step are padded only to the longest cond used
+    at that step, so a short cond is not padded for steps where only short conds are in use.
+    """
 
-    return res
+    def __init__(self, schedules: List[List[ScheduledPromptConditioning]]):
+        conds = []
+        cond_indexes = {}
+        schedule_indexes = []
 
+        for schedule in schedules:
+            indexes = []
+            for entry in schedule:
+                index = cond_indexes.get(id(entry.cond))
+                if index is None:
+                    index = len(conds)
+                    cond_indexes[id(entry.cond)] = index
+                    conds.append(entry.cond)
 
-def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
-    param = c.batch[0][0].schedules[0].cond
+                indexes.append(index)
+
+            schedule_indexes.append(indexes)
+
+        param = conds[0]
+
+        # a schedule uses the first entry that ends at or after the step; past the end of all entries, it uses the first
+        self.last_step = max(entry.end_at_step for schedule in schedules for entry in schedule)
+        table = []
+        for step in range(self.last_step + 2):
+            row = []
+            for schedule, indexes in zip(schedules, schedule_indexes):
+                target_index = 0
+                for current, entry in enumerate(schedule):
+                    if step <= entry.end_at_step:
+                        target_index = current
+                        break
+
+                row.append(indexes[target_index])
+
+            table.append(row)
+
+        self.table = torch.tensor(table, dtype=torch.long, device=param.device)
+        self.token_counts = [max(conds[i].shape[0] for i in row) for row in table]
+
+        # if prompts have wildly different lengths above the limit we'll get tensors of different shapes
+        # and won't be able to torch.stack them. So this fixes that. Conds longer than token_count are
+        # cut short; they are never picked at the steps that use this tensor.
+        self.conds = {}
+        for token_count in set(self.token_counts):
+            padded = []
+            for cond in conds:
+                if cond.shape[0] < token_count:
+                    last_vector_repeated = cond[-1:].repeat([token_count - cond.shape[0], 1])
+                    cond = torch.vstack([cond, last_vector_repeated])
+
+                padded.append(cond[:token_count])
+
+            self.conds[token_count] = torch.stack(padded).to(device=param.device, dtype=param.dtype)
 
-    tensors = []
-    conds_list = []
+    def at_step(self, current_step):
+        step = min(max(current_step, 0), self.last_step + 1)
+        return self.conds[self.token_counts[step]].index_select(0, self.table[step])
 
-    for composable_prompts in c.batch:
-        conds_for_batch = []
 
-        for composable_prompt in composable_prompts:
-            target_index = 0
-            for current, entry in enumerate(composable_prompt.schedules):
-                if current_step <= entry.end_at_step:
-                    target_index = current
-                    break
+compiled_schedules = OrderedDict()
+compiled_schedules_limit = 8
+
+
+def get_compiled_schedule(c, schedules):
+    """
+    Returns CompiledCondSchedule for the schedules of conditioning object c, compiling it on first use. Samplers call
+    this with the same c on every step, so compiled schedules of recently used objects are kept; keeping a reference
+    to c also makes sure its id is not reused by another object while the entry exists.
+    """
+
+    entry = compiled_schedules.get(id(c))
+    if entry is not None and entry[0] is c:
+        compiled_schedules.move_to_end(id(c))
+        return entry[1]
+
+    compiled = CompiledCondSchedule(schedules)
+    compiled_schedules[id(c)] = (c, compiled)
+    while len(compiled_schedules) > compiled_schedules_limit:
+        compiled_schedules.popitem(last=False)
+
+    return compiled
+
+
+def reconstruct_cond_batch(c: List[List[ScheduledPromptConditioning]], current_step):
+    return get_compiled_schedule(c, c).at_step(current_step)
+
+
+def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
+    if getattr(c, "conds_list", None) is None:
+        conds_list = []
+        schedules = []
+
+        for composable_prompts in c.batch:
+            conds_for_batch = []
 
-            conds_for_batch.append((len(tensors), composable_prompt.weight))
-            tensors.append(composable_prompt.schedules[target_index].cond)
+            for composable_prompt in composable_prompts:
+                conds_for_batch.append((len(schedules), composable_prompt.weight))
+                schedules.append(composable_prompt.schedules)
 
-        conds_list.append(conds_for_batch)
+            conds_list.append(conds_for_batch)
 
-    # if prompts have wildly different lengths above the limit we'll get tensors fo different shapes
-    # and won't be able to torch.stack them. So this fixes that.
-    token_count = max([x.shape[0] for x in tensors])
-    for i in range(len(tensors)):
-        if tensors[i].shape[0] != token_count:
-            last_vector = tensors[i][-1:]
-            last_vector_repeated = last_vector.repeat([token_count - tensors[i].shape[0], 1])
-            tensors[i] = torch.vstack([tensors[i], last_vector_repeated])
+        c.conds_list = conds_list
+        c.schedules = schedules
 
-    return conds_list, torch.stack(tensors).to(device=param.device, dtype=param.dtype)
+    return c.conds_list, get_compiled_schedule(c, c.schedules).at_step(current_step)
 
 
 re_attention = re.compile(r"""
@@ -1,13 +1,14 @@
 import os
 
 import numpy as np
+import torch
 from PIL import Image
 from basicsr.utils.download_util import load_file_from_url
 from realesrgan import RealESRGANer
 
 from modules.upscaler import Upscaler, UpscalerData
 from modules.shared import cmd_opts, opts
-from modules import modelloader, errors
+from modules import modelloader, errors, tiling
 
 
 class UpscalerRealESRGAN(Upscaler):
@@ -39,14 +40,11 @@ class UpscalerRealESRGAN(Upscaler):
             self.enable = False
             self.scalers = []
 
-    def do_upscale(self, img, path):
-        if not self.enable:
-            return img
-
+    def create_upsampler(self, path):
         info = self.load_model(path)
         if not os.path.exists(info.local_data_path):
             print(f"Unable to load RealESRGAN model: {info.name}")
-            return img
+            return None, None
 
         upsampler = RealESRGANer(
             scale=info.scale,
@@ -57,11 +55,37 @@ class UpscalerRealESRGAN(Upscaler):
             tile_pad=opts.ESRGAN_tile_overlap,
         )
 
+        return info, upsampler
+
+    def do_upscale(self, img, path):
+        if not self.enable:
+            return img
+
+        info, upsampler = self.create_upsampler(path)
+        if upsampler is None:
+            return img
+
+        if img.mode == "RGB":
+            # RealESRGANer treats the array as BGR, so the model sees channels in the same order as with upscale_with_model
+            dtype = torch.float16 if upsampler.half else torch.float32
+            return tiling.upscale_with_model(upsampler.model, img, opts.ESRGAN_tile, opts.ESRGAN_tile_overlap, upsampler.device, dtype=dtype, desc="Real-ESRGAN tiles", pad_to_multiple=4)
+
         upsampled = upsampler.enhance(np.array(img), outscale=info.scale)[0]
 
         image = Image.fromarray(upsampled)
         return image
 
+    def do_upscale_tensor(self, tensor, path):
+        if not self.enable:
+            return tensor
+
+        _, upsampler = self.create_upsampler(path)
+        if upsampler is None:
+            return tensor
+
+        dtype = torch.float16 if upsampler.half else torch.float32
+        return tiling.upscale_tensor_with_model(upsampler.model, tensor, opts.ESRGAN_tile, opts.ESRGAN_tile_overlap, upsampler.device, dtype=dtype, desc="Real-ESRGAN tiles", pad_to_multiple=4)
+
     def load_model(self, path):
         try:
             info = next(iter([scaler for scaler in self.scalers if scaler.data_path == path]), None)
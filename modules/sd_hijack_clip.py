@@ -1,5 +1,5 @@
 import math
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 import torch
 
@@ -42,6 +42,11 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         self.hijack: sd_hijack.StableDiffusionModelHijack = hijack
         self.chunk_length = 75
 
+        self.token_cache = OrderedDict()
+        """results of tokenize_line() for recently seen texts, most recently used last"""
+
+        self.token_cache_size = 512
+
     def empty_chunk(self):
         """creates an empty PromptChunk and returns it"""
 
@@ -176,21 +181,30 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         """
         Accepts a list of texts and calls tokenize_line() on each, with cache. Returns the list of results and maximum
         length, in tokens, of all texts.
+
+        The cache is kept between calls; its entries are only valid for the same set of embeddings and the same
+        settings that affect tokenization, so those are a part of the key.
         """
 
         token_count = 0
 
-        cache = {}
+        settings = (self.hijack.embedding_db.version, opts.enable_emphasis, opts.comma_padding_backtrack)
+
         batch_chunks = []
         for line in texts:
-            if line in cache:
-                chunks = cache[line]
+            key = (line, settings)
+            cached = self.token_cache.get(key)
+            if cached is not None:
+                self.token_cache.move_to_end(key)
+                chunks, current_token_count = cached
             else:
                 chunks, current_token_count = self.tokenize_line(line)
-                token_count = max(current_token_count, token_count)
 
-                cache[line] = chunks
+                self.token_cache[key] = (chunks, current_token_count)
+                while len(self.token_cache) > self.token_cache_size:
+                    self.token_cache.popitem(last=False)
 
+            token_count = max(current_token_count, token_count)
             batch_chunks.append(chunks)
 
         return batch_chunks, token_count
@@ -213,20 +227,21 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
         used_embeddings = {}
         chunk_count = max([len(x) for x in batch_chunks])
+        batch_size = len(batch_chunks)
 
-        zs = []
-        for i in range(chunk_count):
-            batch_chunk = [chunks[i] if i < len(chunks) else self.empty_chunk() for chunks in batch_chunks]
+        # i-th chunks of all texts, for every i in order; all of them are sent through transformers together
+        flat_chunks = [chunks[i] if i < len(chunks) else self.empty_chunk() for i in range(chunk_count) for chunks in batch_chunks]
 
-            tokens = [x.tokens for x in batch_chunk]
-            multipliers = [x.multipliers for x in batch_chunk]
-            self.hijack.fixes = [x.fixes for x in batch_chunk]
+        for chunk in flat_chunks:
+            for _position, embedding in chunk.fixes:
+                used_embeddings[embedding.name] = embedding
 
-            for fixes in self.hijack.fixes:
-                for _position, embedding in fixes:
-                    used_embeddings[embedding.name] = embedding
+        z_flat = self.encode_chunks(flat_chunks)
 
-            z = self.process_tokens(tokens, multipliers)
+        zs = []
+        for i in range(chunk_count):
+            batch_chunk = flat_chunks[i * batch_size:(i + 1) * batch_size]
+            z = self.apply_multipliers(z_flat[i * batch_size:(i + 1) * batch_size], [x.multipliers for x in batch_chunk])
             zs.append(z)
 
         if len(used_embeddings) > 0:
@@ -235,6 +250,23 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
         return torch.hstack(zs)
 
+    def encode_chunks(self, chunks):
+        """
+        sends a list of PromptChunk objects through transformers in batches of up to opts.clip_max_chunks_per_batch chunks,
+        and returns the concatenated result without multipliers applied.
+        """
+
+        max_batch = max(int(opts.clip_max_chunks_per_batch), 1)
+
+        zs = []
+        for start in range(0, len(chunks), max_batch):
+            batch = chunks[start:start + max_batch]
+
+            self.hijack.fixes = [x.fixes for x in batch]
+            zs.append(self.encode_tokens([x.tokens for x in batch]))
+
+        return torch.cat(zs) if len(zs) > 1 else zs[0]
+
     def process_tokens(self, remade_batch_tokens, batch_multipliers):
         """
         sends one single prompt chunk to be encoded by transformers neural network.
@@ -243,6 +275,13 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         Multipliers are used to give more or less weight to the outputs of transformers network. Each multiplier
         corresponds to one token.
         """
+        z = self.encode_tokens(remade_batch_tokens)
+
+        return self.apply_multipliers(z, batch_multipliers)
+
+    def encode_tokens(self, remade_batch_tokens):
+        """encodes a batch of token lists with transformers; self.hijack.fixes must be set up for the same batch"""
+
         tokens = torch.asarray(remade_batch_tokens).to(devices.device)
 
         # this is for SD2: SD1 uses the same token for padding and end of text, while SD2 uses different ones.
@@ -251,7 +290,10 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
                 index = remade_batch_tokens[batch_pos].index(self.id_end)
                 tokens[batch_pos, index+1:tokens.shape[1]] = self.id_pad
 
-        z = self.encode_with_transformers(tokens)
+        return self.encode_with_transformers(tokens)
+
+    def apply_multipliers(self, z, batch_multipliers):
+        """weights the output of transformers for one chunk index of a batch by token multipliers"""
 
         # restoring original mean is likely not correct, but it seems to work well to prevent artifacts that happen otherwise
         batch_multipliers = torch.asarray(batch_multipliers).to(devices.device)
@@ -1,4 +1,3 @@
-import collections
 import os.path
 import sys
 import gc
@@ -14,7 +13,7 @@ import ldm.modules.midas as midas
 
 from ldm.util import instantiate_from_config
 
-from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet
+from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_cache, cond_cache, model_library, init_latent_cache
 from modules.sd_hijack_inpainting import do_inpainting_hijack
 from modules.timer import Timer
 import tomesd
@@ -24,7 +23,8 @@ model_path = os.path.abspath(os.path.join(paths.models_path, model_dir))
 
 checkpoints_list = {}
 checkpoint_alisases = {}
-checkpoints_loaded = collections.OrderedDict()
+checkpoints_lock = threading.RLock()  # guards the two dicts above, which are also changed from the background hashing thread
+checkpoints_loaded = sd_models_cache.cache.entries
 
 
 class CheckpointInfo:
@@ -45,7 +45,7 @@ class CheckpointInfo:
         self.name = name
         self.name_for_extra = os.path.splitext(os.path.basename(filename))[0]
         self.model_name = os.path.splitext(name.replace("/", "_").replace("\\", "_"))[0]
-        self.hash = model_hash(filename)
+        self.hash = model_library.library.file_data(filename, "model_hash", model_hash)
 
         self.sha256 = hashes.sha256_from_cache(self.filename, f"checkpoint/{name}")
         self.shorthash = self.sha256[0:10] if self.sha256 else None
@@ -59,28 +59,53 @@ class CheckpointInfo:
         _, ext = os.path.splitext(self.filename)
         if ext.lower() == ".safetensors":
             try:
-                self.metadata = read_metadata_from_safetensors(filename)
+                self.metadata = model_library.library.file_data(filename, "safetensors_metadata", read_metadata_from_safetensors)
             except Exception as e:
                 errors.display(e, f"reading checkpoint metadata: {filename}")
 
     def register(self):
-        checkpoints_list[self.title] = self
-        for id in self.ids:
-            checkpoint_alisases[id] = self
+        with checkpoints_lock:
+            checkpoints_list[self.title] = self
+            for id in self.ids:
+                checkpoint_alisases[id] = self
+
+    def calculate_shorthash(self, background=False):
+        """
+        Returns the short hash of the checkpoint, calculating the full hash if needed. With background=True, a hash
+        that isn't cached is calculated in a background thread and None is returned while it's pending.
+        """
+
+        if background:
+            sha256 = hashes.sha256_in_background(self.filename, f"checkpoint/{self.name}", callback=self.hash_calculated_in_background)
+        else:
+            sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}")
+
+        return self.set_sha256(sha256)
+
+    def hash_calculated_in_background(self, sha256):
+        with checkpoints_lock:
+            self.set_sha256(sha256)
 
-    def calculate_shorthash(self):
-        self.sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}")
-        if self.sha256 is None:
+            sd_model = model_data.sd_model
+            if sd_model is not None and getattr(sd_model, "sd_checkpoint_info", None) is self:
+                sd_model.sd_model_hash = self.shorthash
+                shared.opts.data["sd_model_checkpoint"] = self.title
+                shared.opts.data["sd_checkpoint_hash"] = self.sha256
+
+    def set_sha256(self, sha256):
+        if sha256 is None:
             return
 
-        self.shorthash = self.sha256[0:10]
+        with checkpoints_lock:
+            self.sha256 = sha256
+            self.shorthash = self.sha256[0:10]
 
-        if self.shorthash not in self.ids:
-            self.ids += [self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]']
+            if self.shorthash not in self.ids:
+                self.ids += [self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]']
 
-        checkpoints_list.pop(self.title)
-        self.title = f'{self.name} [{self.shorthash}]'
-        self.register()
+            checkpoints_list.pop(self.title, None)
+            self.title = f'{self.name} [{self.shorthash}]'
+            self.register()
 
         return self.shorthash
 
@@ -100,6 +125,13 @@ def setup_model():
     enable_midas_autodownload()
 
 
+def checkpoint_infos():
+    """returns a list of all known checkpoints; use this instead of iterating over checkpoints_list directly"""
+
+    with checkpoints_lock:
+        return list(checkpoints_list.values())
+
+
 def checkpoint_tiles():
     def convert(name):
         return int(name) if name.isdigit() else name.lower()
@@ -107,12 +139,13 @@ def checkpoint_tiles():
     def alphanumeric_key(key):
         return [convert(c) for c in re.split('([0-9]+)', key)]
 
-    return sorted([x.title for x in checkpoints_list.values()], key=alphanumeric_key)
+    return sorted([x.title for x in checkpoint_infos()], key=alphanumeric_key)
 
 
 def list_models():
-    checkpoints_list.clear()
-    checkpoint_alisases.clear()
+    with checkpoints_lock:
+        checkpoints_list.clear()
+        checkpoint_alisases.clear()
 
     cmd_ckpt = shared.cmd_opts.ckpt
     if shared.cmd_opts.no_download_sd_model or cmd_ckpt != shared.sd_model_file or os.path.exists(cmd_ckpt):
@@ -134,13 +167,15 @@ def list_models():
         checkpoint_info = CheckpointInfo(filename)
         checkpoint_info.register()
 
+    model_library.library.save()
+
 
 def get_closet_checkpoint_match(search_string):
     checkpoint_info = checkpoint_alisases.get(search_string, None)
     if checkpoint_info is not None:
         return checkpoint_info
 
-    found = sorted([info for info in checkpoints_list.values() if search_string in info.title], key=lambda x: len(x.title))
+    found = sorted([info for info in checkpoint_infos() if search_string in info.title], key=lambda x: len(x.title))
     if found:
         return found[0]
 
@@ -170,7 +205,8 @@ def select_checkpoint():
     if checkpoint_info is not None:
         return checkpoint_info
 
-    if len(checkpoints_list) == 0:
+    infos = checkpoint_infos()
+    if len(infos) == 0:
         error_message = "No checkpoints found. When searching for checkpoints, looked at:"
         if shared.cmd_opts.ckpt is not None:
             error_message += f"\n - file {os.path.abspath(shared.cmd_opts.ckpt)}"
@@ -180,7 +216,7 @@ def select_checkpoint():
         error_message += "Can't run without a checkpoint. Find and place a .ckpt or .safetensors file into any of those locations."
         raise FileNotFoundError(error_message)
 
-    checkpoint_info = next(iter(checkpoints_list.values()))
+    checkpoint_info = infos[0]
     if model_checkpoint is not None:
         print(f"Checkpoint {model_checkpoint} not found; loading fallback {checkpoint_info.title}", file=sys.stderr)
 
@@ -259,23 +295,30 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
 
 
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
-    sd_model_hash = checkpoint_info.calculate_shorthash()
+    sd_model_hash = checkpoint_info.calculate_shorthash(background=True)
     timer.record("calculate hash")
 
-    if checkpoint_info in checkpoints_loaded:
-        # use checkpoint cache
+    res = sd_models_cache.cache.get(checkpoint_info)
+    if res is not None:
         print(f"Loading weights [{sd_model_hash}] from cache")
-        return checkpoints_loaded[checkpoint_info]
+        return res
 
     print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
-    res = read_state_dict(checkpoint_info.filename)
+
+    _, extension = os.path.splitext(checkpoint_info.filename)
+    if extension.lower() == ".safetensors" and (shared.weight_load_location or devices.get_optimal_device_name()) == "cpu":
+        # memory-map the file; tensors are read from disk as they get copied into the model
+        res = sd_models_cache.MappedStateDict(checkpoint_info.filename, transform_checkpoint_dict_key)
+    else:
+        res = read_state_dict(checkpoint_info.filename)
+
     timer.record("load weights from disk")
 
     return res
 
 
 def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer):
-    sd_model_hash = checkpoint_info.calculate_shorthash()
+    sd_model_hash = checkpoint_info.calculate_shorthash(background=True)
     timer.record("calculate hash")
 
     shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
@@ -283,14 +326,11 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     if state_dict is None:
         state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
 
-    model.load_state_dict(state_dict, strict=False)
+    sd_models_cache.load_state_dict_streaming(model, state_dict)
+    sd_models_cache.cache.put(checkpoint_info, state_dict)
     del state_dict
     timer.record("apply weights to model")
 
-    if shared.opts.sd_checkpoint_cache > 0:
-        # cache newly loaded model
-        checkpoints_loaded[checkpoint_info] = model.state_dict().copy()
-
     if shared.cmd_opts.opt_channelslast:
         model.to(memory_format=torch.channels_last)
         timer.record("apply channels_last")
@@ -319,14 +359,13 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     model.first_stage_model.to(devices.dtype_vae)
     timer.record("apply dtype to VAE")
 
-    # clean up cache if limit is reached
-    while len(checkpoints_loaded) > shared.opts.sd_checkpoint_cache:
-        checkpoints_loaded.popitem(last=False)
-
-    model.sd_model_hash = sd_model_hash
-    model.sd_model_checkpoint = checkpoint_info.filename
-    model.sd_checkpoint_info = checkpoint_info
-    shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
+    with checkpoints_lock:
+        # the hash may have been calculated in background while the weights were loading
+        model.sd_model_hash = checkpoint_info.shorthash or sd_model_hash
+        model.sd_model_checkpoint = checkpoint_info.filename
+        model.sd_checkpoint_info = checkpoint_info
+        shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
+        shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
 
     model.logvar = model.logvar.to(devices.device)  # fix for training
 
@@ -478,6 +517,8 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
         sd_model = instantiate_from_config(sd_config.model)
 
     sd_model.used_config = checkpoint_config
+    cond_cache.cache.clear()
+    init_latent_cache.cache.clear()
 
     timer.record("create model")
 
@@ -516,6 +557,20 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
     return sd_model
 
 
+def update_model_derived_state(sd_model):
+    """
+    Recomputes what depends on model weights after new weights were loaded into a model with the same architecture.
+    Embeddings that fit the previous model fit this one too, so only changed embedding directories are reloaded.
+    """
+
+    from modules import sd_hijack
+
+    sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings()
+
+    with devices.autocast(), torch.no_grad():
+        sd_model.cond_stage_model_empty_prompt = sd_model.cond_stage_model([""])
+
+
 def reload_model_weights(sd_model=None, info=None):
     from modules import lowvram, devices, sd_hijack
     checkpoint_info = info or select_checkpoint()
@@ -523,21 +578,8 @@ def reload_model_weights(sd_model=None, info=None):
     if not sd_model:
         sd_model = model_data.sd_model
 
-    if sd_model is None:  # previous model load failed
-        current_checkpoint_info = None
-    else:
-        current_checkpoint_info = sd_model.sd_checkpoint_info
-        if sd_model.sd_model_checkpoint == checkpoint_info.filename:
-            return
-
-        sd_unet.apply_unet("None")
-
-        if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
-            lowvram.send_everything_to_cpu()
-        else:
-            sd_model.to(devices.cpu)
-
-        sd_hijack.model_hijack.undo_hijack(sd_model)
+    if sd_model is not None and sd_model.sd_model_checkpoint == checkpoint_info.filename:
+        return
 
     timer = Timer()
 
@@ -547,11 +589,24 @@ def reload_model_weights(sd_model=None, info=None):
 
     timer.record("find config")
 
+    if sd_model is not None:
+        sd_unet.apply_unet("None")
+
+        if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+            lowvram.send_everything_to_cpu()
+        elif checkpoint_config != sd_model.used_config:
+            sd_model.to(devices.cpu)
+
+        sd_hijack.model_hijack.undo_hijack(sd_model)
+
     if sd_model is None or checkpoint_config != sd_model.used_config:
         del sd_model
         load_model(checkpoint_info, already_loaded_state_dict=state_dict)
         return model_data.sd_model
 
+    # same architecture: copy new weights into the existing model where it is, instead of creating a new one
+    current_checkpoint_info = sd_model.sd_checkpoint_info
+
     try:
         load_model_weights(sd_model, checkpoint_info, state_dict, timer)
     except Exception:
@@ -569,6 +624,9 @@ def reload_model_weights(sd_model=None, info=None):
             sd_model.to(devices.device)
             timer.record("move model to device")
 
+        update_model_derived_state(sd_model)
+        timer.record("update derived state")
+
     print(f"Weights loaded in {timer.summary()}.")
 
     return sd_model
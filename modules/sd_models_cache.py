@@ -0,0 +1,157 @@
+import collections
+import collections.abc
+import os
+import threading
+
+import torch
+
+from modules import shared
+
+
+class MappedStateDict(collections.abc.Mapping):
+    """
+    Read-only state dict backed by a memory-mapped safetensors file.
+
+    Tensors are created on access as views into the mapping, so opening the file reads only its header, and the
+    weights themselves live in the OS page cache, where they are shared by every process that maps the same file.
+    """
+
+    def __init__(self, filename, transform_key=None):
+        import safetensors
+
+        self.filename = filename
+        self.handle = safetensors.safe_open(filename, framework="pt", device="cpu")
+        self.nbytes = os.path.getsize(filename)
+
+        self.keys_map = {}
+        for key in self.handle.keys():
+            new_key = transform_key(key) if transform_key is not None else key
+            if new_key is not None:
+                self.keys_map[new_key] = key
+
+    def __getitem__(self, key):
+        return self.handle.get_tensor(self.keys_map[key])
+
+    def shape(self, key):
+        """returns the shape of a tensor without reading it"""
+
+        return tuple(self.handle.get_slice(self.keys_map[key]).get_shape())
+
+    def __contains__(self, key):
+        return key in self.keys_map
+
+    def __iter__(self):
+        return iter(self.keys_map)
+
+    def __len__(self):
+        return len(self.keys_map)
+
+
+def state_dict_nbytes(state_dict):
+    if isinstance(state_dict, MappedStateDict):
+        return state_dict.nbytes
+
+    return sum(v.nbytes for v in state_dict.values() if isinstance(v, torch.Tensor))
+
+
+def load_state_dict_streaming(model, state_dict, chunk_bytes=256 * 1024 * 1024):
+    """
+    Loads weights from state_dict into model a chunk of tensors at a time, so that for memory-mapped state dicts
+    only one chunk of the checkpoint needs to be paged in at once instead of the whole file.
+    """
+
+    chunk = {}
+    size = 0
+
+    for key in state_dict:
+        tensor = state_dict[key]
+        chunk[key] = tensor
+        size += tensor.nbytes if isinstance(tensor, torch.Tensor) else 0
+
+        if size >= chunk_bytes:
+            model.load_state_dict(chunk, strict=False)
+            chunk.clear()
+            size = 0
+
+    if chunk:
+        model.load_state_dict(chunk, strict=False)
+
+
+class CheckpointCache:
+    """
+    LRU cache of checkpoint state dicts, limited by the sd_checkpoint_cache entry count and by the
+    sd_checkpoint_cache_size byte budget.
+
+    Safetensors checkpoints are kept as memory-mapped MappedStateDict objects and count against the budget with their
+    file size; other checkpoints are kept as regular dicts of tensors in RAM.
+
+    entries is also exposed as sd_models.checkpoints_loaded, and extensions add and remove items there directly, so
+    sizes are computed on demand for entries that were not added with put().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+
+    def enabled(self):
+        return shared.opts.sd_checkpoint_cache > 0 or shared.opts.sd_checkpoint_cache_size > 0
+
+    def size(self, key):
+        nbytes = self.sizes.get(key)
+        if nbytes is None:
+            nbytes = self.sizes[key] = state_dict_nbytes(self.entries[key])
+
+        return nbytes
+
+    def total_bytes(self):
+        return sum(self.size(key) for key in self.entries)
+
+    def get(self, key):
+        with self.lock:
+            state_dict = self.entries.get(key)
+            if state_dict is not None:
+                self.entries.move_to_end(key)
+
+            return state_dict
+
+    def put(self, key, state_dict):
+        if not self.enabled():
+            self.clear()
+            return
+
+        with self.lock:
+            self.entries[key] = state_dict
+            self.entries.move_to_end(key)
+            self.sizes[key] = state_dict_nbytes(state_dict)
+
+            self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """removes least recently used entries until the cache fits its limits; the entry for keep is never removed"""
+
+        max_count = shared.opts.sd_checkpoint_cache
+        max_bytes = shared.opts.sd_checkpoint_cache_size * 1024 * 1024
+
+        for key in set(self.sizes) - set(self.entries):
+            del self.sizes[key]
+
+        for key in list(self.entries):
+            over_count = max_count > 0 and len(self.entries) > max_count
+            over_budget = max_bytes > 0 and self.total_bytes() > max_bytes
+            if not over_count and not over_budget:
+                break
+
+            if key == keep:
+                continue
+
+            del self.entries[key]
+            self.sizes.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+
+
+cache = CheckpointCache()
@@ -53,6 +53,16 @@ k_diffusion_scheduler = {
 }
 
 
+class CFGDenoiserLayout:
+    def __init__(self, key, conds_list, input_indexes, cond_indexes, denoised_image_indexes):
+        self.key = key
+        self.conds_list = conds_list
+        self.input_indexes = input_indexes
+        self.cond_indexes = cond_indexes
+        self.denoised_image_indexes = denoised_image_indexes
+        self.buffers = {}
+
+
 class CFGDenoiser(torch.nn.Module):
     """
     Classifier free guidance denoiser. A wrapper for stable diffusion model (specifically for unet)
@@ -70,6 +80,46 @@ class CFGDenoiser(torch.nn.Module):
         self.step = 0
         self.image_cfg_scale = None
         self.padded_cond_uncond = False
+        self.layout = None
+
+    def get_layout(self, x, conds_list, is_edit_model):
+        """
+        Returns index tensors describing how the input batch for the model is built from x, computed once per batch.
+        Every image is repeated once for each of its AND-subprompts, followed by the whole batch once more for
+        uncond, and, for edit models, once more for image uncond.
+        """
+
+        key = (id(conds_list), len(conds_list), is_edit_model, x.device)
+        if self.layout is not None and self.layout.key == key and self.layout.conds_list is conds_list:
+            return self.layout
+
+        batch_size = len(conds_list)
+        cond_indexes = [i for i, conds in enumerate(conds_list) for _ in conds]
+        uncond_indexes = list(range(batch_size)) * (2 if is_edit_model else 1)
+
+        self.layout = CFGDenoiserLayout(
+            key=key,
+            conds_list=conds_list,
+            input_indexes=torch.tensor(cond_indexes + uncond_indexes, dtype=torch.long, device=x.device),
+            cond_indexes=torch.tensor(cond_indexes, dtype=torch.long, device=x.device),
+            denoised_image_indexes=torch.tensor([conds[0][0] for conds in conds_list], dtype=torch.long, device=x.device),
+        )
+
+        return self.layout
+
+    def select_into_buffer(self, name, source, indexes):
+        """returns source.index_select(0, indexes), writing into a buffer kept for subsequent steps when possible"""
+
+        if torch.is_grad_enabled():
+            return source.index_select(0, indexes)
+
+        buffer = self.layout.buffers.get(name)
+        shape = (indexes.shape[0],) + source.shape[1:]
+        if buffer is None or buffer.shape != shape or buffer.dtype != source.dtype or buffer.device != source.device:
+            buffer = torch.empty(shape, dtype=source.dtype, device=source.device)
+            self.layout.buffers[name] = buffer
+
+        return torch.index_select(source, 0, indexes, out=buffer)
 
     def combine_denoised(self, x_out, conds_list, uncond, cond_scale):
         denoised_uncond = x_out[-uncond.shape[0]:]
@@ -101,7 +151,7 @@ class CFGDenoiser(torch.nn.Module):
         assert not is_edit_model or all(len(conds) == 1 for conds in conds_list), "AND is not supported for InstructPix2Pix checkpoint (unless using Image CFG scale = 1.0)"
 
         batch_size = len(conds_list)
-        repeats = [len(conds_list[i]) for i in range(batch_size)]
+        layout = self.get_layout(x, conds_list, is_edit_model)
 
         if shared.sd_model.model.conditioning_key == "crossattn-adm":
             image_uncond = torch.zeros_like(image_cond)
@@ -110,14 +160,14 @@ class CFGDenoiser(torch.nn.Module):
             image_uncond = image_cond
             make_condition_dict = lambda c_crossattn, c_concat: {"c_crossattn": c_crossattn, "c_concat": [c_concat]}
 
-        if not is_edit_model:
-            x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x])
-            sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma])
-            image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_uncond])
+        x_in = self.select_into_buffer("x_in", x, layout.input_indexes)
+        sigma_in = self.select_into_buffer("sigma_in", sigma, layout.input_indexes)
+        if not is_edit_model and image_uncond is image_cond:
+            image_cond_in = image_cond.index_select(0, layout.input_indexes)
+        elif not is_edit_model:
+            image_cond_in = torch.cat([image_cond.index_select(0, layout.cond_indexes), image_uncond])
         else:
-            x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x] + [x])
-            sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma] + [sigma])
-            image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_uncond] + [torch.zeros_like(self.init_latent)])
+            image_cond_in = torch.cat([image_cond.index_select(0, layout.cond_indexes), image_uncond, torch.zeros_like(self.init_latent)])
 
         denoiser_params = CFGDenoiserParams(x_in, image_cond_in, sigma_in, state.sampling_step, state.sampling_steps, tensor, uncond)
         cfg_denoiser_callback(denoiser_params)
@@ -157,7 +207,7 @@ class CFGDenoiser(torch.nn.Module):
             if shared.batch_cond_uncond:
                 x_out = self.inner_model(x_in, sigma_in, cond=make_condition_dict([cond_in], image_cond_in))
             else:
-                x_out = torch.zeros_like(x_in)
+                x_out = torch.empty_like(x_in)  # every row is written below
                 for batch_offset in range(0, x_out.shape[0], batch_size):
                     a = batch_offset
                     b = a + batch_size
@@ -179,9 +229,8 @@ class CFGDenoiser(torch.nn.Module):
             if not skip_uncond:
                 x_out[-uncond.shape[0]:] = self.inner_model(x_in[-uncond.shape[0]:], sigma_in[-uncond.shape[0]:], cond=make_condition_dict([uncond], image_cond_in[-uncond.shape[0]:]))
 
-        denoised_image_indexes = [x[0][0] for x in conds_list]
         if skip_uncond:
-            fake_uncond = torch.cat([x_out[i:i+1] for i in denoised_image_indexes])
+            fake_uncond = x_out.index_select(0, layout.denoised_image_indexes)
             x_out = torch.cat([x_out, fake_uncond])  # we skipped uncond denoising, so we put cond-denoised image to where the uncond-denoised image should be
 
         denoised_params = CFGDenoisedParams(x_out, state.sampling_step, state.sampling_steps, self.inner_model)
@@ -190,7 +239,7 @@ class CFGDenoiser(torch.nn.Module):
         devices.test_for_nans(x_out, "unet")
 
         if opts.live_preview_content == "Prompt":
-            sd_samplers_common.store_latent(torch.cat([x_out[i:i+1] for i in denoised_image_indexes]))
+            sd_samplers_common.store_latent(x_out.index_select(0, layout.denoised_image_indexes))
         elif opts.live_preview_content == "Negative prompt":
             sd_samplers_common.store_latent(x_out[-uncond.shape[0]:])
 
@@ -314,6 +314,8 @@ options_templates.update(options_section(('saving-images', "Saving images/grids"
 
     "enable_pnginfo": OptionInfo(True, "Save text information about generation parameters as chunks to png files"),
     "save_txt": OptionInfo(False, "Create a text file next to every image with generation parameters."),
+    "save_images_threads": OptionInfo(1, "Number of background threads for saving images during generation", gr.Slider, {"minimum": 0, "maximum": 8, "step": 1}).info("0 = save images in the generation thread"),
+    "save_images_queue_size": OptionInfo(16, "Maximum number of images waiting to be saved in background", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}).info("generation pauses when this many images are waiting"),
     "save_images_before_face_restoration": OptionInfo(False, "Save a copy of image before doing face restoration."),
     "save_images_before_highres_fix": OptionInfo(False, "Save a copy of image before applying highres fix."),
     "save_images_before_color_correction": OptionInfo(False, "Save a copy of image before applying color correction to img2img results"),
@@ -359,6 +361,8 @@ options_templates.update(options_section(('saving-to-dirs', "Saving to a directo
 options_templates.update(options_section(('upscaling', "Upscaling"), {
     "ESRGAN_tile": OptionInfo(192, "Tile size for ESRGAN upscalers.", gr.Slider, {"minimum": 0, "maximum": 512, "step": 16}).info("0 = no tiling"),
     "ESRGAN_tile_overlap": OptionInfo(8, "Tile overlap for ESRGAN upscalers.", gr.Slider, {"minimum": 0, "maximum": 48, "step": 1}).info("Low values = visible seam"),
+    "hires_fix_upscale_on_device": OptionInfo(False, "Hires fix: upscale images without leaving the GPU when the upscaler supports it").info("ESRGAN, Real-ESRGAN and Nearest; skips conversion to PIL images and back; results differ slightly from the PIL path"),
+    "upscaler_tile_batch_size": OptionInfo(4, "Number of tiles to upscale at once", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).info("ESRGAN, Real-ESRGAN, SwinIR and ScuNET; halved automatically if VRAM runs out"),
     "realesrgan_enabled_models": OptionInfo(["R-ESRGAN 4x+", "R-ESRGAN 4x+ Anime6B"], "Select which Real-ESRGAN models to show in the web UI.", gr.CheckboxGroup, lambda: {"choices": shared_items.realesrgan_models_names()}),
     "upscaler_for_img2img": OptionInfo(None, "Upscaler for img2img", gr.Dropdown, lambda: {"choices": [x.name for x in sd_upscalers]}),
 }))
@@ -376,6 +380,14 @@ options_templates.update(options_section(('system', "System"), {
     "multiple_tqdm": OptionInfo(True, "Add a second progress bar to the console that shows progress for an entire job."),
     "print_hypernet_extra": OptionInfo(False, "Print extra hypernetwork information to console."),
     "list_hidden_files": OptionInfo(True, "Load models/files in hidden directories").info("directory is hidden if its name starts with \".\""),
+    "queue_max_size": OptionInfo(0, "Maximum number of generation jobs waiting in queue", gr.Number, {"precision": 0}).info("0 = unlimited; new jobs over the limit are rejected"),
+    "queue_max_size_per_client": OptionInfo(0, "Maximum number of generation jobs waiting in queue for a single API client", gr.Number, {"precision": 0}).info("0 = unlimited"),
+    "api_results_ttl": OptionInfo(60, "Keep results of API tasks on disk for, in minutes", gr.Number, {"precision": 0}).info("0 = don't keep; results can be fetched with /sdapi/v1/task-result"),
+    "api_results_max_count": OptionInfo(64, "Maximum number of API task results kept on disk", gr.Number, {"precision": 0}),
+    "hash_in_background": OptionInfo(True, "Calculate missing checkpoint and Lora hashes in background").info("generation does not wait for a hash; it is left out of infotext until calculated"),
+    "hash_threads": OptionInfo(2, "Number of threads for calculating hashes in background", gr.Slider, {"minimum": 1, "maximum": 8, "step": 1}).needs_restart(),
+    "model_library_index": OptionInfo(True, "Keep an index of model directories and only list directories that changed when refreshing models").info("new and deleted files are noticed when their directory changes; cached data for a file is checked against the file's own modification time and size"),
+    "api_batch_coalescing_max_size": OptionInfo(0, "Merge compatible txt2img API requests waiting in queue into batches of up to this size", gr.Slider, {"minimum": 0, "maximum": 64, "step": 1}).info("0 = disable; only requests with batch count 1, no scripts and otherwise identical settings are merged"),
 }))
 
 options_templates.update(options_section(('training', "Training"), {
@@ -396,6 +408,7 @@ options_templates.update(options_section(('training', "Training"), {
 options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "sd_model_checkpoint": OptionInfo(None, "Stable Diffusion checkpoint", gr.Dropdown, lambda: {"choices": list_checkpoint_tiles()}, refresh=refresh_checkpoints),
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    "sd_checkpoint_cache_size": OptionInfo(0, "Memory budget for cached checkpoints, in MB", gr.Number).info("0 = limit by count only; safetensors checkpoints are memory-mapped, so their pages are shared between processes"),
     "sd_vae_checkpoint_cache": OptionInfo(0, "VAE Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
     "sd_vae": OptionInfo("Automatic", "SD VAE", gr.Dropdown, lambda: {"choices": shared_items.sd_vae_items()}, refresh=shared_items.refresh_vae_list).info("choose VAE model: Automatic = use one with same filename as checkpoint; None = use VAE from checkpoint"),
     "sd_vae_as_default": OptionInfo(True, "Ignore selected VAE for stable diffusion checkpoints that have their own .vae.pt next to them"),
@@ -422,6 +435,10 @@ options_templates.update(options_section(('optimizations', "Optimizations"), {
     "token_merging_ratio_hr": OptionInfo(0.0, "Token merging ratio for high-res pass", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}).info("only applies if non-zero and overrides above"),
     "pad_cond_uncond": OptionInfo(False, "Pad prompt/negative prompt to be same length").info("improves performance when prompt and negative prompt have different lengths; changes seeds"),
     "experimental_persistent_cond_cache": OptionInfo(False, "persistent cond cache").info("Experimental, keep cond caches across jobs, reduce overhead."),
+    "clip_max_chunks_per_batch": OptionInfo(32, "Maximum number of 75-token prompt chunks to encode with CLIP at once", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}).info("all chunks of all texts in a batch are encoded together, in batches of up to this size"),
+    "cond_cache_size": OptionInfo(64, "Memory for caching encoded prompts between generations, in MB", gr.Number, {"precision": 0}).info("0 = disable; cached conds are kept in VRAM"),
+    "init_latent_cache_size": OptionInfo(64, "Memory for caching VAE-encoded img2img init images between generations, in MB", gr.Number, {"precision": 0}).info("0 = disable; repeated edits of the same image with the same settings skip the VAE encoder; kept in VRAM"),
+    "vae_decode_batch_size": OptionInfo(0, "VAE decode batch size", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}).info("number of images decoded by VAE at once; 0 = whole batch; if VRAM runs out, smaller batches and then tiled decoding are used"),
 }))
 
 options_templates.update(options_section(('compatibility', "Compatibility"), {
@@ -539,6 +556,8 @@ options_templates.update(options_section(('postprocessing', "Postprocessing"), {
     'postprocessing_enable_in_main_ui': OptionInfo([], "Enable postprocessing operations in txt2img and img2img tabs", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
     'postprocessing_operation_order': OptionInfo([], "Postprocessing operation order", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
     'upscaling_max_images_in_cache': OptionInfo(5, "Maximum number of images in upscaling cache", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    'postprocessing_workers': OptionInfo(2, "Number of threads reading images for batch postprocessing", gr.Slider, {"minimum": 1, "maximum": 8, "step": 1}).info("images are read and saved in background while the previous image is being processed"),
+    'postprocessing_resume_batch': OptionInfo(True, "Skip already processed files when batch processing a directory again with same settings").info("processed files are recorded in postprocessing-manifest.jsonl in the output directory"),
 }))
 
 options_templates.update(options_section((None, "Hidden options"), {
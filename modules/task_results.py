@@ -0,0 +1,105 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+from modules import shared, errors
+from modules.paths import data_path
+
+
+class TaskResultStore:
+    """
+    Keeps results of finished tasks on disk, one JSON file per task, so that a client can fetch the result of a task
+    after the request that started it is gone, including after a restart.
+
+    Results are removed after api_results_ttl minutes, and only api_results_max_count most recent results are kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return shared.opts.api_results_ttl > 0 and shared.opts.api_results_max_count > 0
+
+    def filename(self, id_task):
+        return os.path.join(self.path, hashlib.sha256(id_task.encode("utf8")).hexdigest()[0:32] + ".json")
+
+    def expired(self, mtime):
+        return time.time() - mtime > shared.opts.api_results_ttl * 60
+
+    def put(self, id_task, status, result=None, error=None):
+        if not self.enabled():
+            return
+
+        entry = {
+            "id_task": id_task,
+            "status": status,
+            "time_finished": time.time(),
+            "result": result,
+            "error": error,
+        }
+
+        filename = self.filename(id_task)
+        tmp_filename = f"{filename}.tmp"
+
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+
+            with open(tmp_filename, "w", encoding="utf8") as file:
+                json.dump(entry, file)
+
+            os.replace(tmp_filename, filename)
+
+            self.evict()
+
+    def get(self, id_task):
+        """returns the stored entry for the task, or None if there isn't one or it has expired"""
+
+        filename = self.filename(id_task)
+
+        try:
+            if self.expired(os.path.getmtime(filename)):
+                return None
+
+            with open(filename, "r", encoding="utf8") as file:
+                entry = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+        if entry.get("id_task") != id_task:
+            return None
+
+        return entry
+
+    def contains(self, id_task):
+        filename = self.filename(id_task)
+
+        try:
+            return not self.expired(os.path.getmtime(filename))
+        except OSError:
+            return False
+
+    def evict(self):
+        entries = []
+        for filename in glob.glob(os.path.join(self.path, "*.json")):
+            try:
+                entries.append((os.path.getmtime(filename), filename))
+            except OSError:
+                pass
+
+        entries.sort(reverse=True)
+
+        for i, (mtime, filename) in enumerate(entries):
+            if i < shared.opts.api_results_max_count and not self.expired(mtime):
+                continue
+
+            try:
+                os.remove(filename)
+            except OSError as e:
+                errors.display(e, f"removing expired task result {filename}")
+
+
+store = TaskResultStore(os.path.join(data_path, "task_results"))
@@ -12,7 +12,7 @@ import numpy as np
 from PIL import Image, PngImagePlugin
 from torch.utils.tensorboard import SummaryWriter
 
-from modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors
+from modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, cond_cache, model_library
 import modules.textual_inversion.dataset
 from modules.textual_inversion.learn_schedule import LearnRateScheduler
 
@@ -110,6 +110,11 @@ class EmbeddingDatabase:
         self.expected_shape = -1
         self.embedding_dirs = {}
         self.previously_displayed_embeddings = ()
+        self.version = 0
+        """incremented every time the set of registered embeddings changes"""
+
+        self.loaded_files = {}
+        """filename -> ([mtime, size], embedding or None) for files loaded by load_from_dir, so unchanged files are not read again"""
 
     def add_embedding_dir(self, path):
         self.embedding_dirs[path] = DirWithTextualInversionEmbeddings(path)
@@ -121,6 +126,7 @@ class EmbeddingDatabase:
         return self.register_embedding_by_name(embedding, model, embedding.name)
 
     def register_embedding_by_name(self, embedding, model, name):
+        self.version += 1
         ids = model.cond_stage_model.tokenize([name])[0]
         first_id = ids[0]
         if first_id not in self.ids_lookup:
@@ -148,13 +154,26 @@ class EmbeddingDatabase:
         return vec.shape[1]
 
     def load_from_file(self, path, filename):
+        embedding = self.read_embedding_from_file(path, filename)
+        if embedding is not None:
+            self.register_loaded_embedding(embedding)
+
+        return embedding
+
+    def register_loaded_embedding(self, embedding):
+        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
+            self.register_embedding(embedding, shared.sd_model)
+        else:
+            self.skipped_embeddings[embedding.name] = embedding
+
+    def read_embedding_from_file(self, path, filename):
         name, ext = os.path.splitext(filename)
         ext = ext.upper()
 
         if ext in ['.PNG', '.WEBP', '.JXL', '.AVIF']:
             _, second_ext = os.path.splitext(name)
             if second_ext.upper() == '.PREVIEW':
-                return
+                return None
 
             embed_image = Image.open(path)
             if hasattr(embed_image, 'text') and 'sd-ti-embedding' in embed_image.text:
@@ -166,13 +185,13 @@ class EmbeddingDatabase:
                     name = data.get('name', name)
                 else:
                     # if data is None, means this is not an embeding, just a preview image
-                    return
+                    return None
         elif ext in ['.BIN', '.PT']:
             data = torch.load(path, map_location="cpu")
         elif ext in ['.SAFETENSORS']:
             data = safetensors.torch.load_file(path, device="cpu")
         else:
-            return
+            return None
 
         # textual inversion embeddings
         if 'string_to_param' in data:
@@ -199,28 +218,38 @@ class EmbeddingDatabase:
         embedding.shape = vec.shape[-1]
         embedding.filename = path
 
-        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
-            self.register_embedding(embedding, shared.sd_model)
-        else:
-            self.skipped_embeddings[name] = embedding
+        return embedding
 
     def load_from_dir(self, embdir):
+        """loads embeddings from directory embdir; returns the list of files found there"""
+
         if not os.path.isdir(embdir.path):
-            return
+            return []
 
-        for root, _, fns in os.walk(embdir.path, followlinks=True):
-            for fn in fns:
-                try:
-                    fullfn = os.path.join(root, fn)
+        filenames = model_library.library.walk_files(embdir.path)
+        for fullfn in filenames:
+            fn = os.path.basename(fullfn)
 
-                    if os.stat(fullfn).st_size == 0:
-                        continue
+            try:
+                stat = model_library.library.stat(fullfn)
+                if stat[1] == 0:
+                    continue
 
-                    self.load_from_file(fullfn, fn)
-                except Exception:
-                    errors.report(f"Error loading embedding {fn}", exc_info=True)
+                loaded = self.loaded_files.get(fullfn)
+                if loaded is not None and loaded[0] == stat:
+                    embedding = loaded[1]
+                    if embedding is not None:
+                        self.register_loaded_embedding(embedding)
                     continue
 
+                embedding = self.load_from_file(fullfn, fn)
+                self.loaded_files[fullfn] = (stat, embedding)
+            except Exception:
+                errors.report(f"Error loading embedding {fn}", exc_info=True)
+                continue
+
+        return filenames
+
     def load_textual_inversion_embeddings(self, force_reload=False):
         if not force_reload:
             need_reload = False
@@ -232,15 +261,22 @@ class EmbeddingDatabase:
             if not need_reload:
                 return
 
+        cond_cache.cache.clear()
+        self.version += 1
         self.ids_lookup.clear()
         self.word_embeddings.clear()
         self.skipped_embeddings.clear()
         self.expected_shape = self.get_expected_shape()
 
+        found_files = set()
         for embdir in self.embedding_dirs.values():
-            self.load_from_dir(embdir)
+            found_files.update(self.load_from_dir(embdir))
             embdir.update()
 
+        # forget embeddings from files that were deleted
+        for filename in set(self.loaded_files) - found_files:
+            del self.loaded_files[filename]
+
         # re-sort word_embeddings because load_from_dir may not load in alphabetic order.
         # using a temporary copy so we don't reinitialize self.word_embeddings in case other objects have a reference to it.
         sorted_word_embeddings = {e.name: e for e in sorted(self.word_embeddings.values(), key=lambda e: e.name.lower())}
@@ -584,6 +620,7 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
 
                     preview_text = p.prompt
 
+                    cond_cache.cache.clear()  # the embedding being trained has changed since the last preview
                     processed = processing.process_images(p)
                     image = processed.images[0] if len(processed.images) > 0 else None
 
@@ -0,0 +1,179 @@
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from modules import devices, shared
+
+
+def tile_starts(length, tile_size, overlap):
+    """positions of tiles of tile_size along a side of length, overlapping by at least overlap; the last tile ends at the edge"""
+
+    if length <= tile_size:
+        return [0]
+
+    return list(range(0, length - tile_size, max(tile_size - overlap, 1))) + [length - tile_size]
+
+
+def tile_blend_weights(height, width, overlap, device):
+    """weights for a tile that fall off linearly over overlap pixels at each edge; never zero, so borders of the image stay intact"""
+
+    def ramp(length):
+        n = min(overlap, length // 2)
+        weights = torch.ones(length, device=device)
+        if n > 0:
+            edge = torch.arange(1, n + 1, device=device, dtype=torch.float32) / (n + 1)
+            weights[:n] = edge
+            weights[length - n:] = edge.flip(0)
+        return weights
+
+    return torch.minimum(ramp(height)[:, None], ramp(width)[None, :])[None, None]
+
+
+def tiled_upscale(img, model, tile_size, tile_overlap, desc="Tiles", batch_size=None):
+    """
+    Runs model on img, a (1, C, H, W) tensor, in overlapping tiles of up to tile_size x tile_size, and returns the
+    combined result. Tiles are slices of img, and are sent to the model several at once, in batches of
+    opts.upscaler_tile_batch_size; the batch is halved if VRAM runs out. Results are blended where they overlap on
+    the device the model returns them on. tile_size=0 runs the model on the whole image.
+    """
+
+    height, width = img.shape[2], img.shape[3]
+    if tile_size <= 0 or (height <= tile_size and width <= tile_size):
+        return model(img)
+
+    if batch_size is None:
+        batch_size = shared.opts.upscaler_tile_batch_size
+
+    tile_h = min(tile_size, height)
+    tile_w = min(tile_size, width)
+    positions = [(y, x) for y in tile_starts(height, tile_h, tile_overlap) for x in tile_starts(width, tile_w, tile_overlap)]
+
+    result = None
+    result_weights = None
+    weights = None
+    output = None
+
+    with tqdm(total=len(positions), desc=desc) as pbar:
+        index = 0
+        while index < len(positions):
+            if index > 0 and (shared.state.interrupted or shared.state.skipped):
+                break
+
+            batch_positions = positions[index:index + batch_size]
+            batch = torch.cat([img[:, :, y:y + tile_h, x:x + tile_w] for y, x in batch_positions])
+
+            try:
+                output = model(batch)
+            except RuntimeError as e:  # torch.cuda.OutOfMemoryError is a subclass of RuntimeError
+                if "out of memory" not in str(e) or batch_size == 1:
+                    raise
+
+                del batch
+                devices.torch_gc()
+                batch_size = max(batch_size // 2, 1)
+                continue
+
+            scale = output.shape[2] // tile_h
+
+            if result is None:
+                result = torch.zeros((1, output.shape[1], height * scale, width * scale), device=output.device, dtype=torch.float32)
+                result_weights = torch.zeros((1, 1, height * scale, width * scale), device=output.device, dtype=torch.float32)
+                weights = tile_blend_weights(output.shape[2], output.shape[3], tile_overlap * scale, output.device)
+
+            for (y, x), tile in zip(batch_positions, output):
+                region = (slice(None), slice(None), slice(y * scale, y * scale + output.shape[2]), slice(x * scale, x * scale + output.shape[3]))
+                result[region] += tile.float() * weights
+                result_weights[region] += weights
+
+            index += len(batch_positions)
+            pbar.update(len(batch_positions))
+
+    return (result / result_weights.clamp_(min=1e-8)).to(output.dtype)
+
+
+def pil_image_to_torch_bgr(img, device, dtype=torch.float32):
+    """converts a PIL image to a (1, 3, H, W) tensor with BGR channels in 0..1 range; conversion is done on device"""
+
+    arr = np.array(img.convert("RGB"))
+    tensor = torch.from_numpy(arr).to(device)
+
+    return tensor.permute(2, 0, 1).flip(0).unsqueeze(0).to(dtype) / 255
+
+
+def torch_bgr_to_pil_image(tensor):
+    """inverse of pil_image_to_torch_bgr; only the small uint8 result is copied from the device"""
+
+    arr = (tensor[0].float().clamp(0, 1) * 255).round().to(torch.uint8).flip(0).permute(1, 2, 0).cpu().numpy()
+
+    return Image.fromarray(arr, "RGB")
+
+
+def upscale_bgr(model, tensor, tile_size, tile_overlap, desc="Tiles", pad_to_multiple=1):
+    """
+    Upscales a (1, 3, H, W) BGR tensor with a model that takes and returns BGR tensors, using tiled_upscale. With
+    pad_to_multiple, the image is padded by reflection to a multiple of that in both dimensions first, for models that
+    need it.
+    """
+
+    height, width = tensor.shape[2], tensor.shape[3]
+    pad_h = -height % pad_to_multiple
+    pad_w = -width % pad_to_multiple
+    if pad_h or pad_w:
+        tensor = torch.nn.functional.pad(tensor, (0, pad_w, 0, pad_h), mode="reflect")
+
+    with torch.no_grad():
+        output = tiled_upscale(tensor, model, tile_size, tile_overlap, desc=desc)
+
+    scale = output.shape[2] // tensor.shape[2]
+    return output[:, :, :height * scale, :width * scale]
+
+
+def upscale_with_model(model, img, tile_size, tile_overlap, device, dtype=torch.float32, desc="Tiles", pad_to_multiple=1):
+    """Upscales PIL image img with a model that takes and returns BGR tensors; see upscale_bgr"""
+
+    tensor = pil_image_to_torch_bgr(img, device, dtype)
+    output = upscale_bgr(model, tensor, tile_size, tile_overlap, desc=desc, pad_to_multiple=pad_to_multiple)
+
+    return torch_bgr_to_pil_image(output)
+
+
+def upscale_tensor_with_model(model, tensor, tile_size, tile_overlap, device, dtype=torch.float32, desc="Tiles", pad_to_multiple=1):
+    """
+    Same as upscale_with_model, but for a batch of RGB images in a (B, 3, H, W) tensor with values in 0..1 range, as
+    used by Upscaler.do_upscale_tensor. Returns a float32 tensor on the device tensor was on.
+    """
+
+    results = []
+    for image in tensor:
+        image = image[None].flip(1).to(device, dtype)
+        output = upscale_bgr(model, image, tile_size, tile_overlap, desc=desc, pad_to_multiple=pad_to_multiple)
+        results.append(output.flip(1).float().clamp_(0, 1))
+
+    return torch.cat(results).to(tensor.device)
+
+
+def combine_grid(grid, device):
+    """
+    Tensor counterpart of images.combine_grid: tiles of grid, PIL images, are blended on device with
+    tile_blend_weights over grid.overlap pixels at their edges, instead of being pasted one over another.
+    Tiles that are None are skipped and leave black areas.
+    """
+
+    result = torch.zeros((3, grid.image_h, grid.image_w), device=device)
+    result_weights = torch.zeros((1, grid.image_h, grid.image_w), device=device)
+
+    for y, h, row in grid.tiles:
+        for x, w, tile in row:
+            if tile is None:
+                continue
+
+            weights = tile_blend_weights(h, w, grid.overlap, device)[0]
+            tile = torch.from_numpy(np.array(tile.convert("RGB"))).to(device).permute(2, 0, 1).float()
+
+            result[:, y:y + h, x:x + w] += tile * weights
+            result_weights[:, y:y + h, x:x + w] += weights
+
+    result = (result / result_weights.clamp_(min=1e-8)).round_().clamp_(0, 255).to(torch.uint8)
+
+    return Image.fromarray(result.permute(1, 2, 0).cpu().numpy(), "RGB")
@@ -14,7 +14,7 @@ class ExtraNetworksPageCheckpoints(ui_extra_networks.ExtraNetworksPage):
 
     def list_items(self):
         checkpoint: sd_models.CheckpointInfo
-        for index, (name, checkpoint) in enumerate(sd_models.checkpoints_list.items()):
+        for index, checkpoint in enumerate(sd_models.checkpoint_infos()):
             path, ext = os.path.splitext(checkpoint.filename)
             yield {
                 "name": checkpoint.name_for_extra,
@@ -22,7 +22,7 @@ class ExtraNetworksPageCheckpoints(ui_extra_networks.ExtraNetworksPage):
                 "preview": self.find_preview(path),
                 "description": self.find_description(path),
                 "search_term": self.search_terms_from_path(checkpoint.filename) + " " + (checkpoint.sha256 or ""),
-                "onclick": '"' + html.escape(f"""return selectCheckpoint({json.dumps(name)})""") + '"',
+                "onclick": '"' + html.escape(f"""return selectCheckpoint({json.dumps(checkpoint.title)})""") + '"',
                 "local_preview": f"{path}.{shared.opts.samples_format}",
                 "sort_keys": {'default': index, **self.get_sort_keys(checkpoint.filename)},
 
@@ -2,6 +2,7 @@ import os
 from abc import abstractmethod
 
 import PIL
+import torch
 from PIL import Image
 
 import modules.shared
@@ -72,6 +73,39 @@ class Upscaler:
 
         return img
 
+    def do_upscale_tensor(self, tensor, selected_model: str):
+        """
+        Upscales a batch of RGB images in a (B, 3, H, W) tensor with values in 0..1 range, without leaving the
+        device, and returns the result in the same form. Returns None if the upscaler only works with PIL images.
+        """
+
+        return None
+
+    def upscale_tensor(self, tensor, scale, selected_model: str = None):
+        """same as upscale, but for tensors as used by do_upscale_tensor; returns None if those are not supported"""
+
+        self.scale = scale
+        dest_w = int((tensor.shape[3] * scale) // 8 * 8)
+        dest_h = int((tensor.shape[2] * scale) // 8 * 8)
+
+        for _ in range(3):
+            shape = tensor.shape
+
+            tensor = self.do_upscale_tensor(tensor, selected_model)
+            if tensor is None:
+                return None
+
+            if shape == tensor.shape:
+                break
+
+            if tensor.shape[3] >= dest_w and tensor.shape[2] >= dest_h:
+                break
+
+        if tensor.shape[3] != dest_w or tensor.shape[2] != dest_h:
+            tensor = resize_tensor(tensor, dest_w, dest_h)
+
+        return tensor
+
     @abstractmethod
     def load_model(self, path: str):
         pass
@@ -83,6 +117,12 @@ class Upscaler:
         print(f"\nextras: {prompt}", file=shared.progress_print_out)
 
 
+def resize_tensor(tensor, width, height):
+    """resizes a batch of images in a (B, C, H, W) tensor with values in 0..1 range; tensor counterpart of a LANCZOS resize"""
+
+    return torch.nn.functional.interpolate(tensor.float(), size=(height, width), mode="bicubic", antialias=True).clamp_(0, 1)
+
+
 class UpscalerData:
     name = None
     data_path = None
@@ -135,6 +175,9 @@ class UpscalerNearest(Upscaler):
     def do_upscale(self, img, selected_model=None):
         return img.resize((int(img.width * self.scale), int(img.height * self.scale)), resample=NEAREST)
 
+    def do_upscale_tensor(self, tensor, selected_model=None):
+        return torch.nn.functional.interpolate(tensor.float(), size=(int(tensor.shape[2] * self.scale), int(tensor.shape[3] * self.scale)), mode="nearest-exact")
+
     def load_model(self, _):
         pass
 
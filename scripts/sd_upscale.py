@@ -2,13 +2,116 @@ import math
 
 import modules.scripts as scripts
 import gradio as gr
-from PIL import Image
+import torch
 
-from modules import processing, shared, images, devices
+from modules import processing, shared, images, devices, tiling
 from modules.processing import Processed
 from modules.shared import opts, state
 
 
+class TiledImg2Img:
+    """
+    Runs img2img for all tiles of an image in a single process_images call instead of one call per batch of tiles,
+    so that prompts, conds, extra networks and script hooks are set up once. Installed on p in place of its
+    setup_prompts, init and sample methods: init encodes all tiles with VAE, batch_size at a time, and every
+    iteration of process_images samples the next batch of them.
+
+    first_job is the number of batches done before this call, for the progress shown in state.job.
+    """
+
+    def __init__(self, p, tiles, batch_size, seeds, subseeds, first_job=0):
+        self.p = p
+        self.tiles = tiles
+        self.batch_size = batch_size
+        self.seeds = seeds
+        self.subseeds = subseeds
+        self.first_job = first_job
+        self.saved_params = None
+        self.init_latents = None
+        self.image_conditionings = None
+        self.color_corrections = None
+
+    def install(self):
+        p = self.p
+
+        self.saved_params = p.batch_size, p.n_iter, p.seed, p.subseed
+
+        p.setup_prompts = self.setup_prompts
+        p.init = self.init
+        p.sample = self.sample
+        p.batch_size = self.batch_size
+        p.n_iter = math.ceil(len(self.tiles) / self.batch_size)
+        p.seed = self.seeds
+        p.subseed = self.subseeds
+
+    def uninstall(self):
+        p = self.p
+
+        del p.setup_prompts, p.init, p.sample
+        p.batch_size, p.n_iter, p.seed, p.subseed = self.saved_params
+        self.init_latents = None
+        self.image_conditionings = None
+
+    def setup_prompts(self):
+        p = self.p
+
+        type(p).setup_prompts(p)
+        p.all_prompts = p.all_prompts[:len(self.tiles)]
+        p.all_negative_prompts = p.all_negative_prompts[:len(self.tiles)]
+
+    def init(self, all_prompts, all_seeds, all_subseeds):
+        p = self.p
+
+        init_latents = []
+        image_conditionings = []
+        color_corrections = []
+
+        for start in range(0, len(self.tiles), self.batch_size):
+            p.init_images = self.tiles[start:start + self.batch_size]
+            p.batch_size = len(p.init_images)
+            p.color_corrections = None
+
+            type(p).init(p, all_prompts, all_seeds, all_subseeds)
+
+            init_latents.append(p.init_latent)
+            image_conditionings.append(p.image_conditioning)
+            color_corrections += p.color_corrections or []
+
+        p.batch_size = self.batch_size
+        self.init_latents = torch.cat(init_latents)
+        self.image_conditionings = torch.cat(image_conditionings)
+        self.color_corrections = color_corrections or None
+
+    def sample(self, conditioning, unconditional_conditioning, seeds, subseeds, subseed_strength, prompts):
+        p = self.p
+
+        state.job = f"Batch {self.first_job + p.iteration + 1} out of {state.job_count}"
+
+        start = p.iteration * self.batch_size
+        end = start + len(seeds)
+
+        p.init_latent = self.init_latents[start:end]
+        p.image_conditioning = self.image_conditionings[start:end]
+        if self.color_corrections is not None:
+            p.color_corrections = self.color_corrections[start:end]
+
+        return type(p).sample(p, conditioning, unconditional_conditioning, seeds, subseeds, subseed_strength, prompts)
+
+
+def tile_seeds(p, start_seed, subseed, count, batch_size):
+    """seeds and subseeds for count tiles, same as those of a separate process_images call for every batch of tiles"""
+
+    seeds = []
+    subseeds = []
+
+    for i, start in enumerate(range(0, count, batch_size)):
+        n = min(batch_size, count - start)
+        seeds += [start_seed + i + (k if p.subseed_strength == 0 else 0) for k in range(n)]
+        subseeds += [subseed + k for k in range(n)]
+
+    return seeds, subseeds
+
+
 class Script(scripts.Script):
     def title(self):
         return "SD upscale"
@@ -35,6 +138,7 @@ class Script(scripts.Script):
 
         initial_info = None
         seed = p.seed
+        subseed = p.subseed
 
         init_img = p.init_images[0]
         init_img = images.flatten(init_img, opts.img2img_background_color)
@@ -68,29 +172,28 @@ class Script(scripts.Script):
         result_images = []
         for n in range(upscale_count):
             start_seed = seed + n
-            p.seed = start_seed
+            seeds, subseeds = tile_seeds(p, start_seed, subseed, len(work), batch_size)
 
-            work_results = []
-            for i in range(batch_count):
-                p.batch_size = batch_size
-                p.init_images = work[i * batch_size:(i + 1) * batch_size]
+            engine = TiledImg2Img(p, work, batch_size, seeds, subseeds, first_job=n * batch_count)
+            engine.install()
 
-                state.job = f"Batch {i + 1 + n * batch_count} out of {state.job_count}"
+            try:
                 processed = processing.process_images(p)
+            finally:
+                engine.uninstall()
 
-                if initial_info is None:
-                    initial_info = processed.info
+            if initial_info is None:
+                initial_info = processed.info
 
-                p.seed = processed.seed + 1
-                work_results += processed.images
+            work_results = processed.images[processed.index_of_first_image:]
 
             image_index = 0
             for _y, _h, row in grid.tiles:
                 for tiledata in row:
-                    tiledata[2] = work_results[image_index] if image_index < len(work_results) else Image.new("RGB", (p.width, p.height))
+                    tiledata[2] = work_results[image_index] if image_index < len(work_results) else None
                     image_index += 1
 
-            combined_image = images.combine_grid(grid)
+            combined_image = tiling.combine_grid(grid, devices.device)
             result_images.append(combined_image)
 
             if opts.samples_save:
@@ -3,6 +3,7 @@ from copy import copy
 from itertools import permutations, chain
 import random
 import csv
+import time
 from io import StringIO
 from PIL import Image
 import numpy as np
@@ -10,7 +11,7 @@ import numpy as np
 import modules.scripts as scripts
 import gradio as gr
 
-from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_samplers_kdiffusion
+from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_samplers_kdiffusion, extra_networks
 from modules.processing import process_images, Processed, StableDiffusionProcessingTxt2Img
 from modules.shared import opts, state
 import modules.shared as shared
@@ -180,7 +181,7 @@ def str_permutations(x):
 
 
 class AxisOption:
-    def __init__(self, label, type, apply, format_value=format_value_add_label, confirm=None, cost=0.0, choices=None):
+    def __init__(self, label, type, apply, format_value=format_value_add_label, confirm=None, cost=0.0, choices=None, batchable=False):
         self.label = label
         self.type = type
         self.apply = apply
@@ -188,6 +189,7 @@ class AxisOption:
         self.confirm = confirm
         self.cost = cost
         self.choices = choices
+        self.batchable = batchable  # only changes seeds or prompts, so cells that differ in it can be made in one batch
 
 
 class AxisOptionImg2Img(AxisOption):
@@ -202,19 +204,19 @@ class AxisOptionTxt2Img(AxisOption):
 
 
 axis_options = [
-    AxisOption("Nothing", str, do_nothing, format_value=format_nothing),
-    AxisOption("Seed", int, apply_field("seed")),
-    AxisOption("Var. seed", int, apply_field("subseed")),
+    AxisOption("Nothing", str, do_nothing, format_value=format_nothing, batchable=True),
+    AxisOption("Seed", int, apply_field("seed"), batchable=True),
+    AxisOption("Var. seed", int, apply_field("subseed"), batchable=True),
     AxisOption("Var. strength", float, apply_field("subseed_strength")),
     AxisOption("Steps", int, apply_field("steps")),
     AxisOptionTxt2Img("Hires steps", int, apply_field("hr_second_pass_steps")),
     AxisOption("CFG Scale", float, apply_field("cfg_scale")),
     AxisOptionImg2Img("Image CFG Scale", float, apply_field("image_cfg_scale")),
-    AxisOption("Prompt S/R", str, apply_prompt, format_value=format_value),
-    AxisOption("Prompt order", str_permutations, apply_order, format_value=format_value_join_list),
+    AxisOption("Prompt S/R", str, apply_prompt, format_value=format_value, batchable=True),
+    AxisOption("Prompt order", str_permutations, apply_order, format_value=format_value_join_list, batchable=True),
     AxisOptionTxt2Img("Sampler", str, apply_sampler, format_value=format_value, confirm=confirm_samplers, choices=lambda: [x.name for x in sd_samplers.samplers]),
     AxisOptionImg2Img("Sampler", str, apply_sampler, format_value=format_value, confirm=confirm_samplers, choices=lambda: [x.name for x in sd_samplers.samplers_for_img2img]),
-    AxisOption("Checkpoint name", str, apply_checkpoint, format_value=format_value, confirm=confirm_checkpoints, cost=1.0, choices=lambda: sorted(sd_models.checkpoints_list, key=str.casefold)),
+    AxisOption("Checkpoint name", str, apply_checkpoint, format_value=format_value, confirm=confirm_checkpoints, cost=1.0, choices=lambda: sorted([x.title for x in sd_models.checkpoint_infos()], key=str.casefold)),
     AxisOption("Negative Guidance minimum sigma", float, apply_field("s_min_uncond")),
     AxisOption("Sigma Churn", float, apply_field("s_churn")),
     AxisOption("Sigma min", float, apply_field("s_tmin")),
@@ -225,7 +227,7 @@ axis_options = [
     AxisOption("Schedule max sigma", float, apply_override("sigma_max")),
     AxisOption("Schedule rho", float, apply_override("rho")),
     AxisOption("Eta", float, apply_field("eta")),
-    AxisOption("Clip skip", int, apply_clip_skip),
+    AxisOption("Clip skip", int, apply_clip_skip, cost=0.3),
     AxisOption("Denoising", float, apply_field("denoising_strength")),
     AxisOptionTxt2Img("Hires upscaler", str, apply_field("hr_upscaler"), choices=lambda: [*shared.latent_upscale_modes, *[x.name for x in shared.sd_upscalers]]),
     AxisOptionImg2Img("Cond. Image Mask Weight", float, apply_field("inpainting_mask_weight")),
@@ -238,7 +240,123 @@ axis_options = [
 ]
 
 
-def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend, include_lone_images, include_sub_grids, first_axes_processed, second_axes_processed, margin_size):
+def nested_cells(xs, ys, zs, first_axes_processed, second_axes_processed):
+    """(ix, iy, iz) of all cells, in the order of nested loops over axes, first_axes_processed being the outermost"""
+
+    lengths = {'x': len(xs), 'y': len(ys), 'z': len(zs)}
+    third_axes_processed = next(axis for axis in 'xyz' if axis not in (first_axes_processed, second_axes_processed))
+
+    cells = []
+    for i1 in range(lengths[first_axes_processed]):
+        for i2 in range(lengths[second_axes_processed]):
+            for i3 in range(lengths[third_axes_processed]):
+                indexes = {first_axes_processed: i1, second_axes_processed: i2, third_axes_processed: i3}
+                cells.append((indexes['x'], indexes['y'], indexes['z']))
+
+    return cells
+
+
+class XyzPlanner:
+    """
+    Decides in which order cells of a plot are made, and which of them are made together.
+
+    Cells are ordered by values of axes that have a cost, such as checkpoint and VAE, most expensive axis first, and
+    then by extra networks in their prompts, so that every checkpoint, VAE and set of Loras is loaded as few times as
+    possible. Cells that need the same of all of those and differ only in values of batchable axes (seeds and
+    prompts) are made in one process_images call, up to max_batch_size cells at once. That's only done if the
+    plot makes a single image per cell.
+    """
+
+    def __init__(self, p, axes, max_batch_size):
+        self.p = p
+        self.axes = axes
+        self.costly_axes = sorted([i for i, axis in enumerate(axes) if axis.axis.cost > 0], key=lambda i: -axes[i].axis.cost)
+        self.max_batch_size = max_batch_size if self.can_batch() else 1
+        self.networks_keys = {}
+
+    def can_batch(self):
+        return self.p.batch_size == 1 and self.p.n_iter == 1 and getattr(self.p, "image_mask", None) is None
+
+    def costly_key(self, cell):
+        return tuple(cell[i] for i in self.costly_axes)
+
+    def networks_key(self, cell):
+        """extra networks in the cell's prompt; they are only read from the first prompt of a batch, so cells with different ones must not be batched"""
+
+        key = self.networks_keys.get(cell)
+        if key is not None:
+            return key
+
+        pc = copy(self.p)
+        for (opt, values), index in zip(self.axes, cell):
+            if opt.batchable:
+                opt.apply(pc, values[index], values)
+
+        prompt = pc.prompt[0] if type(pc.prompt) == list else pc.prompt
+        _, extra_network_data = extra_networks.parse_prompt(prompt)
+
+        key = tuple(sorted((name, tuple(tuple(params.items) for params in params_list)) for name, params_list in extra_network_data.items()))
+        self.networks_keys[cell] = key
+
+        return key
+
+    def batch_key(self, cell):
+        return tuple(index for (opt, _), index in zip(self.axes, cell) if not opt.batchable), self.networks_key(cell)
+
+    def plan(self, cells):
+        """takes cells in the default order and returns a list of batches, lists of cells to make together"""
+
+        networks_order = {}
+        for cell in cells:
+            networks_order.setdefault(self.networks_key(cell), len(networks_order))
+
+        ordered = sorted(cells, key=lambda cell: (self.costly_key(cell), networks_order[self.networks_key(cell)]))
+
+        groups = {}
+        for cell in ordered:
+            groups.setdefault(self.batch_key(cell), []).append(cell)
+
+        return [group[i:i + self.max_batch_size] for group in groups.values() for i in range(0, len(group), self.max_batch_size)]
+
+    def switches(self, batches):
+        """indexes of batches that need a different value of a costly axis than the batch before"""
+
+        return [i for i in range(1, len(batches)) if self.costly_key(batches[i][0]) != self.costly_key(batches[i - 1][0])]
+
+
+class XyzTimings:
+    """
+    Running estimates of how long it takes to make a batch of a plot, per sampling step, and how long it takes to
+    switch to different values of costly axes, such as loading a checkpoint; used to tell how long a plot will take.
+    """
+
+    def __init__(self):
+        self.step = None
+        self.switch = None
+
+    @staticmethod
+    def blend(old, new):
+        return new if old is None else old * 0.7 + new * 0.3
+
+    def update(self, seconds, steps, switched):
+        if not switched:
+            self.step = self.blend(self.step, seconds / max(steps, 1))
+        elif self.step is not None:
+            self.switch = self.blend(self.switch, max(seconds - steps * self.step, 0))
+
+    def estimate(self, steps, switches):
+        """seconds to make batches with a total of steps sampling steps, with switches changes of costly axes, or None if unknown"""
+
+        if self.step is None:
+            return None
+
+        return steps * self.step + switches * (self.switch or 0)
+
+
+timings = XyzTimings()
+
+
+def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend, include_lone_images, include_sub_grids, batches, margin_size):
     hor_texts = [[images.GridAnnotation(x)] for x in x_labels]
     ver_texts = [[images.GridAnnotation(y)] for y in y_labels]
     title_texts = [[images.GridAnnotation(z)] for z in z_labels]
@@ -247,17 +365,20 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
 
     processed_result = None
 
-    state.job_count = list_size * p.n_iter
+    state.job_count = len(batches) * p.n_iter
+
+    cells_done = 0
 
-    def process_cell(x, y, z, ix, iy, iz):
-        nonlocal processed_result
+    def process_batch(batch):
+        nonlocal processed_result, cells_done
 
         def index(ix, iy, iz):
             return ix + iy * len(xs) + iz * len(xs) * len(ys)
 
-        state.job = f"{index(ix, iy, iz) + 1} out of {list_size}"
+        state.job = f"{cells_done + 1} out of {list_size}" if len(batch) == 1 else f"{cells_done + 1}-{cells_done + len(batch)} out of {list_size}"
+        cells_done += len(batch)
 
-        processed: Processed = cell(x, y, z, ix, iy, iz)
+        processed: Processed = cell(batch)
 
         if processed_result is None:
             # Use our first processed result object as a template container to hold our full results
@@ -268,53 +389,29 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
             processed_result.infotexts = [None] * list_size
             processed_result.index_of_first_image = 1
 
-        idx = index(ix, iy, iz)
-        if processed.images:
-            # Non-empty list indicates some degree of success.
-            processed_result.images[idx] = processed.images[0]
-            processed_result.all_prompts[idx] = processed.prompt
-            processed_result.all_seeds[idx] = processed.seed
-            processed_result.infotexts[idx] = processed.infotexts[0]
-        else:
-            cell_mode = "P"
-            cell_size = (processed_result.width, processed_result.height)
-            if processed_result.images[0] is not None:
-                cell_mode = processed_result.images[0].mode
-                #This corrects size in case of batches:
-                cell_size = processed_result.images[0].size
-            processed_result.images[idx] = Image.new(cell_mode, cell_size)
-
-
-    if first_axes_processed == 'x':
-        for ix, x in enumerate(xs):
-            if second_axes_processed == 'y':
-                for iy, y in enumerate(ys):
-                    for iz, z in enumerate(zs):
-                        process_cell(x, y, z, ix, iy, iz)
-            else:
-                for iz, z in enumerate(zs):
-                    for iy, y in enumerate(ys):
-                        process_cell(x, y, z, ix, iy, iz)
-    elif first_axes_processed == 'y':
-        for iy, y in enumerate(ys):
-            if second_axes_processed == 'x':
-                for ix, x in enumerate(xs):
-                    for iz, z in enumerate(zs):
-                        process_cell(x, y, z, ix, iy, iz)
-            else:
-                for iz, z in enumerate(zs):
-                    for ix, x in enumerate(xs):
-                        process_cell(x, y, z, ix, iy, iz)
-    elif first_axes_processed == 'z':
-        for iz, z in enumerate(zs):
-            if second_axes_processed == 'x':
-                for ix, x in enumerate(xs):
-                    for iy, y in enumerate(ys):
-                        process_cell(x, y, z, ix, iy, iz)
+        for k, (ix, iy, iz) in enumerate(batch):
+            idx = index(ix, iy, iz)
+
+            # a batch of cells has one image per cell and no grid
+            image_index = 0 if len(batch) == 1 else k
+
+            if image_index < len(processed.images):
+                # Non-empty list indicates some degree of success.
+                processed_result.images[idx] = processed.images[image_index]
+                processed_result.all_prompts[idx] = processed.prompt if len(batch) == 1 else processed.all_prompts[k]
+                processed_result.all_seeds[idx] = processed.seed if len(batch) == 1 else processed.all_seeds[k]
+                processed_result.infotexts[idx] = processed.infotexts[image_index]
             else:
-                for iy, y in enumerate(ys):
-                    for ix, x in enumerate(xs):
-                        process_cell(x, y, z, ix, iy, iz)
+                cell_mode = "P"
+                cell_size = (processed_result.width, processed_result.height)
+                if processed_result.images[0] is not None:
+                    cell_mode = processed_result.images[0].mode
+                    #This corrects size in case of batches:
+                    cell_size = processed_result.images[0].size
+                processed_result.images[idx] = Image.new(cell_mode, cell_size)
+
+    for batch in batches:
+        process_batch(batch)
 
     if not processed_result:
         # Should never happen, I've only seen it on one of four open tabs and it needed to refresh.
@@ -408,6 +505,8 @@ class Script(scripts.Script):
                 include_sub_grids = gr.Checkbox(label='Include Sub Grids', value=False, elem_id=self.elem_id("include_sub_grids"))
             with gr.Column():
                 margin_size = gr.Slider(label="Grid margins (px)", minimum=0, maximum=500, value=0, step=2, elem_id=self.elem_id("margin_size"))
+            with gr.Column():
+                max_batch_cells = gr.Slider(label="Cells per batch", minimum=1, maximum=16, value=1, step=1, elem_id=self.elem_id("max_batch_cells"))
 
         with gr.Row(variant="compact", elem_id="swap_axes"):
             swap_xy_axes_button = gr.Button(value="Swap X/Y axes", elem_id="xy_grid_swap_axes_button")
@@ -465,9 +564,9 @@ class Script(scripts.Script):
             (z_values_dropdown, lambda params:get_dropdown_update_from_params("Z",params)),
         )
 
-        return [x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, margin_size]
+        return [x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, margin_size, max_batch_cells]
 
-    def run(self, p, x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, margin_size):
+    def run(self, p, x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, margin_size, max_batch_cells=1):
         if not no_fixed_seeds:
             modules.processing.fix_seed(p)
 
@@ -569,34 +668,18 @@ class Script(scripts.Script):
             ys = fix_axis_seeds(y_opt, ys)
             zs = fix_axis_seeds(z_opt, zs)
 
-        if x_opt.label == 'Steps':
-            total_steps = sum(xs) * len(ys) * len(zs)
-        elif y_opt.label == 'Steps':
-            total_steps = sum(ys) * len(xs) * len(zs)
-        elif z_opt.label == 'Steps':
-            total_steps = sum(zs) * len(xs) * len(ys)
-        else:
-            total_steps = p.steps * len(xs) * len(ys) * len(zs)
-
-        if isinstance(p, StableDiffusionProcessingTxt2Img) and p.enable_hr:
-            if x_opt.label == "Hires steps":
-                total_steps += sum(xs) * len(ys) * len(zs)
-            elif y_opt.label == "Hires steps":
-                total_steps += sum(ys) * len(xs) * len(zs)
-            elif z_opt.label == "Hires steps":
-                total_steps += sum(zs) * len(xs) * len(ys)
-            elif p.hr_second_pass_steps:
-                total_steps += p.hr_second_pass_steps * len(xs) * len(ys) * len(zs)
-            else:
-                total_steps *= 2
+        axes = [AxisInfo(x_opt, xs), AxisInfo(y_opt, ys), AxisInfo(z_opt, zs)]
 
-        total_steps *= p.n_iter
+        def cell_steps(cell):
+            """sampling steps made for a cell, or for a batch of cells it's the first of"""
 
-        image_cell_count = p.n_iter * p.batch_size
-        cell_console_text = f"; {image_cell_count} images per cell" if image_cell_count > 1 else ""
-        plural_s = 's' if len(zs) > 1 else ''
-        print(f"X/Y/Z plot will create {len(xs) * len(ys) * len(zs) * image_cell_count} images on {len(zs)} {len(xs)}x{len(ys)} grid{plural_s}{cell_console_text}. (Total steps to process: {total_steps})")
-        shared.total_tqdm.updateTotal(total_steps)
+            values = {opt.label: values[index] for (opt, values), index in zip(axes, cell)}
+            steps = values.get('Steps', p.steps)
+
+            if isinstance(p, StableDiffusionProcessingTxt2Img) and p.enable_hr:
+                steps += values.get('Hires steps', p.hr_second_pass_steps or steps)
+
+            return steps * p.n_iter
 
         state.xyz_plot_x = AxisInfo(x_opt, xs)
         state.xyz_plot_y = AxisInfo(y_opt, ys)
@@ -626,20 +709,64 @@ class Script(scripts.Script):
             else:
                 second_axes_processed = 'y'
 
+        planner = XyzPlanner(p, axes, max_batch_cells)
+        batches = planner.plan(nested_cells(xs, ys, zs, first_axes_processed, second_axes_processed))
+        switches = planner.switches(batches)
+
+        total_steps = sum(cell_steps(batch[0]) for batch in batches)
+
+        image_cell_count = p.n_iter * p.batch_size
+        cell_console_text = f"; {image_cell_count} images per cell" if image_cell_count > 1 else ""
+        plural_s = 's' if len(zs) > 1 else ''
+        print(f"X/Y/Z plot will create {len(xs) * len(ys) * len(zs) * image_cell_count} images on {len(zs)} {len(xs)}x{len(ys)} grid{plural_s}{cell_console_text}. (Total steps to process: {total_steps})")
+
+        estimate = timings.estimate(total_steps, len(switches))
+        costly_labels = ", ".join(axes[i].axis.label for i in planner.costly_axes)
+        switches_text = f" with {len(switches)} changes of {costly_labels}" if costly_labels else ""
+        estimate_text = f"; estimated time: {time.strftime('%H:%M:%S', time.gmtime(estimate))}" if estimate is not None else ""
+        print(f"X/Y/Z plot will run {len(batches)} batches{switches_text}{estimate_text}.")
+
+        shared.total_tqdm.updateTotal(total_steps)
+
         grid_infotext = [None] * (1 + len(zs))
+        batch_indexes = {id(batch): i for i, batch in enumerate(batches)}
+        switches = set(switches)
 
-        def cell(x, y, z, ix, iy, iz):
+        def cell(batch):
             if shared.state.interrupted:
                 return Processed(p, [], p.seed, "")
 
-            pc = copy(p)
-            pc.styles = pc.styles[:]
-            x_opt.apply(pc, x, xs)
-            y_opt.apply(pc, y, ys)
-            z_opt.apply(pc, z, zs)
+            pcs = []
+            for ix, iy, iz in batch:
+                pc = copy(p)
+                pc.styles = pc.styles[:]
+                x_opt.apply(pc, xs[ix], xs)
+                y_opt.apply(pc, ys[iy], ys)
+                z_opt.apply(pc, zs[iz], zs)
+                pcs.append(pc)
+
+            pc = pcs[0]
+            if len(pcs) > 1:
+                pc.prompt = [x.prompt for x in pcs]
+                pc.negative_prompt = [x.negative_prompt for x in pcs]
+                pc.seed = [processing.get_fixed_seed(x.seed) for x in pcs]
+                pc.subseed = [processing.get_fixed_seed(x.subseed) for x in pcs]
+                pc.batch_size = len(pcs)
+                pc.do_not_save_grid = True  # the cells of a batch are unrelated; each goes into the plot on its own
+
+            time_start = time.perf_counter()
 
             res = process_images(pc)
 
+            if not shared.state.interrupted:
+                timings.update(time.perf_counter() - time_start, cell_steps(batch[0]), batch_indexes[id(batch)] in switches)
+
+            for position_in_batch, (ix, iy, iz) in enumerate(batch):
+                set_grid_infotexts(pc, ix, iy, iz, position_in_batch)
+
+            return res
+
+        def set_grid_infotexts(pc, ix, iy, iz, position_in_batch):
             # Sets subgrid infotexts
             subgrid_index = 1 + iz
             if grid_infotext[subgrid_index] is None and ix == 0 and iy == 0:
@@ -658,7 +785,7 @@ class Script(scripts.Script):
                     if y_opt.label in ["Seed", "Var. seed"] and not no_fixed_seeds:
                         pc.extra_generation_params["Fixed Y Values"] = ", ".join([str(y) for y in ys])
 
-                grid_infotext[subgrid_index] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds)
+                grid_infotext[subgrid_index] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds, position_in_batch=position_in_batch)
 
             # Sets main grid infotext
             if grid_infotext[0] is None and ix == 0 and iy == 0 and iz == 0:
@@ -670,9 +797,7 @@ class Script(scripts.Script):
                     if z_opt.label in ["Seed", "Var. seed"] and not no_fixed_seeds:
                         pc.extra_generation_params["Fixed Z Values"] = ", ".join([str(z) for z in zs])
 
-                grid_infotext[0] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds)
-
-            return res
+                grid_infotext[0] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds, position_in_batch=position_in_batch)
 
         with SharedSettingsStackHelper():
             processed = draw_xyz_grid(
@@ -687,8 +812,7 @@ class Script(scripts.Script):
                 draw_legend=draw_legend,
                 include_lone_images=include_lone_images,
                 include_sub_grids=include_sub_grids,
-                first_axes_processed=first_axes_processed,
-                second_axes_processed=second_axes_processed,
+                batches=batches,
                 margin_size=margin_size
             )
 
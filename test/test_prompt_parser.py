@@ -0,0 +1,63 @@
+import torch
+
+from modules import prompt_parser
+from modules.prompt_parser import ScheduledPromptConditioning, ComposableScheduledPromptConditioning, MulticondLearnedConditioning
+
+
+def reconstruct_multicond_batch_uncompiled(c, current_step):
+    """reconstruct_multicond_batch as it was before schedules were compiled"""
+
+    param = c.batch[0][0].schedules[0].cond
+
+    tensors = []
+    conds_list = []
+
+    for composable_prompts in c.batch:
+        conds_for_batch = []
+
+        for composable_prompt in composable_prompts:
+            target_index = 0
+            for current, entry in enumerate(composable_prompt.schedules):
+                if current_step <= entry.end_at_step:
+                    target_index = current
+                    break
+
+            conds_for_batch.append((len(tensors), composable_prompt.weight))
+            tensors.append(composable_prompt.schedules[target_index].cond)
+
+        conds_list.append(conds_for_batch)
+
+    token_count = max([x.shape[0] for x in tensors])
+    for i in range(len(tensors)):
+        if tensors[i].shape[0] != token_count:
+            last_vector = tensors[i][-1:]
+            last_vector_repeated = last_vector.repeat([token_count - tensors[i].shape[0], 1])
+            tensors[i] = torch.vstack([tensors[i], last_vector_repeated])
+
+    return conds_list, torch.stack(tensors).to(device=param.device, dtype=param.dtype)
+
+
+def test_compiled_schedule_with_mixed_token_counts():
+    generator = torch.Generator().manual_seed(0)
+    short = torch.randn((77, 8), generator=generator)
+    long = torch.randn((154, 8), generator=generator)
+    other = torch.randn((77, 8), generator=generator)
+
+    # [short:long:10] AND other, and a prompt that only uses other
+    c = MulticondLearnedConditioning(shape=(2,), batch=[
+        [
+            ComposableScheduledPromptConditioning([ScheduledPromptConditioning(10, short), ScheduledPromptConditioning(20, long)]),
+            ComposableScheduledPromptConditioning([ScheduledPromptConditioning(20, other)], weight=0.5),
+        ],
+        [
+            ComposableScheduledPromptConditioning([ScheduledPromptConditioning(20, other)]),
+        ],
+    ])
+
+    for step in [-1, 0, 9, 10, 11, 19, 20, 21, 30]:
+        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(c, step)
+        expected_conds_list, expected_tensor = reconstruct_multicond_batch_uncompiled(c, step)
+
+        assert conds_list == expected_conds_list
+        assert tensor.shape == expected_tensor.shape
+        assert torch.equal(tensor, expected_tensor)
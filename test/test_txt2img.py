@@ -1,4 +1,6 @@
 
+import time
+
 import pytest
 import requests
 
@@ -88,3 +90,28 @@ def test_txt2img_multiple_batches_performed(url_txt2img, simple_txt2img_request)
 def test_txt2img_batch_performed(url_txt2img, simple_txt2img_request):
     simple_txt2img_request["batch_size"] = 2
     assert requests.post(url_txt2img, json=simple_txt2img_request).status_code == 200
+
+
+def test_txt2img_submit_then_poll(url_txt2img, simple_txt2img_request, base_url):
+    response = requests.post(f"{url_txt2img}/submit", json=simple_txt2img_request)
+    assert response.status_code == 200
+
+    id_task = response.json()["id_task"]
+    for _ in range(600):
+        result = requests.get(f"{base_url}/sdapi/v1/task-result", params={"id_task": id_task})
+        assert result.status_code == 200
+        if result.json()["status"] not in ("queued", "running"):
+            break
+
+        time.sleep(0.1)
+
+    assert result.json()["status"] == "finished"
+    assert len(result.json()["result"]["images"]) == 1
+
+
+def test_txt2img_multipart(url_txt2img, simple_txt2img_request):
+    simple_txt2img_request["image_format"] = "png"
+    response = requests.post(f"{url_txt2img}/multipart", json=simple_txt2img_request)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("multipart/mixed")
+    assert response.content.count(b"Content-Type: image/png") == 1